@@ -0,0 +1,154 @@
+import os
+
+import numpy as np
+
+# =====================================================
+# Configuration
+# =====================================================
+CENTROIDS_FILE = "ivf_centroids.npy"
+ASSIGNMENTS_FILE = "ivf_assignments.npy"
+DEFAULT_NPROBE = 16
+KMEANS_ITERATIONS = 20
+TRAINING_POINTS_PER_LIST = 64
+MAX_TRAINING_POINTS = 50_000  # Bounds k-means memory to ~300 MB at 1536 dims
+ASSIGN_BLOCK_ROWS = 8192
+
+
+def default_n_lists(n_vectors):
+    # Rule of thumb for IVF: roughly 4 * sqrt(n) inverted lists
+    return max(1, min(n_vectors, int(4 * np.sqrt(n_vectors))))
+
+
+def assign_to_centroids(vectors, centroids):
+    """Nearest centroid (by dot product) for every row, computed in blocks."""
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_BLOCK_ROWS):
+        block = np.asarray(vectors[start : start + ASSIGN_BLOCK_ROWS])
+        assignments[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(vectors, n_lists, iterations=KMEANS_ITERATIONS, seed=0):
+    """K-means on the unit sphere, suited to cosine search over normalized vectors."""
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign_to_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=n_lists)
+        empty = counts == 0
+        if empty.any():
+            # Re-seed empty lists with random points so every list is used
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = sums / norms
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """Inverted-file ANN index over the rows of a ``LocalVectorStore``.
+
+    Rows are bucketed by their nearest k-means centroid. A query scores the
+    centroids, scans only the ``nprobe`` closest lists and ranks those rows
+    exactly, so ``nprobe`` trades recall for speed. New rows are appended to
+    their nearest list without retraining.
+    """
+
+    def __init__(self, centroids, assignments, nprobe=DEFAULT_NPROBE):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.assignments = np.asarray(assignments, dtype=np.int32)
+        self.nprobe = nprobe
+        self._lists = None
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, vectors, rows, n_lists=None, nprobe=DEFAULT_NPROBE, capacity=None, seed=0):
+        """Train centroids on a sample of ``vectors`` and assign every row."""
+        rows = np.asarray(rows, dtype=np.int64)
+        n_lists = n_lists or default_n_lists(len(rows))
+        n_lists = min(n_lists, len(rows))
+        rng = np.random.default_rng(seed)
+        sample_size = min(
+            len(rows), n_lists * TRAINING_POINTS_PER_LIST, MAX_TRAINING_POINTS
+        )
+        sample = np.sort(rng.choice(rows, sample_size, replace=False))
+        centroids = spherical_kmeans(vectors[sample], n_lists, seed=seed)
+
+        capacity = capacity if capacity is not None else int(rows.max()) + 1
+        index = cls(centroids, np.empty(0, dtype=np.int32), nprobe=nprobe)
+        index.reassign(vectors, rows, capacity)
+        return index
+
+    # -------------------------------------------------
+    # Mutation
+    # -------------------------------------------------
+    def add(self, rows, vectors):
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return
+        needed = int(rows.max()) + 1
+        if needed > len(self.assignments):
+            grown = np.full(max(needed, 2 * len(self.assignments)), -1, dtype=np.int32)
+            grown[: len(self.assignments)] = self.assignments
+            self.assignments = grown
+        self.assignments[rows] = assign_to_centroids(vectors, self.centroids)
+        self._lists = None
+
+    def reassign(self, vectors, rows, capacity):
+        """Forget every assignment and assign ``rows`` to the trained centroids."""
+        rows = np.asarray(rows, dtype=np.int64)
+        self.assignments = np.full(capacity, -1, dtype=np.int32)
+        self._lists = None
+        for start in range(0, len(rows), ASSIGN_BLOCK_ROWS):
+            chunk = rows[start : start + ASSIGN_BLOCK_ROWS]
+            self.add(chunk, vectors[chunk])
+
+    def remove(self, rows):
+        rows = [row for row in rows if row < len(self.assignments)]
+        self.assignments[rows] = -1
+        self._lists = None
+
+    # -------------------------------------------------
+    # Search
+    # -------------------------------------------------
+    def _inverted_lists(self):
+        if self._lists is None:
+            assigned = np.flatnonzero(self.assignments >= 0)
+            order = assigned[np.argsort(self.assignments[assigned], kind="stable")]
+            bounds = np.searchsorted(
+                self.assignments[order], np.arange(self.n_lists + 1)
+            )
+            self._lists = [order[bounds[i] : bounds[i + 1]] for i in range(self.n_lists)]
+        return self._lists
+
+    def candidates(self, query, nprobe=None):
+        """Rows in the ``nprobe`` lists whose centroids are closest to ``query``."""
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        centroid_scores = self.centroids @ query
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        lists = self._inverted_lists()
+        return np.concatenate([lists[i] for i in probe])
+
+    # -------------------------------------------------
+    # Persistence
+    # -------------------------------------------------
+    def save(self, path):
+        np.save(os.path.join(path, CENTROIDS_FILE), self.centroids)
+        np.save(os.path.join(path, ASSIGNMENTS_FILE), self.assignments)
+
+    @classmethod
+    def load(cls, path, nprobe=DEFAULT_NPROBE):
+        centroids_path = os.path.join(path, CENTROIDS_FILE)
+        if not os.path.exists(centroids_path):
+            return None
+        return cls(
+            np.load(centroids_path),
+            np.load(os.path.join(path, ASSIGNMENTS_FILE)),
+            nprobe=nprobe,
+        )
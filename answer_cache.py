@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# =====================================================
+# Configuration
+# =====================================================
+# Touched by vectorizer.py after ingestion; cached answers older than it are stale
+DEFAULT_GENERATION_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "instance", "index_generation"
+)
+DEFAULT_THRESHOLD = 0.95  # Cosine similarity between question embeddings
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 1000
+
+
+def bump_generation(path=DEFAULT_GENERATION_PATH):
+    """Mark the vector index as changed so every answer cache drops its entries."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(f"{time.time()}\n")
+
+
+class AnswerCache:
+    """Semantic cache of answers to standalone questions.
+
+    Question embeddings are kept normalized in a fixed-size matrix, so a
+    lookup is one matrix-vector product. A lookup hits when the closest
+    cached question has cosine similarity of at least ``threshold`` and has
+    not outlived ``ttl``, and, when the caller passes the ids it retrieves
+    for the question now, only if they are the ids the answer was built
+    from. Entries are evicted least-recently-used once ``max_entries`` is
+    reached. The cache is cleared when the file at ``generation_path``
+    changes, i.e. when the index was re-ingested.
+    """
+
+    def __init__(
+        self,
+        threshold=DEFAULT_THRESHOLD,
+        ttl=DEFAULT_TTL_SECONDS,
+        max_entries=DEFAULT_MAX_ENTRIES,
+        generation_path=DEFAULT_GENERATION_PATH,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.generation_path = generation_path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale = 0
+        self._lock = threading.Lock()
+        self._vectors = None  # (max_entries, dim), allocated on first insert
+        self._valid = np.zeros(max_entries, dtype=bool)
+        self._entries = OrderedDict()  # row -> (answer, result_ids, created_at), LRU order
+        self._generation = self._read_generation()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # -------------------------------------------------
+    # Lookups
+    # -------------------------------------------------
+    def lookup(self, embedding, result_ids=None):
+        """Return (answer, result_ids) for a similar cached question, or None.
+
+        Given ``result_ids``, an entry built from other results is dropped.
+        """
+        query = self._normalize(embedding)
+        with self._lock:
+            self._check_generation()
+            row = self._nearest(query)
+            if row is not None:
+                answer, cached_ids, created_at = self._entries[row]
+                if result_ids is not None and list(result_ids) != cached_ids:
+                    self.stale += 1
+                elif time.time() - created_at <= self.ttl:
+                    self._entries.move_to_end(row)
+                    self.hits += 1
+                    return answer, cached_ids
+                self._drop(row)
+            self.misses += 1
+            return None
+
+    def put(self, embedding, answer, result_ids=()):
+        if self.max_entries <= 0:
+            return
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._check_generation()
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            # A near-duplicate question replaces the older answer
+            row = self._nearest(vector)
+            if row is None:
+                if len(self._entries) >= self.max_entries:
+                    self._drop(next(iter(self._entries)))
+                    self.evictions += 1
+                row = int(np.flatnonzero(~self._valid)[0])
+            self._vectors[row] = vector
+            self._valid[row] = True
+            self._entries[row] = (answer, list(result_ids), time.time())
+            self._entries.move_to_end(row)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._valid[:] = False
+            self.invalidations += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "stale": self.stale,
+        }
+
+    # -------------------------------------------------
+    # Internals (callers hold self._lock)
+    # -------------------------------------------------
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _nearest(self, query):
+        if not self._entries or len(query) != self._vectors.shape[1]:
+            return None
+        scores = self._vectors @ query
+        scores[~self._valid] = -np.inf
+        row = int(np.argmax(scores))
+        return row if scores[row] >= self.threshold else None
+
+    def _drop(self, row):
+        del self._entries[row]
+        self._valid[row] = False
+
+    def _read_generation(self):
+        if self.generation_path is None:
+            return None
+        try:
+            stat = os.stat(self.generation_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _check_generation(self):
+        generation = self._read_generation()
+        if generation != self._generation:
+            self._generation = generation
+            self._entries.clear()
+            self._valid[:] = False
+            self.invalidations += 1
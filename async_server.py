@@ -0,0 +1,535 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+
+import httpx
+from aiohttp import web
+from openai import AsyncOpenAI
+from upstash_vector.errors import UpstashError
+from upstash_vector.types import QueryResult
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+from flask import render_template
+
+import main
+from main import app as flask_app, db, HistoryMessage
+from vector_store import UPSTASH_URL
+from job_queue import claim, complete, new_owner, release
+from single_flight import AsyncSingleFlight, normalize_query
+from instrumentation import (
+    COALESCED_CALLS,
+    REQUEST_SECONDS,
+    STAGE_ERRORS,
+    STAGE_SECONDS,
+    TRACE_HEADER,
+    new_trace_id,
+    record_usage,
+    stage,
+)
+
+# =====================================================
+# Configuration
+# =====================================================
+# Per-stage deadlines in seconds
+EMBED_TIMEOUT = float(os.getenv("RAG_EMBED_TIMEOUT", 10))
+QUERY_TIMEOUT = float(os.getenv("RAG_QUERY_TIMEOUT", 5))
+COMPLETION_TIMEOUT = float(os.getenv("RAG_COMPLETION_TIMEOUT", 60))
+# Size of the shared keep-alive connection pool to OpenAI
+MAX_CONNECTIONS = int(os.getenv("RAG_MAX_CONNECTIONS", 100))
+TIMEOUT_MESSAGE = "Sorry, the request timed out. Please try again."
+
+PIPELINE_KEY = web.AppKey("pipeline", object)
+# Strong references to replies still being generated for departed clients
+_background_tasks = set()
+
+logger = logging.getLogger(__name__)
+
+
+# =====================================================
+# Async RAG pipeline
+# =====================================================
+class AsyncUpstashIndex:
+    """Upstash vector queries over an ``httpx.AsyncClient`` the caller owns.
+
+    upstash_vector.AsyncIndex opens a client of its own and has no way to
+    close it, so queries go to the REST API directly.
+    """
+
+    def __init__(self, url, token, http_client):
+        self.url = url
+        self.http_client = http_client
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    async def query(self, vector, top_k=10, include_metadata=False):
+        response = await self.http_client.post(
+            f"{self.url}/query",
+            headers=self.headers,
+            json={"vector": list(vector), "topK": top_k, "includeMetadata": include_metadata},
+        )
+        body = response.json()
+        if "error" in body:
+            raise UpstashError(body["error"])
+        return [
+            QueryResult(id=hit["id"], score=hit["score"], metadata=hit.get("metadata"))
+            for hit in body["result"]
+        ]
+
+
+class AsyncRAGPipeline:
+    """Embedding, vector query and completion on pooled async clients.
+
+    Each stage runs under its own deadline and raises ``TimeoutError`` when
+    it is exceeded. Cancelling the calling task (e.g. on client disconnect)
+    aborts whichever upstream call is in flight, unless identical requests
+    share it: like main.build_reply_messages, ``retrieve`` coalesces the
+    embedding and retrieval of identical questions in flight together.
+    """
+
+    def __init__(
+        self,
+        api_key,
+        vector_store="upstash",
+        upstash_token=None,
+        embed_timeout=EMBED_TIMEOUT,
+        query_timeout=QUERY_TIMEOUT,
+        completion_timeout=COMPLETION_TIMEOUT,
+        max_connections=MAX_CONNECTIONS,
+    ):
+        self.api_key = api_key
+        self.upstash_token = upstash_token
+        self.embed_timeout = embed_timeout
+        self.query_timeout = query_timeout
+        self.completion_timeout = completion_timeout
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=httpx.Timeout(completion_timeout, connect=5.0),
+        )
+        self.openai = AsyncOpenAI(api_key=api_key, http_client=self.http_client)
+        # The local store is queried in a worker thread; Upstash on the shared pool
+        self.index = None
+        if vector_store != "local":
+            self.index = AsyncUpstashIndex(UPSTASH_URL, upstash_token, self.http_client)
+        self.single_flight = AsyncSingleFlight()
+
+    async def aclose(self):
+        await self.http_client.aclose()
+
+    async def embed(self, text):
+        # The cache may touch SQLite, so keep it off the event loop
+        cache = main.get_embedding_cache()
+        cached = (await asyncio.to_thread(cache.get_many, main.MODEL, [text]))[0]
+        if cached is not None:
+            return cached
+        with stage("embed"):
+            async with asyncio.timeout(self.embed_timeout):
+                response = await self.openai.embeddings.create(
+                    model=main.MODEL, input=[text]
+                )
+        record_usage(main.MODEL, response)
+        embedding = response.data[0].embedding
+        await asyncio.to_thread(cache.put_many, main.MODEL, [text], [embedding])
+        return embedding
+
+    async def query(self, embedding, top_k=main.RETRIEVAL_CANDIDATES):
+        with stage("vector_query"):
+            async with asyncio.timeout(self.query_timeout):
+                if self.index is not None:
+                    return await self.index.query(
+                        vector=embedding, top_k=top_k, include_metadata=True
+                    )
+                return await asyncio.to_thread(
+                    main.upstash_index.query,
+                    vector=embedding,
+                    top_k=top_k,
+                    include_metadata=True,
+                )
+
+    async def coalesce(self, group, key, fn):
+        """``await fn()``, shared with any identical call in flight (see main.coalesce)."""
+        if not flask_app.config["SINGLE_FLIGHT"]:
+            return await fn()
+        result, shared = await self.single_flight.do(group, key, fn)
+        if shared:
+            COALESCED_CALLS.inc(group)
+        return result
+
+    async def search(self, embedding, user_message_text, fetch_k, limit):
+        # The BM25 lookup runs in a worker thread alongside the vector query
+        return await asyncio.gather(
+            self.query(embedding, fetch_k),
+            asyncio.to_thread(main.lexical_search, user_message_text, limit),
+        )
+
+    async def retrieve(self, user_message_text, history_messages, summary=None):
+        """Return (cached_answer, messages, answer_key).
+
+        ``cached_answer`` is set on an answer cache hit, and no completion is
+        needed; otherwise ``messages`` are ready for the completion.
+        """
+        query_text = main.retrieval_text(user_message_text, history_messages)
+        query_key = normalize_query(query_text)
+        embedding = await self.coalesce("embed", query_key, lambda: self.embed(query_text))
+        fetch_k, limit = main.retrieval_fetch_k(), main.retrieval_limit()
+        results, lexical_hits = await self.coalesce(
+            "retrieval",
+            (query_key, normalize_query(user_message_text), fetch_k, limit),
+            lambda: self.search(embedding, user_message_text, fetch_k, limit),
+        )
+        standalone = not history_messages and not summary
+        answer_key = (embedding, list(main.paper_hits(results))) if standalone else None
+        if standalone:
+            cached = main.get_answer_cache().lookup(*answer_key)
+            if cached is not None:
+                return cached[0], None, None
+        with stage("prompt"):
+            messages = main.build_chat_messages(
+                user_message_text,
+                history_messages,
+                main.knowledge_from_results(results, lexical_hits, user_message_text),
+                summary,
+            )
+        return None, messages, answer_key
+
+    async def complete(self, messages):
+        with stage("completion"):
+            async with asyncio.timeout(self.completion_timeout):
+                response = await self.openai.chat.completions.create(
+                    model=main.CHAT_MODEL, messages=messages
+                )
+        record_usage(main.CHAT_MODEL, response)
+        return response.choices[0].message.content.strip()
+
+    async def stream(self, messages):
+        """Yield completion deltas; the deadline covers the whole stream."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.completion_timeout
+        async with asyncio.timeout_at(deadline):
+            stream = await self.openai.chat.completions.create(
+                model=main.CHAT_MODEL, messages=messages, stream=True
+            )
+        try:
+            iterator = stream.__aiter__()
+            while True:
+                try:
+                    async with asyncio.timeout_at(deadline):
+                        chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+        finally:
+            await stream.close()
+
+
+def get_pipeline(app):
+    """Pipeline for the current /initialize settings, rebuilt when they change."""
+    config = flask_app.config
+    pipeline = app.get(PIPELINE_KEY)
+    if pipeline is None or (pipeline.api_key, pipeline.upstash_token) != (
+        config["OPENAI_API_KEY"],
+        config["UPSTASH_TOKEN"],
+    ):
+        if pipeline is not None:
+            asyncio.get_running_loop().create_task(pipeline.aclose())
+        pipeline = AsyncRAGPipeline(
+            config["OPENAI_API_KEY"],
+            vector_store=config["VECTOR_STORE"],
+            upstash_token=config["UPSTASH_TOKEN"],
+        )
+        app[PIPELINE_KEY] = pipeline
+    return pipeline
+
+
+# =====================================================
+# Database access (runs in worker threads)
+# =====================================================
+def _load_reply_state(bot_message_id, owner):
+    """The reply state of a bot message, leased to ``owner`` if it is pending.
+
+    ("done", html) for finished messages and for messages being generated
+    under another lease; ("pending", user_text, history, summary) otherwise.
+    """
+    with flask_app.test_request_context():
+        bot_msg_db_entry = db.session.get(HistoryMessage, bot_message_id)
+        if bot_msg_db_entry is None:
+            return None
+        if not bot_msg_db_entry.is_pending:
+            return ("done", _render_reply(bot_msg_db_entry.message))
+        if not claim(bot_message_id, owner, flask_app.config["REPLY_LEASE_SECONDS"]):
+            return ("done", main.render_pending_reply(bot_message_id))
+        if flask_app.config["OPENAI_API_KEY"] is None:
+            message = "Error: OpenAI client not initialized."
+            main._finish_bot_message(bot_msg_db_entry, message)
+            complete(bot_message_id, owner)
+            return ("done", _render_reply(message))
+        context = main.load_reply_context(bot_msg_db_entry)
+        if context is None:
+            complete(bot_message_id, owner)
+            return ("done", _render_reply(bot_msg_db_entry.message))
+        return ("pending", *context)
+
+
+def _finish_reply(bot_message_id, text, owner):
+    with flask_app.app_context():
+        bot_msg_db_entry = db.session.get(HistoryMessage, bot_message_id)
+        main._finish_bot_message(bot_msg_db_entry, text)
+        complete(bot_message_id, owner)
+
+
+def _release_reply(bot_message_id, owner):
+    with flask_app.app_context():
+        release(bot_message_id, owner)
+
+
+def _render_reply(text):
+    with flask_app.app_context():
+        return render_template("components/bot_reply_content.html", bot_message=text)
+
+
+# =====================================================
+# Routes
+# =====================================================
+async def get_bot_reply(request):
+    bot_message_id = int(request.match_info["bot_message_id"])
+    owner = new_owner()
+    state = await asyncio.to_thread(_load_reply_state, bot_message_id, owner)
+    if state is None:
+        raise web.HTTPNotFound()
+    if state[0] == "done":
+        return web.Response(text=state[1], content_type="text/html")
+
+    pipeline = get_pipeline(request.app)
+    try:
+        cached_answer, messages, answer_key = await pipeline.retrieve(*state[1:])
+    except TimeoutError:
+        # Leave the message pending so the client can retry
+        await asyncio.to_thread(_release_reply, bot_message_id, owner)
+        return web.Response(
+            status=504, text=_render_reply(TIMEOUT_MESSAGE), content_type="text/html"
+        )
+    except BaseException:
+        await asyncio.shield(asyncio.to_thread(_release_reply, bot_message_id, owner))
+        raise
+
+    if cached_answer is not None:
+        bot_reply_text = cached_answer
+        await asyncio.to_thread(_finish_reply, bot_message_id, bot_reply_text, owner)
+    else:
+        # Saved even if the client disconnects and this handler is cancelled
+        bot_reply_text = await asyncio.shield(
+            _in_background(
+                _complete_reply(pipeline, messages, answer_key, bot_message_id, owner)
+            )
+        )
+    return web.Response(text=_render_reply(bot_reply_text), content_type="text/html")
+
+
+def _in_background(coro):
+    """Run ``coro`` in a task that outlives the request handler."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _complete_reply(pipeline, messages, answer_key, bot_message_id, owner):
+    """Complete ``messages``, then save the reply."""
+    try:
+        bot_reply_text = await pipeline.complete(messages)
+    except Exception:
+        logger.exception("Completion failed for message %s", bot_message_id)
+        bot_reply_text = main.COMPLETION_ERROR_MESSAGE
+    main.remember_answer(answer_key, bot_reply_text)
+    await asyncio.to_thread(_finish_reply, bot_message_id, bot_reply_text, owner)
+    return bot_reply_text
+
+
+async def stream_bot_reply(request):
+    bot_message_id = int(request.match_info["bot_message_id"])
+    owner = new_owner()
+    state = await asyncio.to_thread(_load_reply_state, bot_message_id, owner)
+    if state is None:
+        raise web.HTTPNotFound()
+
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+    await response.prepare(request)
+
+    async def send(event, payload):
+        await response.write(main._sse_event(event, payload).encode())
+
+    if state[0] == "done":
+        await send("done", {"html": state[1]})
+        return response
+
+    pipeline = get_pipeline(request.app)
+    try:
+        cached_answer, messages, answer_key = await pipeline.retrieve(*state[1:])
+    except TimeoutError:
+        await asyncio.to_thread(_release_reply, bot_message_id, owner)
+        await send("done", {"html": _render_reply(TIMEOUT_MESSAGE)})
+        return response
+    except BaseException:
+        await asyncio.shield(asyncio.to_thread(_release_reply, bot_message_id, owner))
+        raise
+
+    if cached_answer is not None:
+        await asyncio.to_thread(_finish_reply, bot_message_id, cached_answer, owner)
+        await send("done", {"html": _render_reply(cached_answer)})
+        return response
+
+    # The completion runs in its own task so that a client disconnect, which
+    # cancels this handler, does not stop the reply from being saved
+    deltas = asyncio.Queue()
+    generation = _in_background(
+        _generate_reply(pipeline, messages, answer_key, bot_message_id, owner, deltas)
+    )
+    while (delta := await deltas.get()) is not None:
+        await send("delta", {"text": delta})
+    bot_reply_text = await asyncio.shield(generation)
+    await send("done", {"html": _render_reply(bot_reply_text)})
+    return response
+
+
+async def _generate_reply(pipeline, messages, answer_key, bot_message_id, owner, deltas):
+    """Stream a completion into ``deltas`` (None ends it), then save the reply."""
+    parts = []
+    started = time.perf_counter()
+    try:
+        async for delta in pipeline.stream(messages):
+            if not parts:
+                STAGE_SECONDS.observe(time.perf_counter() - started, "first_token")
+            parts.append(delta)
+            deltas.put_nowait(delta)
+        bot_reply_text = "".join(parts).strip()
+        STAGE_SECONDS.observe(time.perf_counter() - started, "completion")
+    except Exception:
+        STAGE_ERRORS.inc("completion")
+        logger.exception("Streamed completion failed for message %s", bot_message_id)
+        bot_reply_text = main.COMPLETION_ERROR_MESSAGE
+    finally:
+        deltas.put_nowait(None)
+
+    main.remember_answer(answer_key, bot_reply_text)
+    await asyncio.to_thread(_finish_reply, bot_message_id, bot_reply_text, owner)
+    return bot_reply_text
+
+
+async def wsgi_fallback(request):
+    """Serve every other route from the Flask app in a worker thread.
+
+    Responses without a Content-Length, such as the NDJSON stream of
+    /api/v1/batch-answer, are relayed chunk by chunk as the app yields them.
+    """
+    body = await request.read()
+    environ = EnvironBuilder(
+        path=request.path,
+        base_url=f"{request.scheme}://{request.host}",
+        query_string=request.query_string,
+        method=request.method,
+        headers=list(request.headers.items()),
+        data=body,
+    ).get_environ()
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()  # (status, headers), then body chunks, then None
+    stop = threading.Event()
+
+    def call_flask():
+        # One thread iterates the whole body: stream_with_context needs one context
+        try:
+            app_iter, status, headers = run_wsgi_app(flask_app, environ)
+            try:
+                loop.call_soon_threadsafe(chunks.put_nowait, (status, headers))
+                for chunk in app_iter:
+                    if stop.is_set():
+                        break  # Client went away; closing the iterator ends the work
+                    if chunk:
+                        loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+        finally:
+            loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+    worker = asyncio.create_task(asyncio.to_thread(call_flask))
+    try:
+        start = await chunks.get()
+        if start is None:
+            await worker  # Raises what the app raised
+        status, headers = start
+        streamed = "content-length" not in {name.lower() for name in headers.keys()}
+        if streamed:
+            response = web.StreamResponse(status=int(status.split()[0]))
+        else:
+            response = web.Response(status=int(status.split()[0]))
+        for name, value in headers.items():
+            if name.lower() not in ("content-length", "transfer-encoding"):
+                response.headers.add(name, value)
+
+        if not streamed:
+            parts = []
+            while (chunk := await chunks.get()) is not None:
+                parts.append(chunk)
+            response.body = b"".join(parts)
+            await worker
+            return response
+
+        await response.prepare(request)
+        while (chunk := await chunks.get()) is not None:
+            await response.write(chunk)
+        await worker
+        await response.write_eof()
+        return response
+    finally:
+        stop.set()
+
+
+async def _close_pipeline(app):
+    pipeline = app.get(PIPELINE_KEY)
+    if pipeline is not None:
+        await pipeline.aclose()
+
+
+@web.middleware
+async def trace_requests(request, handler):
+    """Trace id and latency for the async routes; bridged routes get Flask's."""
+    trace_id = new_trace_id(request.headers.get(TRACE_HEADER))
+    started = time.perf_counter()
+    response = await handler(request)
+    if request.match_info.handler is not wsgi_fallback:
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - started, request.match_info.handler.__name__, response.status
+        )
+        if not response.prepared:  # Streams have sent their headers already
+            response.headers[TRACE_HEADER] = trace_id
+    return response
+
+
+def create_app():
+    app = web.Application(middlewares=[trace_requests])
+    app.router.add_get("/api/v1/get-bot-reply/{bot_message_id:\\d+}", get_bot_reply)
+    app.router.add_get(
+        "/api/v1/stream-bot-reply/{bot_message_id:\\d+}", stream_bot_reply
+    )
+    app.router.add_route("*", "/{tail:.*}", wsgi_fallback)
+    app.on_cleanup.append(_close_pipeline)
+    return app
+
+
+if __name__ == "__main__":
+    # Keys from the environment; otherwise they arrive through /initialize
+    if main.clients_configured():
+        main.init_clients(lazy=True)
+        main.start_reply_workers()
+    # handler_cancellation cancels the handler task when the client disconnects
+    web.run_app(create_app(), host="0.0.0.0", port=8080, handler_cancellation=True)
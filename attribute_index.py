@@ -0,0 +1,320 @@
+import os
+import re
+import operator
+from functools import lru_cache
+
+import numpy as np
+
+# =====================================================
+# Configuration
+# =====================================================
+ATTRIBUTES_FILE = "attributes.npz"
+# Metadata keys indexed by the local store; filters may only name these
+DEFAULT_ATTRIBUTE_FIELDS = ("category", "year", "length")
+
+COMPARISONS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+TOKEN = re.compile(
+    r"""\s*(?:
+        (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+      | (?P<number>-?\d+(?:\.\d+)?)
+      | (?P<op>!=|<=|>=|=|<|>)
+      | (?P<paren>[(),])
+      | (?P<word>[A-Za-z_][A-Za-z0-9_.]*)
+    )""",
+    re.VERBOSE,
+)
+
+
+# =====================================================
+# Filter expressions
+# =====================================================
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if match is None:
+            raise ValueError(f"Cannot parse filter at {expression[position:]!r}")
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "string":
+            tokens.append(("value", re.sub(r"\\(.)", r"\1", text[1:-1])))
+        elif kind == "number":
+            tokens.append(("value", float(text)))
+        elif kind == "word" and text.upper() in ("AND", "OR", "NOT", "IN"):
+            tokens.append(("keyword", text.upper()))
+        else:
+            tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    """Recursive descent over the Upstash filter subset.
+
+    expression := conjunction (OR conjunction)*
+    conjunction := term (AND term)*
+    term := "(" expression ")" | field op value | field [NOT] IN "(" value, ... ")"
+    """
+
+    def __init__(self, expression):
+        self.tokens = _tokenize(expression)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, kind, text=None):
+        token = self.peek()
+        if token[0] != kind or (text is not None and token[1] != text):
+            raise ValueError(f"Expected {text or kind} in filter, found {token[1]!r}")
+        self.position += 1
+        return token[1]
+
+    def parse(self):
+        node = self.expression()
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unexpected {self.peek()[1]!r} in filter")
+        return node
+
+    def expression(self):
+        nodes = [self.conjunction()]
+        while self.peek() == ("keyword", "OR"):
+            self.position += 1
+            nodes.append(self.conjunction())
+        return nodes[0] if len(nodes) == 1 else ("or", tuple(nodes))
+
+    def conjunction(self):
+        nodes = [self.term()]
+        while self.peek() == ("keyword", "AND"):
+            self.position += 1
+            nodes.append(self.term())
+        return nodes[0] if len(nodes) == 1 else ("and", tuple(nodes))
+
+    def term(self):
+        if self.peek() == ("paren", "("):
+            self.position += 1
+            node = self.expression()
+            self.take("paren", ")")
+            return node
+        field = self.take("word")
+        negate = self.peek() == ("keyword", "NOT")
+        if negate:
+            self.position += 1
+        if self.peek() == ("keyword", "IN"):
+            self.position += 1
+            self.take("paren", "(")
+            values = [self.take("value")]
+            while self.peek() == ("paren", ","):
+                self.position += 1
+                values.append(self.take("value"))
+            self.take("paren", ")")
+            return ("not in" if negate else "in", field, tuple(values))
+        if negate:
+            raise ValueError("NOT is only supported as NOT IN")
+        op = self.take("op")
+        return (op, field, self.take("value"))
+
+
+@lru_cache(maxsize=256)
+def parse_filter(expression):
+    """Parse an Upstash-style metadata filter, e.g. ``category = 'cs.LG' AND year > 2020``.
+
+    Supports =, !=, <, <=, >, >=, IN, NOT IN, AND, OR and parentheses.
+    Returns a nested tuple tree; raises ValueError on syntax errors.
+    """
+    return _Parser(expression).parse()
+
+
+def filter_fields(node):
+    """Every metadata field named in a parsed filter."""
+    if node[0] in ("and", "or"):
+        return {field for child in node[1] for field in filter_fields(child)}
+    return {node[1]}
+
+
+# =====================================================
+# Attribute index
+# =====================================================
+class AttributeIndex:
+    """Columnar index of scalar metadata over the rows of a ``LocalVectorStore``.
+
+    Numeric fields are float64 columns (NaN where a row lacks the field);
+    string fields are dictionary-encoded into int32 codes (-1 where missing).
+    A filter is evaluated column by column into a boolean row bitmap, which
+    the store applies during its scan so that the top k is taken among
+    matching rows only. Rows without a field never match a condition on it.
+    """
+
+    def __init__(self, fields=DEFAULT_ATTRIBUTE_FIELDS, capacity=0):
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self._numbers = {}  # field -> float64 column
+        self._codes = {}  # field -> int32 column
+        self._values = {}  # field -> list of distinct strings, indexed by code
+        self._lookup = {}  # field -> {string: code}
+
+    # -------------------------------------------------
+    # Maintenance
+    # -------------------------------------------------
+    def resize(self, capacity):
+        grow = capacity - self.capacity
+        if grow <= 0:
+            return
+        for field, column in self._numbers.items():
+            self._numbers[field] = np.concatenate([column, np.full(grow, np.nan)])
+        for field, column in self._codes.items():
+            self._codes[field] = np.concatenate([column, np.full(grow, -1, dtype=np.int32)])
+        self.capacity = capacity
+
+    def _column(self, field, value):
+        """The column that stores ``value`` for ``field``, created on first use."""
+        if field in self._numbers:
+            return self._numbers[field] if _is_number(value) else None
+        if field in self._codes:
+            return self._codes[field] if isinstance(value, str) else None
+        if _is_number(value):
+            self._numbers[field] = np.full(self.capacity, np.nan)
+            return self._numbers[field]
+        if isinstance(value, str):
+            self._codes[field] = np.full(self.capacity, -1, dtype=np.int32)
+            self._values[field] = []
+            self._lookup[field] = {}
+            return self._codes[field]
+        return None
+
+    def _code(self, field, value):
+        code = self._lookup[field].get(value)
+        if code is None:
+            code = self._lookup[field][value] = len(self._values[field])
+            self._values[field].append(value)
+        return code
+
+    def set(self, rows, metadatas):
+        """Index the attributes of ``metadatas``; each replaces its row's old values."""
+        self.clear(rows)
+        for row, metadata in zip(rows, metadatas):
+            for field in self.fields:
+                value = (metadata or {}).get(field)
+                column = None if value is None else self._column(field, value)
+                if column is None:
+                    continue
+                if field in self._numbers:
+                    column[row] = value
+                else:
+                    column[row] = self._code(field, value)
+
+    def clear(self, rows):
+        for column in self._numbers.values():
+            column[rows] = np.nan
+        for column in self._codes.values():
+            column[rows] = -1
+
+    # -------------------------------------------------
+    # Filtering
+    # -------------------------------------------------
+    def mask(self, expression):
+        """Boolean bitmap over all ``capacity`` rows of those matching ``expression``."""
+        node = parse_filter(expression)
+        unknown = filter_fields(node) - set(self.fields)
+        if unknown:
+            raise ValueError(
+                f"Cannot filter on {', '.join(sorted(unknown))}: "
+                f"indexed fields are {', '.join(self.fields)}"
+            )
+        return self._evaluate(node)
+
+    def _evaluate(self, node):
+        kind = node[0]
+        if kind in ("and", "or"):
+            combine = np.logical_and if kind == "and" else np.logical_or
+            result = self._evaluate(node[1][0])
+            for child in node[1][1:]:
+                result = combine(result, self._evaluate(child))
+            return result
+        _, field, value = node
+        if field in self._numbers:
+            return self._compare_numbers(kind, self._numbers[field], value)
+        if field in self._codes:
+            return self._compare_strings(kind, field, value)
+        # Indexed but never seen: no row has the field
+        return np.zeros(self.capacity, dtype=bool)
+
+    @staticmethod
+    def _compare_numbers(kind, column, value):
+        values = value if kind in ("in", "not in") else (value,)
+        if not all(_is_number(v) for v in values):
+            raise ValueError(f"Cannot compare a numeric field with {value!r}")
+        present = ~np.isnan(column)
+        if kind == "in":
+            return np.isin(column, values)
+        if kind == "not in":
+            return present & ~np.isin(column, values)
+        return present & COMPARISONS[kind](column, value)
+
+    def _compare_strings(self, kind, field, value):
+        values = value if kind in ("in", "not in") else (value,)
+        if not all(isinstance(v, str) for v in values):
+            raise ValueError(f"Cannot compare string field {field} with {value!r}")
+        # Decide per distinct string, then expand to rows; code -1 reads the final False
+        dictionary = np.array(self._values[field], dtype=str)
+        if kind in ("in", "not in"):
+            matches = np.isin(dictionary, values)
+            if kind == "not in":
+                matches = ~matches
+        else:
+            matches = COMPARISONS[kind](dictionary, value)
+        return np.append(matches, False)[self._codes[field]]
+
+    # -------------------------------------------------
+    # Persistence
+    # -------------------------------------------------
+    def save(self, path):
+        arrays = {"fields": np.array(self.fields, dtype=str)}
+        arrays.update({f"number:{field}": column for field, column in self._numbers.items()})
+        for field, column in self._codes.items():
+            arrays[f"codes:{field}"] = column
+            arrays[f"values:{field}"] = np.array(self._values[field], dtype=str)
+        target = os.path.join(path, ATTRIBUTES_FILE)
+        # Write then rename so a crash never leaves a truncated index behind
+        with open(target + ".tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(target + ".tmp", target)
+
+    @classmethod
+    def load(cls, path, fields=DEFAULT_ATTRIBUTE_FIELDS, capacity=0):
+        """The saved index, or None if there is none for exactly these ``fields``."""
+        target = os.path.join(path, ATTRIBUTES_FILE)
+        if not os.path.exists(target):
+            return None
+        index = cls(fields, capacity)
+        with np.load(target, allow_pickle=False) as arrays:
+            if tuple(arrays["fields"].tolist()) != index.fields:
+                return None
+            for name in arrays.files:
+                if name == "fields":
+                    continue
+                kind, field = name.split(":", 1)
+                if kind == "number":
+                    index._numbers[field] = arrays[name]
+                elif kind == "codes":
+                    index._codes[field] = arrays[name].astype(np.int32)
+                else:
+                    index._values[field] = arrays[name].tolist()
+                    index._lookup[field] = {v: i for i, v in enumerate(index._values[field])}
+        columns = list(index._numbers.values()) + list(index._codes.values())
+        if any(len(column) != capacity for column in columns):
+            return None
+        return index
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
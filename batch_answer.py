@@ -0,0 +1,89 @@
+"""Answer a file of questions through the RAG pipeline, without the web server.
+
+    uv run batch_answer.py questions.txt --output answers.jsonl
+
+The input holds one question per line, or JSON lines with a "question"
+field. Questions are embedded and retrieved in large batches and answered
+with bounded concurrency; each answer is written as one JSON line (see
+main.answer_questions) as soon as it is ready, so the output is in
+completion order. Needs OPENAI_API_KEY, plus UPSTASH_TOKEN unless
+VECTOR_STORE=local.
+"""
+import argparse
+import json
+import sys
+import time
+
+from tqdm import tqdm
+
+
+def read_questions(lines):
+    questions = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("{"):
+            line = json.loads(line)["question"]
+        questions.append(line)
+    return questions
+
+
+def parse_args(argv=None):
+    # main.py is imported after parsing, so --help does not load the app
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("questions", help="Text or JSONL file of questions; - for stdin.")
+    parser.add_argument(
+        "--output", default="-", help="JSONL file to write; stdout by default."
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="Completions in flight at once (default 8).",
+    )
+    parser.add_argument(
+        "--filter",
+        default="",
+        help="Metadata filter for retrieval, e.g. \"category = 'cs.LG' AND year > 2020\".",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    import main as app_module
+
+    if not app_module.clients_configured():
+        sys.exit("Set OPENAI_API_KEY (and UPSTASH_TOKEN unless VECTOR_STORE=local)")
+    app_module.init_clients()
+    if args.questions == "-":
+        questions = read_questions(sys.stdin)
+    else:
+        with open(args.questions, encoding="utf-8") as f:
+            questions = read_questions(f)
+    concurrency = args.concurrency or app_module.DEFAULT_BATCH_CONCURRENCY
+
+    started = time.perf_counter()
+    failed = 0
+    output = open(args.output, "w", encoding="utf-8") if args.output != "-" else sys.stdout
+    try:
+        results = app_module.answer_questions(questions, concurrency, args.filter)
+        for result in tqdm(results, total=len(questions), unit="q", file=sys.stderr):
+            failed += result["error"] is not None
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - started
+    print(
+        f"{len(questions)} questions in {elapsed:.1f}s "
+        f"({len(questions) / elapsed if elapsed else 0:.1f}/s), {failed} failed",
+        file=sys.stderr,
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""Recall@k and latency of the IVF index against exact search.
+
+Run against an ingested local store:
+
+    python -m benchmarks.ann --store instance/vector_store
+
+or against synthetic clustered data:
+
+    python -m benchmarks.ann --synthetic 100000 --dim 1536
+"""
+import argparse
+import json
+import tempfile
+import time
+
+import numpy as np
+
+from ann_index import IVFIndex
+from vector_store import LocalVectorStore
+
+
+def synthetic_store(path, n_vectors, dim, n_clusters=256, seed=0):
+    # Clustered data resembles real embeddings far better than uniform noise
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    store = LocalVectorStore(path)
+    for start in range(0, n_vectors, 10_000):
+        count = min(10_000, n_vectors - start)
+        labels = rng.integers(n_clusters, size=count)
+        vectors = centers[labels] + 0.6 * rng.normal(size=(count, dim)).astype(np.float32)
+        store.upsert([(f"doc_{start + i}", vectors[i], None) for i in range(count)])
+    return store
+
+
+def sample_queries(store, n_queries, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(np.flatnonzero(store._live), n_queries, replace=False)
+    noise = 0.05 * rng.normal(size=(n_queries, store.dim)).astype(np.float32)
+    return np.asarray(store._matrix[np.sort(rows)]) + noise
+
+
+def timed_ids(store, queries, top_k, **kwargs):
+    latencies = []
+    ids = []
+    for q in queries:
+        started = time.perf_counter()
+        results = store.query(vector=q, top_k=top_k, **kwargs)
+        latencies.append((time.perf_counter() - started) * 1000)
+        ids.append([r.id for r in results])
+    return ids, np.array(latencies)
+
+
+def run(store, nprobes, n_queries, top_k, n_lists=None):
+    queries = sample_queries(store, n_queries)
+    exact_ids, exact_ms = timed_ids(store, queries, top_k, exact=True)
+
+    # Trained in memory only: --store may be a live index with its own IVF lists
+    started = time.perf_counter()
+    ann = store.ann = IVFIndex.train(
+        store._matrix, np.flatnonzero(store._live), n_lists=n_lists, capacity=store.capacity
+    )
+    build_s = time.perf_counter() - started
+
+    rows = [
+        {
+            "mode": "exact",
+            "nprobe": None,
+            f"recall@{top_k}": 1.0,
+            "p50_ms": float(np.percentile(exact_ms, 50)),
+            "p95_ms": float(np.percentile(exact_ms, 95)),
+        }
+    ]
+    for nprobe in nprobes:
+        ann_ids, ann_ms = timed_ids(store, queries, top_k, nprobe=nprobe)
+        recall = np.mean(
+            [len(set(a) & set(e)) / len(e) for a, e in zip(ann_ids, exact_ids)]
+        )
+        rows.append(
+            {
+                "mode": "ivf",
+                "nprobe": nprobe,
+                f"recall@{top_k}": float(recall),
+                "p50_ms": float(np.percentile(ann_ms, 50)),
+                "p95_ms": float(np.percentile(ann_ms, 95)),
+            }
+        )
+    return {
+        "vectors": len(store),
+        "dim": store.dim,
+        "n_lists": ann.n_lists,
+        "build_seconds": build_s,
+        "results": rows,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--store", help="Path of an existing local vector store.")
+    parser.add_argument("--synthetic", type=int, default=50_000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--lists", type=int, default=None)
+    parser.add_argument(
+        "--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64]
+    )
+    parser.add_argument("--output", help="Write results as JSON to this file.")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.store:
+            store = LocalVectorStore(args.store)
+        else:
+            store = synthetic_store(tmp, args.synthetic, args.dim)
+        report = run(store, args.nprobe, args.queries, args.top_k, args.lists)
+        store.close()
+
+    print(
+        f"{report['vectors']} vectors x {report['dim']} dims, "
+        f"{report['n_lists']} lists, built in {report['build_seconds']:.1f}s"
+    )
+    recall_key = f"recall@{args.top_k}"
+    print(f"{'mode':<6} {'nprobe':>6} {recall_key:>10} {'p50 ms':>8} {'p95 ms':>8}")
+    for row in report["results"]:
+        print(
+            f"{row['mode']:<6} {row['nprobe'] or '-':>6} {row[recall_key]:>10.3f} "
+            f"{row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
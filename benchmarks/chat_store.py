@@ -0,0 +1,129 @@
+"""Sustained send-message throughput of the SQLite chat store under concurrent clients.
+
+Compares the rollback journal with synchronous=FULL (the SQLite defaults)
+against WAL with synchronous=NORMAL:
+
+    python -m benchmarks.chat_store --clients 16 --messages 200
+
+Each configuration runs in a fresh process against a fresh database file.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+MODES = {
+    "rollback": {"SQLITE_JOURNAL_MODE": "DELETE", "SQLITE_SYNCHRONOUS": "FULL"},
+    "wal": {"SQLITE_JOURNAL_MODE": "WAL", "SQLITE_SYNCHRONOUS": "NORMAL"},
+}
+
+
+def run(clients, messages_per_client):
+    """Post messages from ``clients`` threads; main.py reads its config from the env."""
+    import main
+    from models import History
+
+    with main.app.app_context():
+        sessions = [History(title=f"Bench {i}") for i in range(clients)]
+        main.db.session.add_all(sessions)
+        main.db.session.commit()
+        session_ids = [session.id for session in sessions]
+
+    latencies = [[] for _ in range(clients)]
+    errors = [0] * clients
+    start_barrier = threading.Barrier(clients + 1)
+
+    def client_loop(i):
+        client = main.app.test_client()
+        start_barrier.wait()
+        for n in range(messages_per_client):
+            started = time.perf_counter()
+            response = client.post(
+                "/api/v1/send-message",
+                data={"message": f"Question {n}", "session_id": session_ids[i]},
+            )
+            latencies[i].append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                errors[i] += 1
+
+    threads = [threading.Thread(target=client_loop, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    all_ms = np.concatenate([np.array(l) for l in latencies])
+    total = clients * messages_per_client
+    return {
+        "clients": clients,
+        "messages": total,
+        "errors": sum(errors),
+        "seconds": elapsed,
+        "messages_per_second": total / elapsed,
+        "p50_ms": float(np.percentile(all_ms, 50)),
+        "p95_ms": float(np.percentile(all_ms, 95)),
+        "p99_ms": float(np.percentile(all_ms, 99)),
+    }
+
+
+def run_mode(mode, clients, messages_per_client):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+            **MODES[mode],
+        )
+        output = subprocess.run(
+            [
+                sys.executable, "-m", "benchmarks.chat_store", "--child",
+                "--clients", str(clients), "--messages", str(messages_per_client),
+            ],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+    report = json.loads(output.strip().splitlines()[-1])
+    report["mode"] = mode
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument(
+        "--messages", type=int, default=200, help="Messages sent by each client."
+    )
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help="Write results as JSON to this file.")
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run(args.clients, args.messages)))
+        return
+
+    reports = [run_mode(mode, args.clients, args.messages) for mode in args.modes]
+    print(f"{args.clients} clients x {args.messages} messages")
+    print(f"{'mode':<9} {'msg/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for row in reports:
+        print(
+            f"{row['mode']:<9} {row['messages_per_second']:>8.1f} {row['p50_ms']:>8.2f} "
+            f"{row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['errors']:>7}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Memory footprint, recall@k and latency of each local store storage kind.
+
+    python -m benchmarks.compression --store instance/vector_store
+    python -m benchmarks.compression --synthetic 50000 --dim 1536
+
+Each storage kind re-encodes the store, so --store is copied to a temporary
+directory first and left untouched; the copy needs as much free disk space.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from benchmarks.ann import synthetic_store, sample_queries, timed_ids
+from quantization import STORAGE_KINDS
+from vector_store import LocalVectorStore, LOCK_FILE
+
+
+def run(store, queries, top_k, reranks):
+    exact_ids, exact_ms = timed_ids(store, queries, top_k, exact=True)
+    rows = []
+    for storage in STORAGE_KINDS:
+        store.compress(storage)
+        for rerank in reranks if storage != "float32" else [0]:
+            store.rerank = rerank
+            ids, ms = timed_ids(store, queries, top_k, exact=True)
+            recall = np.mean([len(set(a) & set(e)) / len(e) for a, e in zip(ids, exact_ids)])
+            rows.append(
+                {
+                    "storage": storage,
+                    "rerank": rerank,
+                    "bytes_per_vector": store.memory_footprint() / store.capacity,
+                    f"recall@{top_k}": float(recall),
+                    "p50_ms": float(np.percentile(ms, 50)),
+                    "p95_ms": float(np.percentile(ms, 95)),
+                }
+            )
+    return {"vectors": len(store), "dim": store.dim, "results": rows}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--store", help="Path of an existing local vector store.")
+    parser.add_argument("--synthetic", type=int, default=50_000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--rerank", type=int, nargs="+", default=[0, 50, 200])
+    parser.add_argument("--output", help="Write results as JSON to this file.")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.store:
+            copy = os.path.join(tmp, "store")
+            shutil.copytree(args.store, copy, ignore=shutil.ignore_patterns(LOCK_FILE))
+            store = LocalVectorStore(copy)
+        else:
+            store = synthetic_store(tmp, args.synthetic, args.dim)
+        queries = sample_queries(store, args.queries)
+        report = run(store, queries, args.top_k, args.rerank)
+        store.close()
+
+    recall_key = f"recall@{args.top_k}"
+    print(f"{report['vectors']} vectors x {report['dim']} dims")
+    print(f"{'storage':<8} {'rerank':>6} {'B/vec':>8} {recall_key:>10} {'p50 ms':>8} {'p95 ms':>8}")
+    for row in report["results"]:
+        print(
+            f"{row['storage']:<8} {row['rerank']:>6} {row['bytes_per_vector']:>8.0f} "
+            f"{row[recall_key]:>10.3f} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
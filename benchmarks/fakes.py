@@ -0,0 +1,213 @@
+"""Deterministic local stand-ins for the OpenAI API and the arXiv dataset.
+
+``FakeOpenAIServer`` answers ``/v1/embeddings`` and ``/v1/chat/completions``
+over HTTP, so the real OpenAI client (pointed at it with OPENAI_BASE_URL)
+and its connection handling are part of what is measured. ``WordEncoding``
+counts tokens without the tiktoken download, so benchmarks run offline.
+"""
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+EMBEDDING_DIM = 1536  # text-embedding-3-small
+COMPLETION_TEXT = "This is a benchmark answer drawn from the retrieved abstracts."
+
+WORDS = (
+    "attention transformer graph neural network convolution dataset benchmark "
+    "quantum entanglement galaxy cluster redshift spectral manifold optimization "
+    "gradient descent stochastic bayesian inference variational posterior kernel "
+    "regression lattice gauge theory boson fermion topology entropy diffusion "
+    "reinforcement policy reward simulation turbulence plasma magnetic field"
+).split()
+
+
+def fake_embedding(text, dim=EMBEDDING_DIM):
+    """Unit vector seeded by the text, so equal texts embed identically."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class FakeOpenAIServer:
+    """Threaded HTTP server with ``latency_ms`` +/- ``jitter_ms`` per call.
+
+    Jitter is drawn from a seeded generator, so a run with the same request
+    order sees the same delays.
+    """
+
+    def __init__(
+        self,
+        embed_latency_ms=50.0,
+        completion_latency_ms=500.0,
+        jitter_ms=10.0,
+        dim=EMBEDDING_DIM,
+        seed=0,
+    ):
+        self.embed_latency_ms = embed_latency_ms
+        self.completion_latency_ms = completion_latency_ms
+        self.jitter_ms = jitter_ms
+        self.dim = dim
+        self.calls = {"embeddings": 0, "chat": 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _delay(self, kind, latency_ms):
+        with self._lock:
+            self.calls[kind] += 1
+            jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms)
+        time.sleep(max(0.0, latency_ms + jitter) / 1000.0)
+
+    def embeddings(self, body):
+        inputs = body["input"]
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        self._delay("embeddings", self.embed_latency_ms)
+        data = []
+        for i, text in enumerate(inputs):
+            vector = fake_embedding(text, self.dim)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(text.split()) for text in inputs)
+        return {
+            "object": "list",
+            "data": data,
+            "model": body["model"],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def chat(self, body):
+        self._delay("chat", self.completion_latency_ms)
+        prompt_tokens = sum(len(m["content"].split()) for m in body["messages"])
+        completion_tokens = len(COMPLETION_TEXT.split())
+        return {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": COMPLETION_TEXT},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _handler_class(self):
+        fake = self
+        routes = {"/v1/embeddings": fake.embeddings, "/v1/chat/completions": fake.chat}
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, like the real API
+
+            def do_POST(self):
+                route = routes.get(self.path)
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if route is None:
+                    self.send_error(404)
+                    return
+                payload = json.dumps(route(body)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+# =====================================================
+# Tokenizer
+# =====================================================
+class WordEncoding:
+    """One token per word, in place of a tiktoken encoding (fetched on first use)."""
+
+    def encode(self, text):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+def install_word_encoding(*modules):
+    """Preset the lazily loaded ``_encoding`` of each module (vectorizer, prompt_builder)."""
+    for module in modules:
+        module._encoding = WordEncoding()
+
+
+# =====================================================
+# Synthetic dataset
+# =====================================================
+class _Split:
+    def __init__(self, num_examples):
+        self.num_examples = num_examples
+
+
+class _Info:
+    def __init__(self, split, num_examples):
+        self.splits = {split: _Split(num_examples)}
+
+
+class SyntheticDataset:
+    """Streams ``n`` papers shaped like the "section" config of ccdv/arxiv-summarization."""
+
+    def __init__(self, n, split="train", sections=6, seed=0):
+        self.n = n
+        self.split = split
+        self.sections = sections
+        self.seed = seed
+        self.info = _Info(split, n)
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        for _ in range(self.n):
+            abstract = " ".join(rng.choices(WORDS, k=150))
+            article = "\n".join(
+                " ".join(rng.choices(WORDS, k=400)) for _ in range(self.sections)
+            )
+            yield {"abstract": abstract, "article": article}
+
+
+def questions(n, seed=1):
+    """``n`` distinct questions over the synthetic vocabulary."""
+    rng = random.Random(seed)
+    return [f"Question {i}: what is known about {' '.join(rng.choices(WORDS, k=6))}?" for i in range(n)]
@@ -0,0 +1,290 @@
+"""End-to-end RAG benchmark against local stand-ins for OpenAI and the dataset.
+
+Ingests synthetic papers with vectorizer.main() into the local vector store,
+then drives send-message + get-bot-reply from concurrent clients:
+
+    python -m benchmarks.rag --papers 2000 --clients 8 --turns 20 --output run.json
+
+A fake OpenAI server (deterministic embeddings and answers, configurable
+latency and jitter) runs in this process; each phase runs in a fresh child
+process so its peak RSS is its own. Tokens are counted as words, so nothing
+is downloaded. Compare two runs with --compare.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.fakes import (
+    FakeOpenAIServer,
+    SyntheticDataset,
+    install_word_encoding,
+    questions,
+)
+
+
+def latency_summary(latencies_ms):
+    values = np.asarray(latencies_ms, dtype=np.float64)
+    if not len(values):
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "mean_ms": None}
+    return {
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "mean_ms": float(values.mean()),
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+
+
+# =====================================================
+# Phases (run in child processes)
+# =====================================================
+def run_ingest(workdir, papers, workers, chunk_articles):
+    import prompt_builder
+    import vectorizer
+    from vector_store import LocalVectorStore
+
+    install_word_encoding(vectorizer, prompt_builder)
+    # The synthetic stream replaces the Hugging Face download
+    vectorizer.load_dataset = lambda *args, **kwargs: SyntheticDataset(papers)
+    argv = [
+        "--vector-store", "local",
+        "--local-store-path", os.path.join(workdir, "vector_store"),
+        "--checkpoint", os.path.join(workdir, "checkpoint.db"),
+        "--embedding-cache", os.path.join(workdir, "embedding_cache.db"),
+        "--lexical-index", os.path.join(workdir, "lexical_index"),
+        "--workers", str(workers),
+        "--requests-per-second", "1000",
+    ]
+    if chunk_articles:
+        argv.append("--chunk-articles")
+
+    started = time.perf_counter()
+    vectorizer.main(argv)
+    elapsed = time.perf_counter() - started
+    vectors = len(LocalVectorStore(os.path.join(workdir, "vector_store")))
+    return {
+        "papers": papers,
+        "vectors": vectors,
+        "seconds": elapsed,
+        "vectors_per_second": vectors / elapsed,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_chat(workdir, clients, turns):
+    """Each client holds one session and sends ``turns`` messages, waiting for each reply."""
+    import main
+    import prompt_builder
+    from models import History
+
+    install_word_encoding(prompt_builder)
+    main.app.config["EMBEDDING_CACHE_PATH"] = os.path.join(workdir, "embedding_cache.db")
+    main.app.test_client().post(
+        "/initialize", data={"openai_api_key": "benchmark", "upstash_token": ""}
+    )
+    with main.app.app_context():
+        sessions = [History(title=f"Bench {i}") for i in range(clients)]
+        main.db.session.add_all(sessions)
+        main.db.session.commit()
+        session_ids = [session.id for session in sessions]
+
+    all_questions = questions(clients * turns)
+    send_ms, reply_ms, turn_ms = [], [], []
+    errors = [0] * clients
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(clients + 1)
+
+    def client_loop(i):
+        client = main.app.test_client()
+        start_barrier.wait()
+        for n in range(turns):
+            started = time.perf_counter()
+            response = client.post(
+                "/api/v1/send-message",
+                data={"message": all_questions[i * turns + n], "session_id": session_ids[i]},
+            )
+            sent = time.perf_counter()
+            bot_message_id = response.data.decode().split("bot-message-")[1].split('"')[0]
+            reply = client.get(f"/api/v1/get-bot-reply/{bot_message_id}")
+            done = time.perf_counter()
+            failed = response.status_code != 200 or reply.status_code != 200 or (
+                main.COMPLETION_ERROR_MESSAGE.encode() in reply.data
+            )
+            with lock:
+                send_ms.append((sent - started) * 1000)
+                reply_ms.append((done - sent) * 1000)
+                turn_ms.append((done - started) * 1000)
+                errors[i] += failed
+
+    threads = [threading.Thread(target=client_loop, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    total = clients * turns
+    return {
+        "clients": clients,
+        "turns": total,
+        "errors": sum(errors),
+        "seconds": elapsed,
+        "turns_per_second": total / elapsed,
+        "turn": latency_summary(turn_ms),
+        "send_message": latency_summary(send_ms),
+        "get_bot_reply": latency_summary(reply_ms),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_child(phase, workdir, server, args):
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="benchmark",
+        OPENAI_BASE_URL=server.base_url,
+        VECTOR_STORE="local",
+        LOCAL_VECTOR_STORE_PATH=os.path.join(workdir, "vector_store"),
+        LEXICAL_INDEX_PATH=os.path.join(workdir, "lexical_index"),
+        INDEX_GENERATION_PATH=os.path.join(workdir, "index_generation"),
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'chat.db')}",
+    )
+    command = [
+        sys.executable, "-m", "benchmarks.rag", "--child", phase, "--workdir", workdir,
+        "--papers", str(args.papers), "--ingest-workers", str(args.ingest_workers),
+        "--clients", str(args.clients), "--turns", str(args.turns),
+    ]
+    if args.chunk_articles:
+        command.append("--chunk-articles")
+    output = subprocess.run(
+        command, env=env, check=True, stdout=subprocess.PIPE, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report):
+    ingest, chat = report.get("ingest"), report.get("chat")
+    if ingest:
+        print(
+            f"ingest: {ingest['vectors']} vectors in {ingest['seconds']:.1f}s "
+            f"({ingest['vectors_per_second']:.1f}/s), peak RSS {ingest['peak_rss_mb']:.0f} MiB"
+        )
+    if chat:
+        print(
+            f"chat:   {chat['turns']} turns from {chat['clients']} clients, "
+            f"{chat['turns_per_second']:.2f} turns/s, {chat['errors']} errors, "
+            f"peak RSS {chat['peak_rss_mb']:.0f} MiB"
+        )
+        print(f"{'':<15} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for name in ("turn", "send_message", "get_bot_reply"):
+            row = chat[name]
+            print(f"{name:<15} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+
+
+def compare(baseline_path, current_path):
+    """Print the relative change of each headline number between two JSON reports."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+    rows = [
+        ("ingest", ("vectors_per_second",)),
+        ("ingest", ("peak_rss_mb",)),
+        ("chat", ("turns_per_second",)),
+        ("chat", ("peak_rss_mb",)),
+        ("chat", ("turn", "p50_ms")),
+        ("chat", ("turn", "p95_ms")),
+        ("chat", ("turn", "p99_ms")),
+    ]
+    print(f"{baseline.get('commit')} -> {current.get('commit')}")
+    for phase, path in rows:
+        old, new = baseline.get(phase), current.get(phase)
+        if not old or not new:
+            continue
+        for key in path:
+            old, new = old[key], new[key]
+        change = (new - old) / old * 100 if old else float("nan")
+        print(f"{phase + '.' + '.'.join(path):<28} {old:>10.2f} {new:>10.2f} {change:>+8.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--papers", type=int, default=2000)
+    parser.add_argument("--ingest-workers", type=int, default=4)
+    parser.add_argument(
+        "--chunk-articles", action="store_true", help="Also ingest article chunks."
+    )
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument(
+        "--turns", type=int, default=20, help="Messages sent by each client."
+    )
+    parser.add_argument("--embed-latency-ms", type=float, default=50.0)
+    parser.add_argument("--completion-latency-ms", type=float, default=300.0)
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--dim", type=int, default=1536, help="Fake embedding size.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results as JSON to this file.")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASELINE", "CURRENT"),
+        help="Compare two JSON reports instead of running.",
+    )
+    parser.add_argument("--child", choices=["ingest", "chat"], help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.child == "ingest":
+        print(json.dumps(run_ingest(args.workdir, args.papers, args.ingest_workers, args.chunk_articles)))
+        return
+    if args.child == "chat":
+        print(json.dumps(run_chat(args.workdir, args.clients, args.turns)))
+        return
+
+    server = FakeOpenAIServer(
+        embed_latency_ms=args.embed_latency_ms,
+        completion_latency_ms=args.completion_latency_ms,
+        jitter_ms=args.jitter_ms,
+        dim=args.dim,
+        seed=args.seed,
+    )
+    report = {"commit": git_commit(), "config": vars(args)}
+    with server, tempfile.TemporaryDirectory() as workdir:
+        report["ingest"] = run_child("ingest", workdir, server, args)
+        report["chat"] = run_child("chat", workdir, server, args)
+        report["upstream_calls"] = dict(server.calls)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Time from process start to the first response of the production server.
+
+Starts ``serve.py`` with one worker, polls ``/`` until it answers, then
+stops it. The first boot runs against a fresh database and template cache;
+later boots reuse them, as a restarted machine would:
+
+    python -m benchmarks.startup --runs 5
+
+Also reports how long ``import main`` takes on its own.
+"""
+import argparse
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+TARGET_MS = 300.0
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_env(workdir, port):
+    return dict(
+        os.environ,
+        HOST="127.0.0.1",
+        PORT=str(port),
+        WEB_CONCURRENCY="1",
+        OPENAI_API_KEY="benchmark",
+        VECTOR_STORE="local",
+        LOCAL_VECTOR_STORE_PATH=os.path.join(workdir, "vector_store"),
+        LEXICAL_INDEX_PATH=os.path.join(workdir, "lexical_index"),
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'chat.db')}",
+        JINJA_CACHE_PATH=os.path.join(workdir, "jinja_cache"),
+    )
+
+
+def time_to_first_response(workdir, timeout=30.0):
+    """Milliseconds from spawning serve.py to a 200 from ``/``."""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "serve.py"],
+        cwd=REPO_ROOT,
+        env=server_env(workdir, port),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(url, timeout=timeout) as response:
+                    if response.status == 200:
+                        return (time.perf_counter() - started) * 1000
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+        raise TimeoutError(f"serve.py did not answer within {timeout}s")
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+def import_ms(workdir):
+    """Milliseconds to import main.py in a fresh interpreter."""
+    code = "import time; t = time.perf_counter(); import main; print((time.perf_counter() - t) * 1000)"
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=REPO_ROOT,
+        env=server_env(workdir, 0),
+        check=True,
+        stdout=subprocess.PIPE,
+        text=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="Boots after the first.")
+    parser.add_argument("--target-ms", type=float, default=TARGET_MS)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        first = time_to_first_response(workdir)
+        boots = [time_to_first_response(workdir) for _ in range(args.runs)]
+        imports = [import_ms(workdir) for _ in range(args.runs)]
+
+    median = statistics.median(boots)
+    print(f"first boot (fresh database):  {first:8.1f} ms")
+    print(f"restart, median of {args.runs}:       {median:8.1f} ms  (min {min(boots):.1f}, max {max(boots):.1f})")
+    print(f"import main, median:          {statistics.median(imports):8.1f} ms")
+    verdict = "within" if median <= args.target_ms else "over"
+    print(f"restart is {verdict} the {args.target_ms:.0f} ms target")
+
+
+if __name__ == "__main__":
+    main()
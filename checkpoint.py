@@ -0,0 +1,124 @@
+import sqlite3
+import time
+
+# =====================================================
+# Checkpoint journal for vectorizer.py
+# =====================================================
+STATUS_EMBEDDED = "embedded"
+STATUS_UPSERTED = "upserted"
+STATUS_FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    error_class TEXT,
+    error_message TEXT,
+    failures INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_records_status ON records (status);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class CheckpointJournal:
+    """Durable record of which vector ids were embedded, upserted or failed.
+
+    Backed by a local SQLite file in WAL mode so several vectorizer processes
+    (one per shard) can share the same journal. A journal belongs to the
+    ``target`` index it was first opened for; its records say nothing about
+    any other index, so opening it for another target raises ValueError.
+    """
+
+    def __init__(self, path, target=None):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        if target is not None:
+            self._bind(target)
+        self.conn.commit()
+
+    def _bind(self, target):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO settings (key, value) VALUES ('target', ?)", (target,)
+            )
+            (bound,) = self.conn.execute(
+                "SELECT value FROM settings WHERE key = 'target'"
+            ).fetchone()
+        if bound != target:
+            self.conn.close()
+            raise ValueError(
+                f"{self.path} journals ingestion into {bound}, not {target}; "
+                "pass another --checkpoint"
+            )
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _mark(self, ids, status, error=None):
+        error_class = type(error).__name__ if error is not None else None
+        error_message = str(error)[:500] if error is not None else None
+        failures = 1 if status == STATUS_FAILED else 0
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                """
+                INSERT INTO records (id, status, error_class, error_message, failures, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    status = excluded.status,
+                    error_class = excluded.error_class,
+                    error_message = excluded.error_message,
+                    failures = records.failures + excluded.failures,
+                    updated_at = excluded.updated_at
+                """,
+                [(i, status, error_class, error_message, failures, now) for i in ids],
+            )
+
+    def mark_embedded(self, ids):
+        self._mark(ids, STATUS_EMBEDDED)
+
+    def mark_upserted(self, ids):
+        self._mark(ids, STATUS_UPSERTED)
+
+    def mark_failed(self, ids, error):
+        self._mark(ids, STATUS_FAILED, error)
+
+    def forget(self, ids):
+        """Drop ``ids``, e.g. once their vectors are deleted from the index."""
+        with self.conn:
+            self.conn.executemany("DELETE FROM records WHERE id = ?", [(i,) for i in ids])
+
+    def ids_with_status(self, status):
+        rows = self.conn.execute("SELECT id FROM records WHERE status = ?", (status,))
+        return {row[0] for row in rows}
+
+    def completed_ids(self):
+        return self.ids_with_status(STATUS_UPSERTED)
+
+    def failed_ids(self):
+        return self.ids_with_status(STATUS_FAILED)
+
+    def failures(self):
+        return self.conn.execute(
+            "SELECT id, error_class, error_message, failures FROM records "
+            "WHERE status = ? ORDER BY id",
+            (STATUS_FAILED,),
+        ).fetchall()
+
+    def counts(self):
+        rows = self.conn.execute("SELECT status, COUNT(*) FROM records GROUP BY status")
+        return dict(rows.fetchall())
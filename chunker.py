@@ -0,0 +1,48 @@
+# =====================================================
+# Configuration
+# =====================================================
+DEFAULT_CHUNK_TOKENS = 512
+DEFAULT_CHUNK_OVERLAP = 64
+
+
+def split_sections(article):
+    """Sections of an article from the "section" dataset config, one per line."""
+    return [section.strip() for section in article.split("\n") if section.strip()]
+
+
+def chunk_article(
+    article,
+    encoding,
+    max_tokens=DEFAULT_CHUNK_TOKENS,
+    overlap=DEFAULT_CHUNK_OVERLAP,
+):
+    """Yield chunks of at most ``max_tokens`` tokens from ``article``.
+
+    Whole sections are packed into a chunk while they fit, so chunk
+    boundaries fall between sections where possible. A section longer than
+    ``max_tokens`` is cut at token boundaries. Each chunk starts with the
+    last ``overlap`` tokens of the previous one.
+    """
+    if not 0 <= overlap < max_tokens:
+        raise ValueError("overlap must be smaller than max_tokens")
+    window = []
+    fresh = 0  # Tokens in the window that no emitted chunk contains yet
+
+    for section in split_sections(article):
+        tokens = encoding.encode(section + "\n")
+        if fresh and len(window) + len(tokens) > max_tokens:
+            yield encoding.decode(window)
+            window = window[-overlap:] if overlap else []
+            fresh = 0
+        while len(window) + len(tokens) > max_tokens:
+            take = max_tokens - len(window)
+            window += tokens[:take]
+            tokens = tokens[take:]
+            yield encoding.decode(window)
+            window = window[-overlap:] if overlap else []
+            fresh = 0
+        window += tokens
+        fresh += len(tokens)
+
+    if fresh:
+        yield encoding.decode(window)
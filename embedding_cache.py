@@ -0,0 +1,200 @@
+import os
+import sqlite3
+import hashlib
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+# =====================================================
+# Configuration
+# =====================================================
+# Shared by main.py and vectorizer.py so chat queries and ingestion reuse vectors
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "instance", "embedding_cache.db"
+)
+DEFAULT_MAX_MEMORY_ENTRIES = 10_000
+DEFAULT_MAX_DISK_ENTRIES = 1_000_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    model TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    vector BLOB NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (model, digest)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_embeddings_last_used ON embeddings (last_used);
+"""
+
+
+def text_digest(text):
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def pack_vector(vector):
+    return array("f", vector).tobytes()
+
+
+def unpack_vector(blob):
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache keyed on (model, sha256(text)).
+
+    A hot in-memory LRU tier sits in front of an optional SQLite tier that
+    stores vectors as packed float32 blobs. Both tiers are size-bounded and
+    evict least-recently-used entries. Pass ``path=None`` for memory only.
+    """
+
+    def __init__(
+        self,
+        path=DEFAULT_CACHE_PATH,
+        max_memory_entries=DEFAULT_MAX_MEMORY_ENTRIES,
+        max_disk_entries=DEFAULT_MAX_DISK_ENTRIES,
+    ):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._disk_entries = 0
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            self._disk_entries = self._conn.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()[0]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # -------------------------------------------------
+    # Lookups
+    # -------------------------------------------------
+    def get_many(self, model, texts):
+        """Return cached vectors for ``texts``, with None for every miss."""
+        keys = [(model, text_digest(text)) for text in texts]
+        results = [None] * len(keys)
+        disk_lookups = {}
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    results[i] = vector
+                else:
+                    disk_lookups.setdefault(key[1], []).append(i)
+
+            if disk_lookups and self._conn is not None:
+                found = self._read_disk(model, list(disk_lookups))
+                for digest, vector in found.items():
+                    for i in disk_lookups.pop(digest):
+                        results[i] = vector
+                        self.disk_hits += 1
+                    self._remember((model, digest), vector)
+
+            self.misses += sum(len(positions) for positions in disk_lookups.values())
+
+        return results
+
+    def put_many(self, model, texts, vectors):
+        rows = []
+        now = time.time()
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                digest = text_digest(text)
+                self._remember((model, digest), vector)
+                rows.append((model, digest, pack_vector(vector), now))
+            if self._conn is not None and rows:
+                with self._conn:
+                    cursor = self._conn.executemany(
+                        "INSERT OR IGNORE INTO embeddings (model, digest, vector, last_used) "
+                        "VALUES (?, ?, ?, ?)",
+                        rows,
+                    )
+                self._disk_entries += max(cursor.rowcount, 0)
+                self._evict_disk()
+
+    def embed(self, model, texts, embed_fn):
+        """Embed ``texts`` with ``embed_fn``, only sending cache misses upstream."""
+        vectors = self.get_many(model, texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # Byte-identical texts within one call are embedded only once
+            missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+            fresh = dict(zip(missing_texts, embed_fn(missing_texts)))
+            self.put_many(model, missing_texts, [fresh[t] for t in missing_texts])
+            for i in missing:
+                vectors[i] = fresh[texts[i]]
+        return vectors
+
+    def stats(self):
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_entries": self._disk_entries,
+        }
+
+    # -------------------------------------------------
+    # Internals (callers hold self._lock)
+    # -------------------------------------------------
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, model, digests):
+        found = {}
+        # Stay well below SQLite's bound-parameter limit
+        for start in range(0, len(digests), 500):
+            chunk = digests[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._conn.execute(
+                f"SELECT digest, vector FROM embeddings "
+                f"WHERE model = ? AND digest IN ({placeholders})",
+                [model, *chunk],
+            ).fetchall()
+            for digest, blob in rows:
+                found[digest] = unpack_vector(blob)
+        if found:
+            now = time.time()
+            with self._conn:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND digest = ?",
+                    [(now, model, digest) for digest in found],
+                )
+        return found
+
+    def _evict_disk(self):
+        if self._disk_entries <= self.max_disk_entries:
+            return
+        # Evict down to 90% of the bound so eviction does not run on every put
+        excess = self._disk_entries - int(self.max_disk_entries * 0.9)
+        with self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM embeddings WHERE (model, digest) IN ("
+                "SELECT model, digest FROM embeddings ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+        self._disk_entries -= max(cursor.rowcount, 0)
@@ -0,0 +1,340 @@
+import os
+import json
+import re
+import struct
+
+import numpy as np
+
+# =====================================================
+# Configuration
+# =====================================================
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.npy"
+IDS_FILE = "ids.bin"
+IDS_OFFSETS_FILE = "ids_offsets.npy"
+COLUMNS_DIR = "columns"
+HEADER_BYTES = 128  # Fixed .npy header size, so the row count can be rewritten in place
+DEFAULT_PUSH_BATCH_SIZE = 1000
+
+COLUMN_NAME = re.compile(r"^[A-Za-z0-9_]+$")
+
+
+# =====================================================
+# Appendable .npy files
+# =====================================================
+def _npy_header(dtype, shape):
+    """A version 1.0 .npy header padded to ``HEADER_BYTES``."""
+    header = repr(
+        {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            "fortran_order": False,
+            "shape": tuple(shape),
+        }
+    ).encode("latin1")
+    prefix = np.lib.format.MAGIC_PREFIX + b"\x01\x00"
+    header_len = HEADER_BYTES - len(prefix) - 2
+    return prefix + struct.pack("<H", header_len) + header.ljust(header_len - 1) + b"\n"
+
+
+class _AppendableArray:
+    """A .npy file grown along its first axis; its header is rewritten on ``sync``.
+
+    ``rows`` truncates an existing file to that many rows, dropping anything
+    appended after the last committed sync.
+    """
+
+    def __init__(self, path, dtype, row_shape=(), rows=0):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.row_bytes = self.dtype.itemsize * int(np.prod(self.row_shape, dtype=np.int64))
+        self.rows = rows
+        mode = "r+b" if os.path.exists(path) else "w+b"
+        self._file = open(path, mode)
+        self._file.truncate(HEADER_BYTES + rows * self.row_bytes)
+        self._file.seek(0, os.SEEK_END)
+        self.sync()
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        self._file.write(values.tobytes())
+        self.rows += len(values)
+
+    def sync(self):
+        self._file.flush()
+        position = self._file.tell()
+        self._file.seek(0)
+        self._file.write(_npy_header(self.dtype, (self.rows,) + self.row_shape))
+        self._file.seek(position)
+        self._file.flush()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+class _BlobColumn:
+    """Variable-length values: concatenated bytes plus an int64 offsets array.
+
+    ``fresh`` ignores leftovers of a column that was never committed.
+    """
+
+    def __init__(self, data_path, offsets_path, rows=0, fresh=False):
+        existing = os.path.exists(offsets_path) and not fresh
+        end = int(np.load(offsets_path, mmap_mode="r")[rows]) if existing else 0
+        self._offsets = _AppendableArray(offsets_path, np.int64, rows=rows + 1 if existing else 0)
+        if not existing:
+            # Rows that predate this column are empty
+            self._offsets.append(np.zeros(rows + 1, dtype=np.int64))
+        self._data = open(data_path, "r+b" if os.path.exists(data_path) else "w+b")
+        self._data.truncate(end)
+        self._data.seek(end)
+        self._end = end
+
+    def append(self, blobs):
+        offsets = np.empty(len(blobs), dtype=np.int64)
+        for i, blob in enumerate(blobs):
+            self._data.write(blob)
+            self._end += len(blob)
+            offsets[i] = self._end
+        self._offsets.append(offsets)
+
+    def sync(self):
+        self._data.flush()
+        self._offsets.sync()
+
+    def close(self):
+        self.sync()
+        self._data.close()
+        self._offsets.close()
+
+
+class _BlobReader:
+    """Read side of a ``_BlobColumn``: both files are memory-mapped, not loaded."""
+
+    def __init__(self, data_path, offsets_path, rows):
+        self._offsets = np.load(offsets_path, mmap_mode="r")[: rows + 1]
+        size = int(self._offsets[-1])
+        # An empty file cannot be mapped; every blob in it is empty
+        self._data = np.memmap(data_path, dtype=np.uint8, mode="r", shape=(size,)) if size else None
+
+    def read(self, start, end):
+        """The blobs of rows [start, end)."""
+        offsets = self._offsets[start : end + 1].tolist()
+        if self._data is None:
+            return [b""] * (end - start)
+        data = self._data[offsets[0] : offsets[-1]].tobytes()
+        base = offsets[0]
+        return [data[a - base : b - base] for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+# =====================================================
+# Export
+# =====================================================
+def _column_paths(path, name):
+    return (
+        os.path.join(path, COLUMNS_DIR, f"{name}.bin"),
+        os.path.join(path, COLUMNS_DIR, f"{name}_offsets.npy"),
+    )
+
+
+def _read_manifest(path):
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest["format"] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported embedding export format {manifest['format']}")
+    return manifest
+
+
+class ExportWriter:
+    """Appends embeddings to an export directory as they are produced.
+
+    Vectors go to one contiguous float32 ``vectors.npy``; row ``i`` belongs
+    to the ``i``-th id in the id table (``ids.bin`` + ``ids_offsets.npy``).
+    Metadata is stored column by column under ``columns/``, one JSON value
+    per row, empty where a row lacks the key. Each ``append`` ends by
+    rewriting ``manifest.json``, which is what readers trust: a crash loses
+    at most the batch in flight, and reopening resumes after the last
+    committed row. Ids appended twice keep both rows; the later one wins
+    when pushed.
+    """
+
+    def __init__(self, path, model=None):
+        self.path = path
+        os.makedirs(os.path.join(path, COLUMNS_DIR), exist_ok=True)
+        manifest = _read_manifest(path)
+        fresh = manifest is None
+        if fresh:
+            manifest = {
+                "format": FORMAT_VERSION,
+                "model": model,
+                "dim": None,
+                "rows": 0,
+                "columns": [],
+            }
+        if model is not None and manifest["model"] not in (None, model):
+            raise ValueError(
+                f"Export at {path} holds {manifest['model']} embeddings, not {model}"
+            )
+        self.manifest = manifest
+        self.manifest["model"] = manifest["model"] or model
+        rows = manifest["rows"]
+        self._vectors = None
+        if manifest["dim"] is not None:
+            self._open_vectors(manifest["dim"])
+        self._ids = _BlobColumn(
+            os.path.join(path, IDS_FILE), os.path.join(path, IDS_OFFSETS_FILE), rows, fresh
+        )
+        self._columns = {
+            name: _BlobColumn(*_column_paths(path, name), rows) for name in manifest["columns"]
+        }
+
+    def __len__(self):
+        return self.manifest["rows"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open_vectors(self, dim):
+        self._vectors = _AppendableArray(
+            os.path.join(self.path, VECTORS_FILE), np.float32, (dim,), self.manifest["rows"]
+        )
+
+    def append(self, ids, embeddings, metadatas=None):
+        """Append one batch of rows and commit it."""
+        if not ids:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if self._vectors is None:
+            self.manifest["dim"] = vectors.shape[1]
+            self._open_vectors(vectors.shape[1])
+        if vectors.shape != (len(ids), self.manifest["dim"]):
+            raise ValueError(
+                f"Expected {len(ids)} vectors of {self.manifest['dim']} dimensions, "
+                f"got shape {vectors.shape}"
+            )
+        metadatas = metadatas or [None] * len(ids)
+        for name in sorted({key for m in metadatas if m for key in m} - set(self._columns)):
+            if not COLUMN_NAME.match(name):
+                raise ValueError(f"Metadata key {name!r} cannot be a column name")
+            self._columns[name] = _BlobColumn(
+                *_column_paths(self.path, name), len(self), fresh=True
+            )
+            self.manifest["columns"].append(name)
+
+        self._vectors.append(vectors)
+        self._ids.append([vector_id.encode("utf-8") for vector_id in ids])
+        for name, column in self._columns.items():
+            column.append(
+                [
+                    json.dumps(m[name]).encode("utf-8") if m and name in m else b""
+                    for m in metadatas
+                ]
+            )
+        self._commit(len(ids))
+
+    def _commit(self, appended):
+        self._vectors.sync()
+        self._ids.sync()
+        for column in self._columns.values():
+            column.sync()
+        self.manifest["rows"] += appended
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def close(self):
+        if self._vectors is not None:
+            self._vectors.close()
+        self._ids.close()
+        for column in self._columns.values():
+            column.close()
+
+
+class EmbeddingExport:
+    """Read side of an export; the vectors are memory-mapped, not loaded."""
+
+    def __init__(self, path):
+        self.path = path
+        manifest = _read_manifest(path)
+        if manifest is None:
+            raise FileNotFoundError(f"No embedding export at {path}")
+        self.model = manifest["model"]
+        self.dim = manifest["dim"]
+        self.columns = manifest["columns"]
+        self.rows = manifest["rows"]
+        if self.rows:
+            self.vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")[: self.rows]
+        else:
+            self.vectors = np.zeros((0, self.dim or 0), dtype=np.float32)
+        self._ids = None
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            blobs = self._id_reader().read(0, self.rows)
+            self._ids = [blob.decode("utf-8") for blob in blobs]
+        return self._ids
+
+    def _id_reader(self):
+        return _BlobReader(
+            os.path.join(self.path, IDS_FILE),
+            os.path.join(self.path, IDS_OFFSETS_FILE),
+            self.rows,
+        )
+
+    def column(self, name):
+        """Values of one metadata key for every row, None where a row lacks it."""
+        if name not in self.columns:
+            return [None] * self.rows
+        blobs = _BlobReader(*_column_paths(self.path, name), self.rows).read(0, self.rows)
+        return [json.loads(blob) if blob else None for blob in blobs]
+
+    def batches(self, batch_size=DEFAULT_PUSH_BATCH_SIZE):
+        """Yield (ids, vectors, metadatas) per ``batch_size`` rows; vectors are views.
+
+        Ids and metadata are decoded one batch at a time, so memory stays
+        bounded by the batch rather than the export.
+        """
+        ids = self._id_reader()
+        columns = {
+            name: _BlobReader(*_column_paths(self.path, name), self.rows) for name in self.columns
+        }
+        for start in range(0, self.rows, batch_size):
+            end = min(start + batch_size, self.rows)
+            values = {
+                name: [json.loads(blob) if blob else None for blob in reader.read(start, end)]
+                for name, reader in columns.items()
+            }
+            metadatas = [
+                {name: column[row] for name, column in values.items() if column[row] is not None}
+                or None
+                for row in range(end - start)
+            ]
+            batch_ids = [blob.decode("utf-8") for blob in ids.read(start, end)]
+            yield batch_ids, self.vectors[start:end], metadatas
+
+
+def push_export(export, upsert, batch_size=DEFAULT_PUSH_BATCH_SIZE, as_lists=False):
+    """Upsert every row of ``export`` with ``upsert(records)``; returns the row count.
+
+    Records are (id, vector, metadata) tuples, which both the local store
+    and Upstash accept. ``as_lists`` converts vectors for JSON clients.
+    """
+    pushed = 0
+    for ids, vectors, metadatas in export.batches(batch_size):
+        rows = vectors.tolist() if as_lists else vectors
+        upsert(list(zip(ids, rows, metadatas)))
+        pushed += len(ids)
+    return pushed
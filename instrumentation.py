@@ -0,0 +1,212 @@
+import logging
+import threading
+import uuid
+from bisect import bisect_left
+from time import perf_counter
+from contextvars import ContextVar
+
+# =====================================================
+# Configuration
+# =====================================================
+# Upper bounds in seconds, from a cache hit up to a slow completion
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0, 60.0,
+)
+TRACE_HEADER = "X-Request-ID"
+TRACE_LOG_FORMAT = "%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s"
+
+trace_id_var = ContextVar("trace_id", default="-")
+
+
+# =====================================================
+# Metric types
+# =====================================================
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_label_text(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram; ``time(*labels)`` returns a span context manager."""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        self._observe(value, label_values)
+
+    def _observe(self, value, label_values):
+        slot = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][slot] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *label_values):
+        return Span(self, label_values)
+
+    def count(self, *label_values):
+        series = self._series.get(label_values)
+        return series[2] if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        for label_values, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                labels = _label_text(names, label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _label_text(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Span:
+    """Times a block into a histogram; an exception also bumps STAGE_ERRORS.
+
+    Cancellation and generator exits are timed but not counted as errors.
+    """
+
+    __slots__ = ("histogram", "label_values", "started")
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.histogram._observe(perf_counter() - self.started, self.label_values)
+        if exc_type is not None and self.histogram is STAGE_SECONDS:
+            if issubclass(exc_type, Exception):
+                STAGE_ERRORS.inc(*self.label_values)
+        return False
+
+
+# =====================================================
+# Metrics
+# =====================================================
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds", "Latency of each stage of a chat turn.", labels=("stage",)
+)
+STAGE_ERRORS = Counter(
+    "rag_stage_errors_total", "Exceptions raised by each stage.", labels=("stage",)
+)
+TOKENS = Counter(
+    "rag_tokens_total", "OpenAI tokens used, by model and kind.", labels=("model", "kind")
+)
+COALESCED_CALLS = Counter(
+    "rag_coalesced_calls_total",
+    "Upstream calls saved by joining an identical call already in flight.",
+    labels=("stage",),
+)
+REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "Latency of each HTTP endpoint.", labels=("endpoint", "status")
+)
+
+METRICS = [STAGE_SECONDS, STAGE_ERRORS, TOKENS, COALESCED_CALLS, REQUEST_SECONDS]
+
+
+def stage(name):
+    """Span timing one stage of a chat turn into ``rag_stage_seconds``."""
+    return Span(STAGE_SECONDS, (name,))
+
+
+def record_usage(model, response):
+    """Count the tokens an OpenAI response reports; streamed responses report none."""
+    usage = getattr(response, "usage", None)
+    for kind in ("prompt_tokens", "completion_tokens"):
+        value = getattr(usage, kind, None)
+        if isinstance(value, int):
+            TOKENS.inc(model, kind.split("_")[0], amount=value)
+
+
+def render_metrics(cache_stats=None):
+    """All metrics in the Prometheus text format.
+
+    ``cache_stats`` maps a cache name to its ``stats()`` dict; its counters
+    and hit rate are exported as-is, read at scrape time.
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for key, kind in (("hits", "counter"), ("misses", "counter"), ("hit_rate", "gauge")):
+        name = f"rag_cache_{key}" + ("_total" if kind == "counter" else "")
+        lines.append(f"# TYPE {name} {kind}")
+        for cache, stats in sorted((cache_stats or {}).items()):
+            lines.append(f'{name}{{cache="{cache}"}} {stats[key]}')
+    return "\n".join(lines) + "\n"
+
+
+# =====================================================
+# Trace ids
+# =====================================================
+def new_trace_id(incoming=None):
+    """Reuse a trace id from an upstream proxy, or start a new one."""
+    trace_id = incoming or uuid.uuid4().hex[:16]
+    trace_id_var.set(trace_id)
+    return trace_id
+
+
+def _stamp_trace_ids():
+    """Give every log record the trace id of the request being served."""
+    make_record = logging.getLogRecordFactory()
+    if getattr(make_record, "stamps_trace_id", False):
+        return
+
+    def record_with_trace_id(*args, **kwargs):
+        record = make_record(*args, **kwargs)
+        record.trace_id = trace_id_var.get()
+        return record
+
+    record_with_trace_id.stamps_trace_id = True
+    logging.setLogRecordFactory(record_with_trace_id)
+
+
+def configure_logging(level="INFO", trace_ids=False):
+    _stamp_trace_ids()
+    root = logging.getLogger()
+    root.setLevel(level)
+    if not root.handlers:
+        root.addHandler(logging.StreamHandler())
+    if trace_ids:
+        for handler in root.handlers:
+            handler.setFormatter(logging.Formatter(TRACE_LOG_FORMAT))
@@ -0,0 +1,247 @@
+import os
+import socket
+import threading
+import time
+import uuid
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, HistoryMessage, ReplyJob
+
+# =====================================================
+# Configuration
+# =====================================================
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# Must outlast a completion; an expired lease is taken over by another worker
+DEFAULT_LEASE_SECONDS = 120.0
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF_SECONDS = 2.0  # Doubled after every failed attempt
+DEFAULT_POLL_INTERVAL = 0.5
+CLAIM_SCAN_LIMIT = 8  # Runnable jobs tried per claim before giving up
+
+
+def new_owner():
+    """Lease owner id, unique per claimant across processes and hosts."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+# =====================================================
+# Queue operations (run inside an app context)
+# =====================================================
+def enqueue(message_id):
+    """Add a job for the pending bot message ``message_id`` to the session.
+
+    The caller commits, so the job lands in the same transaction as the
+    message. Returns False if the message already has a job.
+    """
+    if db.session.get(ReplyJob, message_id) is not None:
+        return False
+    db.session.add(
+        ReplyJob(
+            message_id=message_id,
+            status=STATUS_QUEUED,
+            attempts=0,
+            available_at=time.time(),
+        )
+    )
+    return True
+
+
+def _claimable(now):
+    # Queued and past its backoff, or running under a lease nobody renewed
+    pending = db.select(HistoryMessage.id).where(
+        HistoryMessage.id == ReplyJob.message_id, HistoryMessage.is_pending == True
+    )
+    return db.and_(
+        db.or_(
+            db.and_(ReplyJob.status == STATUS_QUEUED, ReplyJob.available_at <= now),
+            db.and_(ReplyJob.status == STATUS_RUNNING, ReplyJob.lease_expires_at < now),
+        ),
+        pending.exists(),
+    )
+
+
+def _take_lease(message_id, owner, lease_seconds):
+    """Compare-and-swap the job to running under ``owner``; True if it won."""
+    now = time.time()
+    result = db.session.execute(
+        db.update(ReplyJob)
+        .where(ReplyJob.message_id == message_id, _claimable(now))
+        .values(
+            status=STATUS_RUNNING,
+            lease_owner=owner,
+            lease_expires_at=now + lease_seconds,
+            attempts=ReplyJob.attempts + 1,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def claim(message_id, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """Lease the job of ``message_id``, creating it if the message has none.
+
+    Used when a reply is generated inside a request. Returns False while
+    another claimant holds the lease or once the reply is finished.
+    """
+    if db.session.get(ReplyJob, message_id) is None:
+        enqueue(message_id)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # Another request created it first
+    return _take_lease(message_id, owner, lease_seconds)
+
+
+def claim_next(owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """Lease the oldest runnable job; returns it, or None if there is none."""
+    candidates = db.session.execute(
+        db.select(ReplyJob.message_id)
+        .where(_claimable(time.time()))
+        .order_by(ReplyJob.available_at)
+        .limit(CLAIM_SCAN_LIMIT)
+    ).scalars().all()
+    for message_id in candidates:
+        if _take_lease(message_id, owner, lease_seconds):
+            return db.session.get(ReplyJob, message_id, populate_existing=True)
+    return None
+
+
+def _update_leased(message_id, owner, **values):
+    db.session.execute(
+        db.update(ReplyJob)
+        .where(ReplyJob.message_id == message_id, ReplyJob.lease_owner == owner)
+        .values(lease_owner=None, lease_expires_at=None, **values)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def complete(message_id, owner):
+    _update_leased(message_id, owner, status=STATUS_DONE)
+
+
+def release(message_id, owner):
+    """Give the job back without counting the attempt, e.g. after a client timeout."""
+    _update_leased(
+        message_id,
+        owner,
+        status=STATUS_QUEUED,
+        attempts=ReplyJob.attempts - 1,
+        available_at=time.time(),
+    )
+
+
+def retry_later(job, owner, error, max_attempts, backoff_seconds):
+    """Re-queue ``job`` with exponential backoff, or mark it failed when out of attempts."""
+    error_text = f"{type(error).__name__}: {error}"[:500]
+    if job.attempts >= max_attempts:
+        _update_leased(job.message_id, owner, status=STATUS_FAILED, last_error=error_text)
+        return
+    delay = backoff_seconds * 2 ** (job.attempts - 1)
+    _update_leased(
+        job.message_id,
+        owner,
+        status=STATUS_QUEUED,
+        available_at=time.time() + delay,
+        last_error=error_text,
+    )
+
+
+# =====================================================
+# Worker pool
+# =====================================================
+class ReplyWorkerPool:
+    """Threads that claim reply jobs and run ``handler(message_id, final_attempt)``.
+
+    A handler exception re-queues the job with backoff until
+    ``max_attempts`` is reached; on the final attempt the handler is
+    expected to record an error reply itself. Jobs survive restarts, and
+    jobs leased by a crashed worker are picked up once their lease expires.
+    """
+
+    def __init__(
+        self,
+        app,
+        handler,
+        workers=2,
+        lease_seconds=DEFAULT_LEASE_SECONDS,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        backoff_seconds=DEFAULT_BACKOFF_SECONDS,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+    ):
+        self.app = app
+        self.handler = handler
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.poll_interval = poll_interval
+        self.processed = 0
+        self.retried = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for n in range(self.workers):
+            thread = threading.Thread(
+                target=self._loop, name=f"reply-worker-{n}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def run_once(self):
+        """Claim and run one job; False if none was runnable."""
+        # A fresh owner per job: a lease that expired and was re-taken, even
+        # by another thread of this pool, can no longer be completed by us
+        owner = new_owner()
+        with self.app.app_context():
+            try:
+                job = claim_next(owner, self.lease_seconds)
+                if job is None:
+                    return False
+                final_attempt = job.attempts >= self.max_attempts
+                try:
+                    self.handler(job.message_id, final_attempt)
+                except Exception as e:
+                    db.session.rollback()
+                    retry_later(job, owner, e, self.max_attempts, self.backoff_seconds)
+                    outcome = "failed" if final_attempt else "retried"
+                else:
+                    complete(job.message_id, owner)
+                    outcome = "processed"
+                with self._lock:
+                    setattr(self, outcome, getattr(self, outcome) + 1)
+                return True
+            finally:
+                db.session.remove()
+
+    def stats(self):
+        return {
+            "workers": len(self._threads),
+            "processed": self.processed,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                worked = self.run_once()
+            except Exception:
+                worked = False  # e.g. database locked; try again after a pause
+            if not worked:
+                self._stop.wait(self.poll_interval)
@@ -0,0 +1,302 @@
+import os
+import re
+import json
+import shutil
+from array import array
+
+import numpy as np
+
+# =====================================================
+# Configuration
+# =====================================================
+DEFAULT_LEXICAL_INDEX_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "instance", "lexical_index"
+)
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60  # Damping constant from the reciprocal-rank fusion paper
+MAX_TERM_BYTES = 32  # Width of the fixed-size term dictionary entries
+
+TERMS_FILE = "terms.npy"
+TERM_INFO_FILE = "term_info.npy"
+POSTINGS_FILE = "postings.bin"
+DOC_IDS_FILE = "doc_ids.npy"
+DOC_LENGTHS_FILE = "doc_lengths.npy"
+DOCUMENTS_FILE = "documents.bin"
+DOC_OFFSETS_FILE = "doc_offsets.npy"
+STATS_FILE = "stats.json"
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the "
+    "this to was we were which with".split()
+)
+
+
+def tokenize(text):
+    """Lowercased alphanumeric runs; acronyms and dataset names stay whole."""
+    return [
+        token[:MAX_TERM_BYTES]
+        for token in TOKEN_PATTERN.findall(text.lower())
+        if len(token) > 1 and token not in STOPWORDS
+    ]
+
+
+# =====================================================
+# Posting list compression
+# =====================================================
+def encode_varints(values):
+    """LEB128-encode unsigned ints: 7 bits per byte, high bit marks continuation."""
+    values = np.asarray(values, dtype=np.uint64)
+    widths = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        widths += values >= (1 << shift)
+    out = np.empty(int(widths.sum()), dtype=np.uint8)
+    starts = np.cumsum(widths) - widths
+    for k in range(int(widths.max(initial=0))):
+        mask = widths > k
+        byte = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (widths[mask] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[mask] + k] = byte | more
+    return out.tobytes()
+
+
+def decode_varints(data):
+    """Vectorized inverse of encode_varints over a uint8 array."""
+    data = np.asarray(data, dtype=np.uint8)
+    terminal = data < 0x80
+    if terminal.all():
+        # Common case for gaps in long posting lists and for term frequencies
+        return data.astype(np.uint32)
+    ends = np.flatnonzero(terminal)
+    starts = np.empty_like(ends)
+    starts[0:1] = 0
+    starts[1:] = ends[:-1] + 1
+    widths = ends - starts + 1
+    values = (data[starts] & 0x7F).astype(np.uint32)
+    for k in range(1, int(widths.max())):
+        multi = np.flatnonzero(widths > k)
+        values[multi] |= (data[starts[multi] + k].astype(np.uint32) & 0x7F) << (7 * k)
+    return values
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """Fuse ranked id lists by summing 1 / (k + rank); best first."""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class LexicalHit:
+    def __init__(self, id, score, text):
+        self.id = id
+        self.score = score
+        self.text = text
+
+    def __repr__(self):
+        return f"LexicalHit(id={self.id!r}, score={self.score:.4f})"
+
+
+# =====================================================
+# Index
+# =====================================================
+class BM25IndexBuilder:
+    """Accumulates documents in memory and writes a ``BM25Index`` on ``finish``.
+
+    Posting lists hold delta-encoded document numbers followed by term
+    frequencies, both as varints. The term dictionary is a sorted array of
+    fixed-width byte strings, so lookups are a binary search over a
+    memory-mapped file.
+    """
+
+    def __init__(self, path=DEFAULT_LEXICAL_INDEX_PATH):
+        self.path = path
+        self._doc_ids = []
+        self._doc_lengths = array("I")
+        self._documents = []
+        self._postings = {}  # term -> array("I") of interleaved (doc, tf)
+
+    def __len__(self):
+        return len(self._doc_ids)
+
+    def add(self, doc_id, text):
+        doc = len(self._doc_ids)
+        tokens = tokenize(text)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for term, tf in counts.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = array("I")
+            postings.append(doc)
+            postings.append(tf)
+        self._doc_ids.append(doc_id)
+        self._doc_lengths.append(len(tokens))
+        self._documents.append(text.encode("utf-8"))
+
+    def finish(self):
+        """Write the index next to ``path``, then swap it into place.
+
+        A server may have the previous index memory-mapped; truncating its
+        files in place could crash it with SIGBUS, whereas renamed-away
+        files stay readable until it reloads.
+        """
+        staging = f"{self.path}.tmp-{os.getpid()}"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        terms = sorted(self._postings)
+        # offset, gap bytes, total bytes, df
+        term_info = np.zeros((len(terms), 4), dtype=np.int64)
+        offset = 0
+        with open(os.path.join(staging, POSTINGS_FILE), "wb") as f:
+            for i, term in enumerate(terms):
+                pairs = np.frombuffer(self._postings.pop(term), dtype=np.uint32)
+                docs, tfs = pairs[0::2], pairs[1::2]
+                # Gaps and frequencies are decoded separately so that each
+                # can take the single-byte fast path on its own
+                gap_blob = encode_varints(np.diff(docs, prepend=0))
+                tf_blob = encode_varints(tfs)
+                f.write(gap_blob)
+                f.write(tf_blob)
+                nbytes = len(gap_blob) + len(tf_blob)
+                term_info[i] = (offset, len(gap_blob), nbytes, len(docs))
+                offset += nbytes
+
+        np.save(
+            os.path.join(staging, TERMS_FILE),
+            np.array([t.encode("utf-8") for t in terms], dtype=f"S{MAX_TERM_BYTES}"),
+        )
+        np.save(os.path.join(staging, TERM_INFO_FILE), term_info)
+        np.save(os.path.join(staging, DOC_IDS_FILE), np.array(self._doc_ids, dtype=np.str_))
+        lengths = np.frombuffer(self._doc_lengths, dtype=np.uint32)
+        np.save(os.path.join(staging, DOC_LENGTHS_FILE), lengths)
+
+        doc_offsets = np.zeros(len(self._documents) + 1, dtype=np.int64)
+        with open(os.path.join(staging, DOCUMENTS_FILE), "wb") as f:
+            for i, document in enumerate(self._documents):
+                f.write(document)
+                doc_offsets[i + 1] = doc_offsets[i] + len(document)
+        np.save(os.path.join(staging, DOC_OFFSETS_FILE), doc_offsets)
+
+        with open(os.path.join(staging, STATS_FILE), "w") as f:
+            json.dump(
+                {
+                    "documents": len(self._doc_ids),
+                    "avg_length": float(lengths.mean()) if len(lengths) else 0.0,
+                    "k1": BM25_K1,
+                    "b": BM25_B,
+                },
+                f,
+            )
+        _swap_into_place(staging, self.path)
+        return BM25Index(self.path)
+
+
+def _swap_into_place(staging, path):
+    previous = None
+    if os.path.exists(path):
+        previous = f"{path}.old-{os.getpid()}"
+        os.replace(path, previous)
+    os.replace(staging, path)
+    if previous is not None:
+        shutil.rmtree(previous)
+
+
+class BM25Index:
+    """Read-only BM25 index; every file is memory-mapped, nothing is loaded eagerly."""
+
+    def __init__(self, path=DEFAULT_LEXICAL_INDEX_PATH):
+        self.path = path
+        with open(os.path.join(path, STATS_FILE)) as f:
+            stats = json.load(f)
+        self.n_docs = stats["documents"]
+        self.avg_length = stats["avg_length"] or 1.0
+        self.k1 = stats["k1"]
+        self.b = stats["b"]
+
+        def mapped(name):
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        self._terms = mapped(TERMS_FILE)
+        self._term_info = mapped(TERM_INFO_FILE)
+        self._doc_ids = mapped(DOC_IDS_FILE)
+        self._doc_lengths = mapped(DOC_LENGTHS_FILE)
+        self._doc_offsets = mapped(DOC_OFFSETS_FILE)
+        self._postings = self._map_bytes(POSTINGS_FILE)
+        self._documents = self._map_bytes(DOCUMENTS_FILE)
+        self._norms = None
+
+    def _map_bytes(self, name):
+        file_path = os.path.join(self.path, name)
+        if os.path.getsize(file_path) == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(file_path, dtype=np.uint8, mode="r")
+
+    @classmethod
+    def load(cls, path=DEFAULT_LEXICAL_INDEX_PATH):
+        """The index at ``path``, or None if none has been built."""
+        if not os.path.exists(os.path.join(path, STATS_FILE)):
+            return None
+        return cls(path)
+
+    def __len__(self):
+        return self.n_docs
+
+    def _lookup(self, term):
+        key = term.encode("utf-8")
+        i = int(np.searchsorted(self._terms, key))
+        if i < len(self._terms) and self._terms[i] == key:
+            return self._term_info[i]
+        return None
+
+    def postings(self, term):
+        """(doc_numbers, term_frequencies) for ``term``; empty arrays if unknown."""
+        info = self._lookup(term)
+        if info is None:
+            empty = np.zeros(0, dtype=np.uint32)
+            return empty, empty
+        offset, gap_bytes, nbytes, df = (int(v) for v in info)
+        gaps = decode_varints(self._postings[offset : offset + gap_bytes])
+        tfs = decode_varints(self._postings[offset + gap_bytes : offset + nbytes])
+        return np.cumsum(gaps, dtype=np.int64), tfs
+
+    def document(self, doc):
+        start, end = self._doc_offsets[doc], self._doc_offsets[doc + 1]
+        return bytes(self._documents[start:end]).decode("utf-8")
+
+    def _length_norms(self):
+        # Per-document BM25 length normalization, computed once per process
+        if self._norms is None:
+            lengths = np.asarray(self._doc_lengths, dtype=np.float32)
+            self._norms = self.k1 * (1.0 - self.b + self.b * lengths / self.avg_length)
+        return self._norms
+
+    def search(self, text, top_k=10):
+        """Top ``top_k`` documents for ``text`` by BM25, best first."""
+        norms = self._length_norms()
+        totals = None
+        for term in set(tokenize(text)):
+            docs, tfs = self.postings(term)
+            if not len(docs):
+                continue
+            df = len(docs)
+            idf = np.float32(np.log(1.0 + (self.n_docs - df + 0.5) / (df + 0.5)))
+            tfs = tfs.astype(np.float32)
+            if totals is None:
+                totals = np.zeros(self.n_docs, dtype=np.float32)
+            # Documents are unique within one posting list, so += is safe
+            totals[docs] += idf * np.float32(self.k1 + 1.0) * tfs / (tfs + norms[docs])
+        if totals is None:
+            return []
+
+        candidates = np.flatnonzero(totals)
+        k = min(top_k, len(candidates))
+        best = candidates[np.argpartition(-totals[candidates], k - 1)[:k]]
+        best = best[np.argsort(-totals[best], kind="stable")]
+        return [
+            LexicalHit(str(self._doc_ids[doc]), float(totals[doc]), self.document(doc))
+            for doc in best
+        ]
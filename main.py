@@ -1,21 +1,144 @@
-from flask import Flask, render_template, request, redirect, url_for, make_response
-from upstash_vector import Index, Vector
-from openai import OpenAI
-from upstash_vector import Index, Vector
+import os
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import (
+    Flask,
+    Response,
+    g,
+    render_template,
+    request,
+    redirect,
+    url_for,
+    make_response,
+    stream_with_context,
+)
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy.engine import make_url
+
+from models import db, History, HistoryMessage, configure_sqlite, ensure_schema
+from prompt_builder import (
+    SUMMARY_TOKEN_BUDGET,
+    retrieval_text,
+    select_knowledge,
+    split_history,
+    summary_request,
+)
+from embedding_cache import EmbeddingCache
+from answer_cache import AnswerCache, DEFAULT_GENERATION_PATH
+from vector_store import (
+    LocalVectorStore,
+    UPSTASH_URL,
+    DEFAULT_LOCAL_STORE_PATH,
+    DEFAULT_RERANK,
+)
+from ann_index import DEFAULT_NPROBE
+from attribute_index import parse_filter, DEFAULT_ATTRIBUTE_FIELDS
+from lexical_index import BM25Index, DEFAULT_LEXICAL_INDEX_PATH, reciprocal_rank_fusion
+from job_queue import (
+    ReplyWorkerPool,
+    claim,
+    complete,
+    enqueue,
+    new_owner,
+    release,
+    DEFAULT_LEASE_SECONDS,
+    DEFAULT_MAX_ATTEMPTS,
+    DEFAULT_BACKOFF_SECONDS,
+)
+from instrumentation import (
+    COALESCED_CALLS,
+    REQUEST_SECONDS,
+    STAGE_ERRORS,
+    STAGE_SECONDS,
+    TRACE_HEADER,
+    configure_logging,
+    new_trace_id,
+    record_usage,
+    render_metrics,
+    stage,
+)
+from single_flight import SingleFlight, normalize_query
+from reranker import (
+    Candidate,
+    Reranker,
+    DEFAULT_RERANK_CANDIDATES,
+    DEFAULT_DEADLINE_MS,
+    DEFAULT_DENSE_WEIGHT,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# openai and upstash_vector are most of the import time; load them on first use
+def OpenAI(**kwargs):
+    from openai import OpenAI
+
+    return OpenAI(**kwargs)
+
+
+def Index(**kwargs):
+    from upstash_vector import Index
+
+    return Index(**kwargs)
+
+
+class LazyClient:
+    """Builds the wrapped client on first attribute access."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+                client = self._client
+        return getattr(client, name)
 
-from models import db, History, HistoryMessage
 
 # =====================================================
 # Global instances
 # =====================================================
-openai_client = None  # Will be initialized in main()
-upstash_index = None  # Will be initialized in main()
+openai_client = None  # Initialized in init_clients(), once per process
+upstash_index = None  # Vector index (Upstash or local), initialized in init_clients()
+embedding_cache = None  # Will be initialized on first use
+answer_cache = None  # Will be initialized on first use
+lexical_index = None  # BM25 index, loaded in init_clients() when vectorizer.py built one
+reranker = None  # Will be initialized on first use
+reply_workers = None  # Background reply generation, started in initialize()
+single_flight = None  # Will be initialized on first use
 
 # =====================================================
 # Set up OpenAI
 # =====================================================
 MODEL = "text-embedding-3-small"
 MAX_TOKENS_PER_REQUEST = 8191
+CHAT_MODEL = "gpt-3.5-turbo"
+RETRIEVAL_TOP_K = 10  # Papers retrieved per question, per retriever
+# Vector hits fetched per question; article chunks of one paper collapse into one
+RETRIEVAL_CANDIDATES = RETRIEVAL_TOP_K * 3
+MAX_SEARCH_TOP_K = 100
+# Bulk question answering (/api/v1/batch-answer and batch_answer.py)
+BATCH_EMBED_SIZE = 512  # Questions per embeddings call
+BATCH_QUERY_SIZE = 100  # Questions per query_many call
+DEFAULT_BATCH_CONCURRENCY = 8  # Completions in flight at once
+MAX_BATCH_QUESTIONS = 10_000  # Per request to the endpoint
+COMPLETION_ERROR_MESSAGE = "Sorry, I encountered an error while generating a response."
+
+# =====================================================
+# Pagination
+# =====================================================
+SIDEBAR_PAGE_SIZE = 50
+HISTORY_PAGE_SIZE = 50
+# Upper bound on unsummarized turns loaded to build a reply
+MAX_CONTEXT_MESSAGES = 200
 
 # =====================================================
 # Configuration
@@ -23,37 +146,269 @@ MAX_TOKENS_PER_REQUEST = 8191
 app = Flask(__name__)
 
 # SQLite configuration
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///data.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL", "sqlite:///data.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["OPENAI_API_KEY"] = None
-app.config["UPSTASH_TOKEN"] = None
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {}
+_database_url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+if _database_url.get_backend_name() != "sqlite" or _database_url.database not in (None, "", ":memory:"):
+    # In-memory SQLite gets a single shared connection, which takes no pool sizing
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"].update(pool_size=10, max_overflow=20, pool_timeout=30)
+if _database_url.get_backend_name() == "sqlite":
+    # Seconds a writer waits for the database lock before raising "database is locked"
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"]["connect_args"] = {"timeout": 30}
+# WAL lets readers run alongside the writer; NORMAL skips the fsync on every commit
+app.config["SQLITE_JOURNAL_MODE"] = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+app.config["SQLITE_SYNCHRONOUS"] = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+# Read from the environment in production; otherwise set through the /initialize form
+app.config["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
+app.config["UPSTASH_TOKEN"] = os.getenv("UPSTASH_TOKEN")
+# Shared with vectorizer.py; set to None to keep the cache in memory only
+app.config["EMBEDDING_CACHE_PATH"] = os.path.join(app.instance_path, "embedding_cache.db")
+# "upstash" (default) or "local" for the in-process vector store
+app.config["VECTOR_STORE"] = os.getenv("VECTOR_STORE", "upstash")
+app.config["LOCAL_VECTOR_STORE_PATH"] = os.getenv(
+    "LOCAL_VECTOR_STORE_PATH", DEFAULT_LOCAL_STORE_PATH
+)
+# Inverted lists scanned per query once an ANN index has been built
+app.config["LOCAL_VECTOR_STORE_NPROBE"] = int(
+    os.getenv("LOCAL_VECTOR_STORE_NPROBE", DEFAULT_NPROBE)
+)
+# Candidates re-scored with full-precision vectors when the store is compressed
+app.config["LOCAL_VECTOR_STORE_RERANK"] = int(
+    os.getenv("LOCAL_VECTOR_STORE_RERANK", DEFAULT_RERANK)
+)
+# Semantic answer cache for questions asked without chat history
+app.config["ANSWER_CACHE_THRESHOLD"] = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+app.config["ANSWER_CACHE_TTL"] = float(os.getenv("ANSWER_CACHE_TTL", 24 * 60 * 60))
+# Set to 0 to disable the answer cache
+app.config["ANSWER_CACHE_MAX_ENTRIES"] = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 1000))
+# Touched by vectorizer.py after ingestion to invalidate cached answers
+app.config["INDEX_GENERATION_PATH"] = os.getenv(
+    "INDEX_GENERATION_PATH", DEFAULT_GENERATION_PATH
+)
+# BM25 index fused with vector search results; hybrid retrieval is off if missing
+app.config["LEXICAL_INDEX_PATH"] = os.getenv(
+    "LEXICAL_INDEX_PATH", DEFAULT_LEXICAL_INDEX_PATH
+)
+# Re-rank an over-fetched candidate set before filling the knowledge budget
+app.config["RERANK_ENABLED"] = os.getenv("RERANK_ENABLED", "0") == "1"
+app.config["RERANK_CANDIDATES"] = int(
+    os.getenv("RERANK_CANDIDATES", DEFAULT_RERANK_CANDIDATES)
+)
+# Past this, the un-reranked order is used
+app.config["RERANK_DEADLINE_MS"] = float(
+    os.getenv("RERANK_DEADLINE_MS", DEFAULT_DEADLINE_MS)
+)
+app.config["RERANK_DENSE_WEIGHT"] = float(
+    os.getenv("RERANK_DENSE_WEIGHT", DEFAULT_DENSE_WEIGHT)
+)
+# Threads generating queued replies; 0 generates each reply inside its request
+app.config["REPLY_WORKERS"] = int(os.getenv("REPLY_WORKERS", 0))
+app.config["REPLY_LEASE_SECONDS"] = float(
+    os.getenv("REPLY_LEASE_SECONDS", DEFAULT_LEASE_SECONDS)
+)
+app.config["REPLY_MAX_ATTEMPTS"] = int(os.getenv("REPLY_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS))
+app.config["REPLY_RETRY_BACKOFF"] = float(
+    os.getenv("REPLY_RETRY_BACKOFF", DEFAULT_BACKOFF_SECONDS)
+)
+
+# Concurrent identical questions share one embedding and retrieval call
+app.config["SINGLE_FLIGHT"] = os.getenv("SINGLE_FLIGHT", "1") == "1"
+# ... and one completion when their prompts are identical
+app.config["SINGLE_FLIGHT_COMPLETIONS"] = os.getenv("SINGLE_FLIGHT_COMPLETIONS", "0") == "1"
+
+# Prefix log lines with the request's trace id (taken from X-Request-ID if sent)
+app.config["LOG_TRACE_IDS"] = os.getenv("LOG_TRACE_IDS", "0") == "1"
+app.config["LOG_LEVEL"] = os.getenv("LOG_LEVEL", "INFO")
+# Compiled templates are shared across workers and restarts; set to "" to disable
+app.config["JINJA_CACHE_PATH"] = os.getenv(
+    "JINJA_CACHE_PATH", os.path.join(app.instance_path, "jinja_cache")
+)
 
 db.init_app(app)
+configure_logging(app.config["LOG_LEVEL"], app.config["LOG_TRACE_IDS"])
+if app.config["JINJA_CACHE_PATH"]:
+    os.makedirs(app.config["JINJA_CACHE_PATH"], exist_ok=True)
+    app.jinja_options = {
+        **app.jinja_options,
+        "bytecode_cache": FileSystemBytecodeCache(app.config["JINJA_CACHE_PATH"]),
+    }
 
 # =====================================================
 # Initialization
 # =====================================================
 with app.app_context():
-    db.create_all()
+    configure_sqlite(
+        db.engine, app.config["SQLITE_JOURNAL_MODE"], app.config["SQLITE_SYNCHRONOUS"]
+    )
+    ensure_schema()
 
 
 # =====================================================
 # Helper functions
 # =====================================================
-def embed_texts(texts):
-    response = openai_client.embeddings.create(model=MODEL, input=texts)
+def precompile_templates():
+    """Compile every template ahead of the first request that renders it."""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def get_embedding_cache():
+    global embedding_cache
+    if embedding_cache is None:
+        embedding_cache = EmbeddingCache(app.config["EMBEDDING_CACHE_PATH"])
+    return embedding_cache
+
+
+def get_answer_cache():
+    global answer_cache
+    if answer_cache is None:
+        answer_cache = AnswerCache(
+            threshold=app.config["ANSWER_CACHE_THRESHOLD"],
+            ttl=app.config["ANSWER_CACHE_TTL"],
+            max_entries=app.config["ANSWER_CACHE_MAX_ENTRIES"],
+            generation_path=app.config["INDEX_GENERATION_PATH"],
+        )
+    return answer_cache
+
+
+def get_reranker():
+    global reranker
+    if reranker is None:
+        reranker = Reranker(
+            dense_weight=app.config["RERANK_DENSE_WEIGHT"],
+            deadline_ms=app.config["RERANK_DEADLINE_MS"],
+        )
+    return reranker
+
+
+def get_single_flight():
+    global single_flight
+    if single_flight is None:
+        single_flight = SingleFlight()
+    return single_flight
+
+
+def coalesce(group, key, fn):
+    """``fn()``, shared with any identical call (same ``group`` and ``key``) in flight."""
+    if not app.config["SINGLE_FLIGHT"]:
+        return fn()
+    result, shared = get_single_flight().do(group, key, fn)
+    if shared:
+        COALESCED_CALLS.inc(group)
+    return result
+
+
+def start_reply_workers():
+    global reply_workers
+    if reply_workers is None and app.config["REPLY_WORKERS"] > 0:
+        reply_workers = ReplyWorkerPool(
+            app,
+            run_reply_job,
+            workers=app.config["REPLY_WORKERS"],
+            lease_seconds=app.config["REPLY_LEASE_SECONDS"],
+            max_attempts=app.config["REPLY_MAX_ATTEMPTS"],
+            backoff_seconds=app.config["REPLY_RETRY_BACKOFF"],
+        )
+        reply_workers.start()
+    return reply_workers
+
+
+def retrieval_limit():
+    """Papers gathered per retriever: the re-ranking pool, or the final top k."""
+    if app.config["RERANK_ENABLED"]:
+        return max(app.config["RERANK_CANDIDATES"], RETRIEVAL_TOP_K)
+    return RETRIEVAL_TOP_K
+
+
+def retrieval_fetch_k():
+    # Article chunks of one paper collapse into one candidate, so over-fetch
+    return max(retrieval_limit(), RETRIEVAL_CANDIDATES)
+
+
+def remember_answer(answer_key, answer):
+    """Cache a generated answer under the ``answer_key`` from build_reply_messages."""
+    if answer_key is not None and answer and answer != COMPLETION_ERROR_MESSAGE:
+        embedding, result_ids = answer_key
+        get_answer_cache().put(embedding, answer, result_ids)
+
+
+def _embed_texts_uncached(texts):
+    with stage("embed"):
+        response = openai_client.embeddings.create(model=MODEL, input=texts)
+    record_usage(MODEL, response)
     return [e.embedding for e in response.data]
 
 
+def embed_texts(texts):
+    return get_embedding_cache().embed(MODEL, texts, _embed_texts_uncached)
+
+
+def _before_arg():
+    """The ``before`` keyset cursor from the query string, or None for the first page."""
+    return request.args.get("before", type=int)
+
+
+def sidebar_page(before=None):
+    """Return (sessions, next_before) for one page of the sidebar, newest first."""
+    query = History.query
+    if before is not None:
+        query = query.filter(History.id < before)
+    sessions = query.order_by(History.id.desc()).limit(SIDEBAR_PAGE_SIZE + 1).all()
+    next_before = None
+    if len(sessions) > SIDEBAR_PAGE_SIZE:
+        sessions = sessions[:SIDEBAR_PAGE_SIZE]
+        next_before = sessions[-1].id
+    return sessions, next_before
+
+
+def history_page(history_id, before=None):
+    """Return (messages, next_before) for the newest messages older than ``before``."""
+    query = HistoryMessage.query.filter(HistoryMessage.history_id == history_id)
+    if before is not None:
+        query = query.filter(HistoryMessage.id < before)
+    messages = query.order_by(HistoryMessage.id.desc()).limit(HISTORY_PAGE_SIZE + 1).all()
+    next_before = None
+    if len(messages) > HISTORY_PAGE_SIZE:
+        messages = messages[:HISTORY_PAGE_SIZE]
+        next_before = messages[-1].id
+    # Rendered oldest first
+    return messages[::-1], next_before
+
+
+# =====================================================
+# Request tracing
+# =====================================================
+@app.before_request
+def start_trace():
+    g.trace_id = new_trace_id(request.headers.get(TRACE_HEADER))
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def finish_trace(response):
+    started = g.get("started")
+    if started is not None:
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - started, request.endpoint or "unknown", response.status_code
+        )
+        response.headers[TRACE_HEADER] = g.trace_id
+    return response
+
+
 # =====================================================
 # Routes
 # =====================================================
 @app.route("/api/v1/history/<int:history_id>")
 def load_history(history_id):
-    history = History.query.get_or_404(history_id)
-    messages = HistoryMessage.query.filter_by(history_id=history_id).all()
+    before = _before_arg()
+    if before is None:
+        history = History.query.get_or_404(history_id)
+    messages, next_before = history_page(history_id, before)
+    # Older pages are prepended to the open session by infinite scroll
+    template = "components/history.html" if before is None else "components/history_page.html"
     return render_template(
-        "components/history.html", messages=messages, history_id=history_id
+        template, messages=messages, history_id=history_id, next_before=next_before
     )
 
 
@@ -67,51 +422,41 @@ def send_message():
 
     if session_id_str and session_id_str != "null" and session_id_str.strip() != "":
         try:
-            current_session_id = int(session_id_str)
-            history = History.query.get(current_session_id)
-            if history:
-                session_id = history.id
-            else:  # Invalid session_id_str, create new session
-                history = History(
-                    title=message_text[:30] if message_text else "New Chat"
-                )
-                db.session.add(history)
-                db.session.commit()
-                session_id = history.id
-                new_session_created = True
+            history = db.session.get(History, int(session_id_str))
         except ValueError:  # session_id_str is not a valid int
-            history = History(title=message_text[:30] if message_text else "New Chat")
-            db.session.add(history)
-            db.session.commit()
-            session_id = history.id
-            new_session_created = True
-    else:  # No session_id_str, create new session
+            history = None
+
+    if history is None:  # No or invalid session_id_str, create new session
         history = History(title=message_text[:30] if message_text else "New Chat")
         db.session.add(history)
-        db.session.commit()
-        session_id = history.id
+        db.session.flush()  # Assigns the id inside the same transaction
         new_session_created = True
+    session_id = history.id
 
-    # Save user message
-    user_msg_db = HistoryMessage(
-        history_id=session_id, message=message_text, is_user=True
-    )
+    # Save user message, then a placeholder for the bot message; the reply
+    # context relies on the user message having the smaller id
+    user_msg_db = HistoryMessage(history_id=session_id, message=message_text, is_user=True)
     db.session.add(user_msg_db)
-    db.session.commit()
-
-    # Create a placeholder for bot message
+    db.session.flush()
     bot_msg_db = HistoryMessage(
         history_id=session_id, message="Thinking...", is_user=False, is_pending=True
     )
     db.session.add(bot_msg_db)
-    db.session.commit()
+    db.session.flush()
     bot_message_id = bot_msg_db.id
+    queued = app.config["REPLY_WORKERS"] > 0
+    if queued:
+        enqueue(bot_message_id)
+    # One transaction per request: the flushes above only assign ids
+    with stage("db_commit"):
+        db.session.commit()
 
     response_html = render_template(
         "components/thinking_message.html",
         user_message=message_text,
         bot_message_id=bot_message_id,
         session_id=session_id,
+        queued=queued,
     )
 
     resp = make_response(response_html)
@@ -120,44 +465,57 @@ def send_message():
     return resp
 
 
-@app.route("/api/v1/get-bot-reply/<int:bot_message_id>", methods=["GET"])
-def get_bot_reply(bot_message_id):
-    bot_msg_db_entry = HistoryMessage.query.get_or_404(bot_message_id)
-    if not bot_msg_db_entry.is_pending:  # Check if already processed
-        return render_template(
-            "components/bot_reply_content.html", bot_message=bot_msg_db_entry.message
-        )
-
-    # Ensure openai_client is initialized - MOVED THIS CHECK TO THE BEGINNING
-    if openai_client is None:
-        # This case should ideally be handled by ensuring initialization at app start
-        # or redirecting to initialization page if keys are missing.
-        # For now, returning an error message.
-        bot_msg_db_entry.message = "Error: OpenAI client not initialized."
-        bot_msg_db_entry.is_pending = False
+def _finish_bot_message(bot_msg_db_entry, message):
+    # Single commit that turns the placeholder into the final reply
+    bot_msg_db_entry.message = message
+    bot_msg_db_entry.is_pending = False
+    with stage("db_commit"):
         db.session.commit()
-        return render_template(
-            "components/bot_reply_content.html", bot_message=bot_msg_db_entry.message
-        )
+    return message
+
+
+def render_pending_reply(bot_message_id):
+    """Placeholder that polls until the reply has been generated elsewhere."""
+    # Without workers, polling get-bot-reply takes over the lease once it expires
+    endpoint = "bot_reply_result" if app.config["REPLY_WORKERS"] > 0 else "get_bot_reply"
+    return render_template(
+        "components/pending_reply.html",
+        poll_url=url_for(endpoint, bot_message_id=bot_message_id),
+    )
+
 
-    # Find the user message that prompted this bot reply.
-    # This assumes the immediately preceding user message in the same session.
-    user_msg_db_entry = (
-        HistoryMessage.query.filter(
+def load_reply_context(bot_msg_db_entry):
+    """Return (user_message_text, history_messages, summary) for a pending bot message.
+
+    Returns None after recording an error reply on ``bot_msg_db_entry`` when
+    the user message cannot be found.
+    """
+    # One query fetches the unsummarized turns before this reply, newest first,
+    # together with the session row that holds the summary
+    rows = (
+        db.session.query(HistoryMessage, History)
+        .join(History, History.id == HistoryMessage.history_id)
+        .filter(
             HistoryMessage.history_id == bot_msg_db_entry.history_id,
-            HistoryMessage.is_user == True,
-            HistoryMessage.id
-            < bot_msg_db_entry.id,  # User message must come before bot message
+            HistoryMessage.id < bot_msg_db_entry.id,
+            HistoryMessage.id > db.func.coalesce(History.summary_through_id, 0),
+            HistoryMessage.is_pending == False,
         )
         .order_by(HistoryMessage.id.desc())
-        .first()
+        .limit(MAX_CONTEXT_MESSAGES)
+        .all()
     )
+    recent = [message for message, _ in rows]
+    history = rows[0][1] if rows else bot_msg_db_entry.history
 
-    if not user_msg_db_entry:
-        # Fallback or error: if no preceding user message found (should not happen in normal flow)
-        # For simplicity, we'll use the bot_msg_db_entry's history_id to find any user message
-        # This part might need more robust logic depending on exact requirements.
-        # As a quick fix, let's assume the latest user message in the session.
+    # The user message that prompted this bot reply is the latest one before it
+    user_index = next((i for i, msg in enumerate(recent) if msg.is_user), None)
+    if user_index is not None:
+        user_msg_db_entry = recent[user_index]
+        history_messages = recent[:user_index:-1]  # Older turns, oldest first
+    else:
+        # Fallback: if no preceding user message is found (should not happen in
+        # normal flow), use the latest user message in the session.
         user_msg_db_entry = (
             HistoryMessage.query.filter_by(
                 history_id=bot_msg_db_entry.history_id, is_user=True
@@ -167,50 +525,102 @@ def get_bot_reply(bot_message_id):
         )
         if not user_msg_db_entry:
             # Still no user message, update bot message to error and return
-            bot_msg_db_entry.message = "Error: Could not find user message context."
-            bot_msg_db_entry.is_pending = False
-            db.session.commit()
-            return render_template(
-                "components/bot_reply_content.html",
-                bot_message=bot_msg_db_entry.message,
+            _finish_bot_message(
+                bot_msg_db_entry, "Error: Could not find user message context."
             )
+            return None
+        history_messages = []
+
+    # Older turns that do not fit the history budget are folded into the summary
+    overflow, history_messages = split_history(history_messages)
+    if overflow:
+        update_summary(history, overflow)
+
+    return user_msg_db_entry.message, history_messages, history.summary
 
-    user_message_text = user_msg_db_entry.message
 
-    # Step 0: Gather history messages
-    history_messages = None
-    if bot_msg_db_entry.history_id:
-        # Fetch all messages in the session
-        history_messages = (
-            HistoryMessage.query.filter_by(history_id=user_msg_db_entry.history_id)
-            .order_by(HistoryMessage.id.asc())
-            .all()
+def update_summary(history, overflow):
+    """Fold ``overflow`` turns into ``history.summary`` with one completion call."""
+    if openai_client is None:
+        return
+    try:
+        with stage("summary"):
+            response = openai_client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=summary_request(history.summary, overflow),
+                max_tokens=SUMMARY_TOKEN_BUDGET,
+            )
+        record_usage(CHAT_MODEL, response)
+        history.summary = response.choices[0].message.content.strip()
+    except Exception:
+        # Keep the previous summary; the overflow is retried on the next turn
+        logger.exception("Summary update failed for history %s", history.id)
+        return
+    history.summary_through_id = overflow[-1].id
+    db.session.commit()
+
+
+def lexical_search(text, top_k=RETRIEVAL_TOP_K):
+    if lexical_index is None:
+        return []
+    with stage("lexical_query"):
+        return lexical_index.search(text, top_k=top_k)
+
+
+def vector_query(embedding, top_k, metadata_filter=""):
+    """Nearest vectors with metadata, limited to rows matching ``metadata_filter``.
+
+    The filter uses Upstash syntax, which the local store also evaluates.
+    """
+    options = {"filter": metadata_filter} if metadata_filter else {}
+    with stage("vector_query"):
+        return upstash_index.query(
+            vector=embedding, top_k=top_k, include_metadata=True, **options
         )
 
-    # Step 1: Create vector embedding for the user message
-    embedding = None
-    if history_messages is None:
-        # If no history messages, just use the user message
-        embedding = embed_texts([user_message_text])[0]
-    else:
-        # If there are history messages, concatenate them with the user message
-        history_texts = [msg.message for msg in history_messages if msg.is_user]
-        combined_text = "\n".join(history_texts) + "\n" + user_message_text
-        # Create vector embedding for the combined text
-        embedding = embed_texts([combined_text])[0]
-
-    # Step 2: Query top 10 most similar vectors
-    knowledge = []
-    results = upstash_index.query(
-        vector=embedding,
-        top_k=10,
-        include_metadata=True,
-    )
+
+def paper_hits(results, limit=RETRIEVAL_TOP_K):
+    """Best-first {paper id: Candidate} from vector ``results``, one entry per paper.
+
+    Abstracts and article chunks carry their paper id in the metadata; only
+    the best-scoring hit of each paper is kept.
+    """
+    papers = {}
     for result in results:
-        if result.metadata and "abstract" in result.metadata:
-            knowledge.append(result.metadata["abstract"])
+        metadata = result.metadata or {}
+        text = metadata.get("text", metadata.get("abstract"))
+        if text is None:
+            continue
+        paper = metadata.get("paper", result.id)
+        if paper not in papers:
+            papers[paper] = Candidate(paper, text, getattr(result, "score", None))
+            if len(papers) == limit:
+                break
+    return papers
+
+
+def knowledge_from_results(results, lexical_hits=(), question=None):
+    """Paper texts from vector ``results``, fused with BM25 ``lexical_hits`` by rank.
 
-    # Step 3: Ask OpenAI for a response
+    With re-ranking enabled and a ``question`` given, the fused candidates
+    are re-ordered by the reranker before the top ones fill the budget.
+    """
+    limit = retrieval_limit()
+    papers = paper_hits(results, limit)
+    if lexical_hits:
+        dense_ids = list(papers)
+        for hit in lexical_hits:
+            papers.setdefault(hit.id, Candidate(hit.id, hit.text))
+        fused = reciprocal_rank_fusion([dense_ids, [hit.id for hit in lexical_hits]])
+        papers = {doc_id: papers[doc_id] for doc_id, _ in fused[:limit]}
+    candidates = list(papers.values())
+    if question is not None and app.config["RERANK_ENABLED"]:
+        with stage("rerank"):
+            candidates = get_reranker().rerank(question, candidates, RETRIEVAL_TOP_K)
+    return select_knowledge([candidate.text for candidate in candidates[:RETRIEVAL_TOP_K]])
+
+
+def build_chat_messages(user_message_text, history_messages, knowledge, summary=None):
     knowledge_str = "\n".join(knowledge)
     instructions = (
         "You are a helpful assistant that helps people answer question about Arxiv papers and journals\n"
@@ -223,7 +633,11 @@ def get_bot_reply(bot_message_id):
         "4. If the user asks a question that is not related to the provided knowledge, say 'I don't know'."
     )
 
-    if history_messages is not None:
+    if summary:
+        instructions += "\n\n\n"
+        instructions += f"EARLIER CONVERSATION SUMMARY\n{summary}"
+
+    if history_messages:
         instructions += "\n\n\n"
         instructions += "CHAT HISTORIES\n"
         # If there are history messages, include them in the instructions
@@ -233,64 +647,542 @@ def get_bot_reply(bot_message_id):
             else:
                 instructions += f"\nAssistant: {message.message}\n"
 
-    try:
+    return [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": user_message_text},
+    ]
+
+
+def build_reply_messages(bot_msg_db_entry):
+    """Run retrieval for a pending bot message.
+
+    Returns (messages, answer_key), where ``answer_key`` is passed to
+    remember_answer once the reply is generated; it is None when the
+    question depends on chat history and must not be cached. Returns None
+    after recording a reply on ``bot_msg_db_entry`` when no completion is
+    needed: on errors, or when a cached answer was found.
+    """
+    # Ensure openai_client is initialized - MOVED THIS CHECK TO THE BEGINNING
+    if openai_client is None:
+        # This case should ideally be handled by ensuring initialization at app start
+        # or redirecting to initialization page if keys are missing.
+        # For now, returning an error message.
+        _finish_bot_message(bot_msg_db_entry, "Error: OpenAI client not initialized.")
+        return None
+
+    context = load_reply_context(bot_msg_db_entry)
+    if context is None:
+        return None
+    user_message_text, history_messages, summary = context
+
+    # Step 1: Create vector embedding for the user message. Identical questions
+    # in flight at the same time share the embedding and retrieval calls
+    query_text = retrieval_text(user_message_text, history_messages)
+    query_key = normalize_query(query_text)
+    embedding = coalesce("embed", query_key, lambda: embed_texts([query_text])[0])
+
+    # Step 2: Query the top 10 most similar papers, plus the top 10 BM25 matches
+    # (over-fetched when re-ranking)
+    results, lexical_hits = coalesce(
+        "retrieval",
+        (query_key, normalize_query(user_message_text), retrieval_fetch_k(), retrieval_limit()),
+        lambda: (
+            vector_query(embedding, retrieval_fetch_k()),
+            lexical_search(user_message_text, retrieval_limit()),
+        ),
+    )
+
+    # Standalone questions can be answered from the semantic answer cache, as
+    # long as they still retrieve the papers the cached answer was built from
+    standalone = not history_messages and not summary
+    answer_key = (embedding, list(paper_hits(results))) if standalone else None
+    if standalone:
+        cached = get_answer_cache().lookup(*answer_key)
+        if cached is not None:
+            _finish_bot_message(bot_msg_db_entry, cached[0])
+            return None
+
+    # Step 3: Build the prompt for OpenAI
+    with stage("prompt"):
+        messages = build_chat_messages(
+            user_message_text,
+            history_messages,
+            knowledge_from_results(results, lexical_hits, user_message_text),
+            summary,
+        )
+    return messages, answer_key
+
+
+def complete_reply(messages):
+    if app.config["SINGLE_FLIGHT_COMPLETIONS"]:
+        key = json.dumps(messages, sort_keys=True)
+        return coalesce("completion", key, lambda: _complete_reply_uncoalesced(messages))
+    return _complete_reply_uncoalesced(messages)
+
+
+def _complete_reply_uncoalesced(messages):
+    with stage("completion"):
         response = openai_client.chat.completions.create(  # Assuming standard OpenAI client v1.x
-            model="gpt-3.5-turbo",  # Ensure this model is appropriate
-            messages=[
-                {"role": "system", "content": instructions},
-                {"role": "user", "content": user_message_text},
-            ],
+            model=CHAT_MODEL,
+            messages=messages,
+        )
+    record_usage(CHAT_MODEL, response)
+    return response.choices[0].message.content.strip()
+
+
+def retrieve_many(embeddings, top_k, metadata_filter=""):
+    """``vector_query`` for many embeddings, ``BATCH_QUERY_SIZE`` per round trip."""
+    options = {"filter": metadata_filter} if metadata_filter else {}
+    results = []
+    for start in range(0, len(embeddings), BATCH_QUERY_SIZE):
+        queries = [
+            {"vector": embedding, "top_k": top_k, "include_metadata": True, **options}
+            for embedding in embeddings[start : start + BATCH_QUERY_SIZE]
+        ]
+        with stage("vector_query"):
+            results.extend(upstash_index.query_many(queries=queries))
+    return results
+
+
+def answer_questions(questions, concurrency=DEFAULT_BATCH_CONCURRENCY, metadata_filter=""):
+    """Answer standalone ``questions`` in bulk, returning an iterator of results.
+
+    Questions are embedded ``BATCH_EMBED_SIZE`` at a time and retrieved
+    together with ``retrieve_many`` before this returns, so a failure there
+    raises here. Prompts and completions then run ``concurrency`` at a time
+    and results are yielded as they finish, tagged with their ``index``; a
+    question whose prompt or completion fails gets an ``error`` instead of
+    an ``answer``. The answer cache is bypassed so every answer is generated.
+    Timings are in milliseconds; the embed and retrieval timings are for the
+    whole batch, which every question shares.
+    """
+    started = time.perf_counter()
+    embeddings = []
+    for start in range(0, len(questions), BATCH_EMBED_SIZE):
+        embeddings.extend(embed_texts(questions[start : start + BATCH_EMBED_SIZE]))
+    embedded = time.perf_counter()
+    results = retrieve_many(embeddings, retrieval_fetch_k(), metadata_filter)
+    retrieved = time.perf_counter()
+    batch_timings = {
+        "embed_batch_ms": (embedded - started) * 1000,
+        "retrieval_batch_ms": (retrieved - embedded) * 1000,
+    }
+
+    def answer(index):
+        question = questions[index]
+        item_started = time.perf_counter()
+        answer_text = error = None
+        completion_started = None
+        try:
+            with stage("prompt"):
+                messages = build_chat_messages(
+                    question,
+                    [],
+                    knowledge_from_results(
+                        results[index], lexical_search(question, retrieval_limit()), question
+                    ),
+                )
+            completion_started = time.perf_counter()
+            answer_text = complete_reply(messages)
+        except Exception as exc:
+            logger.exception("Batch answer failed for question %d", index)
+            error = str(exc)
+        finished = time.perf_counter()
+        completion_started = completion_started or finished
+        return {
+            "index": index,
+            "question": question,
+            "answer": answer_text,
+            "error": error,
+            "papers": list(paper_hits(results[index])),
+            "timings": {
+                **batch_timings,
+                "prompt_ms": (completion_started - item_started) * 1000,
+                "completion_ms": (finished - completion_started) * 1000,
+                "elapsed_ms": (finished - started) * 1000,
+            },
+        }
+
+    def generate():
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            futures = [pool.submit(answer, index) for index in range(len(questions))]
+            for future in as_completed(futures):
+                yield future.result()
+
+    return generate()
+
+
+def run_reply_job(message_id, final_attempt):
+    """Generate a queued reply; runs in a ReplyWorkerPool thread.
+
+    Errors propagate so the job is retried, except on the final attempt,
+    which records the error reply.
+    """
+    bot_msg_db_entry = db.session.get(HistoryMessage, message_id)
+    answer_key = None
+    try:
+        prepared = build_reply_messages(bot_msg_db_entry)
+        if prepared is None:
+            return
+        messages, answer_key = prepared
+        bot_reply_text = complete_reply(messages)
+    except Exception:
+        if not final_attempt:
+            raise
+        logger.exception("Reply job for message %s failed on its final attempt", message_id)
+        db.session.rollback()
+        bot_reply_text = COMPLETION_ERROR_MESSAGE
+    _finish_bot_message(bot_msg_db_entry, bot_reply_text)
+    remember_answer(answer_key, bot_reply_text)
+
+
+@app.route("/api/v1/get-bot-reply/<int:bot_message_id>", methods=["GET"])
+def get_bot_reply(bot_message_id):
+    bot_msg_db_entry = HistoryMessage.query.get_or_404(bot_message_id)
+    if not bot_msg_db_entry.is_pending:  # Check if already processed
+        return render_template(
+            "components/bot_reply_content.html", bot_message=bot_msg_db_entry.message
         )
-        bot_reply_text = response.choices[0].message.content.strip()
-    except Exception as e:
-        # Log the error e
-        bot_reply_text = "Sorry, I encountered an error while generating a response."
+
+    # Only the holder of the lease generates; retries and other tabs poll
+    owner = new_owner()
+    if not claim(bot_message_id, owner, app.config["REPLY_LEASE_SECONDS"]):
+        return render_pending_reply(bot_message_id), 202
+
+    try:
+        prepared = build_reply_messages(bot_msg_db_entry)
+    except Exception:
+        release(bot_message_id, owner)
+        raise
+    if prepared is None:
+        complete(bot_message_id, owner)
+        return render_template(
+            "components/bot_reply_content.html", bot_message=bot_msg_db_entry.message
+        )
+    messages, answer_key = prepared
+
+    try:
+        bot_reply_text = complete_reply(messages)
+    except Exception:
+        logger.exception("Completion failed for message %s", bot_message_id)
+        bot_reply_text = COMPLETION_ERROR_MESSAGE
 
     # Update the bot message in DB
-    bot_msg_db_entry.message = bot_reply_text
-    bot_msg_db_entry.is_pending = False
-    db.session.commit()
+    _finish_bot_message(bot_msg_db_entry, bot_reply_text)
+    complete(bot_message_id, owner)
+    remember_answer(answer_key, bot_reply_text)
 
     return render_template(
         "components/bot_reply_content.html", bot_message=bot_reply_text
     )
 
 
-@app.route("/initialize", methods=["POST"])
-def initialize():
+@app.route("/api/v1/bot-reply/<int:bot_message_id>", methods=["GET"])
+def bot_reply_result(bot_message_id):
+    """The reply once it is ready; 202 with a polling placeholder until then."""
+    bot_msg_db_entry = HistoryMessage.query.get_or_404(bot_message_id)
+    if bot_msg_db_entry.is_pending:
+        return render_pending_reply(bot_message_id), 202
+    return render_template(
+        "components/bot_reply_content.html", bot_message=bot_msg_db_entry.message
+    )
+
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+@app.route("/api/v1/stream-bot-reply/<int:bot_message_id>", methods=["GET"])
+def stream_bot_reply(bot_message_id):
+    """Server-sent events: one "delta" per completion chunk, then "done".
+
+    The reply is written to the database once, when the stream finishes.
+    If the client disconnects first, the rest of the completion is still
+    read and saved, since history pages show stored replies without polling.
+    """
+    bot_msg_db_entry = HistoryMessage.query.get_or_404(bot_message_id)
+
+    def render_reply(text):
+        return render_template("components/bot_reply_content.html", bot_message=text)
+
+    prepared = None
+    owner = new_owner()
+    if bot_msg_db_entry.is_pending and claim(
+        bot_message_id, owner, app.config["REPLY_LEASE_SECONDS"]
+    ):
+        try:
+            prepared = build_reply_messages(bot_msg_db_entry)
+        except Exception:
+            release(bot_message_id, owner)
+            raise
+        if prepared is None:
+            complete(bot_message_id, owner)
+    if prepared is None:
+        # Already processed, answered from cache, failed before completion,
+        # or being generated under someone else's lease
+        if bot_msg_db_entry.is_pending:
+            finished_html = render_pending_reply(bot_message_id)
+        else:
+            finished_html = render_reply(bot_msg_db_entry.message)
+
+    def generate():
+        if prepared is None:
+            yield _sse_event("done", {"html": finished_html})
+            return
+
+        parts = []
+        stream = None
+        client_gone = False
+        # Timed by hand: a span held across yields would count a client
+        # disconnect as a completion error
+        started = time.perf_counter()
+        try:
+            stream = openai_client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=prepared[0],
+                stream=True,
+            )
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    if not parts:
+                        STAGE_SECONDS.observe(time.perf_counter() - started, "first_token")
+                    parts.append(delta)
+                    if not client_gone:
+                        try:
+                            yield _sse_event("delta", {"text": delta})
+                        except GeneratorExit:
+                            # No more yields; keep reading so the reply is saved
+                            client_gone = True
+            bot_reply_text = "".join(parts).strip()
+            STAGE_SECONDS.observe(time.perf_counter() - started, "completion")
+        except Exception:
+            STAGE_ERRORS.inc("completion")
+            logger.exception("Streamed completion failed for message %s", bot_message_id)
+            bot_reply_text = COMPLETION_ERROR_MESSAGE
+        finally:
+            if stream is not None and hasattr(stream, "close"):
+                stream.close()
+
+        # Re-load the row: the view's session may be gone once streaming starts
+        _finish_bot_message(db.session.get(HistoryMessage, bot_message_id), bot_reply_text)
+        complete(bot_message_id, owner)
+        remember_answer(prepared[1], bot_reply_text)
+        if not client_gone:
+            yield _sse_event("done", {"html": render_reply(bot_reply_text)})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def clients_configured():
+    needs_upstash_token = app.config["VECTOR_STORE"] != "local"
+    return app.config["OPENAI_API_KEY"] is not None and (
+        not needs_upstash_token or app.config["UPSTASH_TOKEN"] is not None
+    )
+
+
+def init_clients(lazy=False):
+    """Create the OpenAI client and vector index from the configured keys.
+
+    With ``lazy``, each client is built, and its library imported, on first
+    use, which keeps them off the path to the first page a new server serves.
+    """
     global openai_client
     global upstash_index
+    global lexical_index
 
-    app.config["OPENAI_API_KEY"] = request.form.get("openai_api_key")
-    app.config["UPSTASH_TOKEN"] = request.form.get("upstash_token")
+    def build(factory):
+        return LazyClient(factory) if lazy else factory()
 
-    # Initialize OpenAI client with user-provided API key
-    openai_api_key = request.form.get("openai_api_key")
-    openai_client = OpenAI(api_key=openai_api_key)
+    openai_client = build(lambda: OpenAI(api_key=app.config["OPENAI_API_KEY"]))
 
-    # Initialize Upstash index with user-provided token
-    upstash_token = request.form.get("upstash_token")
-    upstash_index = Index(
-        url="https://capable-midge-9649-eu1-vector.upstash.io",
-        token=upstash_token,
-    )
+    if app.config["VECTOR_STORE"] == "local":
+        upstash_index = build(
+            lambda: LocalVectorStore(
+                app.config["LOCAL_VECTOR_STORE_PATH"],
+                nprobe=app.config["LOCAL_VECTOR_STORE_NPROBE"],
+                rerank=app.config["LOCAL_VECTOR_STORE_RERANK"],
+            )
+        )
+    else:
+        upstash_index = build(
+            lambda: Index(
+                url=UPSTASH_URL,
+                token=app.config["UPSTASH_TOKEN"],
+            )
+        )
+    lexical_index = BM25Index.load(app.config["LEXICAL_INDEX_PATH"])
+
+
+def init_worker():
+    """Per-process setup for a server worker forked from a preloaded app.
+
+    Database connections, HTTP clients and threads do not survive a fork,
+    so each worker opens its own instead of inheriting the parent's.
+    """
+    global openai_client, upstash_index, lexical_index, embedding_cache, reply_workers
+    global single_flight
+    with app.app_context():
+        db.engine.dispose(close=False)  # Leave the parent's connections to the parent
+    openai_client = upstash_index = lexical_index = embedding_cache = reply_workers = None
+    single_flight = None
+    if clients_configured():
+        init_clients(lazy=True)
+        start_reply_workers()
+
+
+def shutdown_worker(timeout=None):
+    """Stop claiming reply jobs; a job cut short is retried once its lease expires."""
+    global reply_workers
+    if reply_workers is not None:
+        reply_workers.stop(timeout)
+        reply_workers = None
+
+
+@app.route("/initialize", methods=["POST"])
+def initialize():
+    app.config["OPENAI_API_KEY"] = request.form.get("openai_api_key")
+    app.config["UPSTASH_TOKEN"] = request.form.get("upstash_token")
+    init_clients()
+    # Answers retrieved from the previous index may no longer apply
+    get_answer_cache().clear()
+    start_reply_workers()
 
     return redirect(url_for("index"))
 
 
 @app.route("/")
 def index():
-    if app.config["OPENAI_API_KEY"] is None or app.config["UPSTASH_TOKEN"] is None:
-        return render_template("initialization.html")
-    sessions = History.query.order_by(History.id.desc()).all()
-    return render_template("index.html", sessions=sessions)
+    if not clients_configured():
+        return render_template(
+            "initialization.html",
+            needs_upstash_token=app.config["VECTOR_STORE"] != "local",
+        )
+    sessions, next_before = sidebar_page()
+    return render_template("index.html", sessions=sessions, next_before=next_before)
+
+
+@app.route("/api/v1/cache-stats")
+def cache_stats():
+    return {
+        "embedding_cache": get_embedding_cache().stats(),
+        "answer_cache": get_answer_cache().stats(),
+        "single_flight": get_single_flight().stats(),
+    }
+
+
+@app.route("/api/v1/search")
+def search():
+    """Papers closest to ``q``, restricted by an optional metadata ``filter``.
+
+    e.g. ``?q=graph+neural+networks&filter=category = 'cs.LG' AND year > 2020``
+    """
+    question = request.args.get("q", "").strip()
+    metadata_filter = request.args.get("filter", "").strip()
+    top_k = max(1, min(request.args.get("top_k", RETRIEVAL_TOP_K, type=int), MAX_SEARCH_TOP_K))
+    if not question:
+        return {"error": "Missing query parameter q"}, 400
+    if openai_client is None:
+        return {"error": "OpenAI client not initialized."}, 503
+    try:
+        if metadata_filter:
+            parse_filter(metadata_filter)
+        embedding = embed_texts([question])[0]
+        # Chunks of one paper collapse into one result, so over-fetch
+        results = vector_query(embedding, top_k * 3, metadata_filter)
+    except ValueError as error:  # Bad syntax, or a field the local store does not index
+        return {"error": str(error)}, 400
+
+    papers = {}
+    for result in results:
+        metadata = result.metadata or {}
+        paper = metadata.get("paper", result.id)
+        if paper in papers:
+            continue
+        papers[paper] = {
+            "paper": paper,
+            "id": result.id,
+            "score": result.score,
+            "text": metadata.get("text", metadata.get("abstract")),
+            **{
+                key: metadata[key]
+                for key in ("title",) + DEFAULT_ATTRIBUTE_FIELDS
+                if key in metadata
+            },
+        }
+        if len(papers) == top_k:
+            break
+    return {"query": question, "filter": metadata_filter, "results": list(papers.values())}
+
+
+@app.route("/api/v1/batch-answer", methods=["POST"])
+def batch_answer():
+    """Answer a JSON list of ``questions``, streamed back as JSON lines.
+
+    Body: ``{"questions": [...], "filter": "...", "concurrency": 8}``; see
+    answer_questions for the fields of each line.
+    """
+    payload = request.get_json(silent=True) or {}
+    questions = payload.get("questions")
+    if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+        return {"error": "Expected a JSON body with a list of questions"}, 400
+    if len(questions) > MAX_BATCH_QUESTIONS:
+        return {"error": f"At most {MAX_BATCH_QUESTIONS} questions per request"}, 413
+    if openai_client is None:
+        return {"error": "OpenAI client not initialized."}, 503
+    if upstash_index is None:
+        return {"error": "Vector index not initialized."}, 503
+    metadata_filter = payload.get("filter") or ""
+    try:
+        if metadata_filter:
+            parse_filter(metadata_filter)
+        concurrency = int(payload.get("concurrency", DEFAULT_BATCH_CONCURRENCY))
+    except (TypeError, ValueError) as error:
+        return {"error": str(error)}, 400
+    # Embedding and retrieval run before the stream starts, so their errors get a status
+    try:
+        results = answer_questions(questions, concurrency, metadata_filter)
+    except ValueError as error:  # A field the local store does not index
+        return {"error": str(error)}, 400
+    except Exception as error:
+        logger.exception("Batch embedding or retrieval failed")
+        return {"error": str(error)}, 502
+
+    def generate():
+        for result in results:
+            yield json.dumps(result) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+@app.route("/metrics")
+def metrics():
+    caches = {}
+    for name, stats in (
+        ("embedding", get_embedding_cache().stats()),
+        ("answer", get_answer_cache().stats()),
+    ):
+        hits = stats.get("hits", stats.get("memory_hits", 0) + stats.get("disk_hits", 0))
+        caches[name] = {"hits": hits, "misses": stats["misses"], "hit_rate": stats["hit_rate"]}
+    return Response(render_metrics(caches), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/sidebar")
 def get_sidebar():
-    sessions = History.query.order_by(History.id.desc()).all()
-    return render_template("components/sidebar.html", sessions=sessions)
+    sessions, next_before = sidebar_page(_before_arg())
+    return render_template(
+        "components/sidebar.html", sessions=sessions, next_before=next_before
+    )
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080, debug=True, use_reloader=True)
+    # Development server; production runs serve.py
+    debug = os.getenv("FLASK_DEBUG", "0") == "1"
+    if clients_configured():
+        init_clients(lazy=True)
+        start_reply_workers()
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 8080)), debug=debug, use_reloader=debug)
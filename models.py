@@ -1,4 +1,7 @@
+import hashlib
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 
 db = SQLAlchemy()
 
@@ -6,9 +9,18 @@ db = SQLAlchemy()
 class History(db.Model):
     id: int = db.Column(db.Integer, primary_key=True)
     title: str = db.Column(db.String(200), nullable=False)
+    # Rolling summary of the turns up to summary_through_id (a HistoryMessage id)
+    summary: str = db.Column(db.Text, nullable=True)
+    summary_through_id: int = db.Column(db.Integer, nullable=True)
 
 
 class HistoryMessage(db.Model):
+    __table_args__ = (
+        # Session pages and reply context scan one session in id order
+        db.Index("ix_history_message_history_id_id", "history_id", "id"),
+        db.Index("ix_history_message_history_id_is_user_id", "history_id", "is_user", "id"),
+    )
+
     id: int = db.Column(db.Integer, primary_key=True)
     history_id: int = db.Column(db.Integer, db.ForeignKey("history.id"), nullable=False)
     message: str = db.Column(db.Text, nullable=False)
@@ -16,3 +28,90 @@ class HistoryMessage(db.Model):
     is_system: bool = db.Column(db.Boolean, default=False)
     is_pending: bool = db.Column(db.Boolean, default=False, nullable=False)
     history = db.relationship("History", backref=db.backref("messages", lazy=True))
+
+
+class ReplyJob(db.Model):
+    """Generation job for a pending bot message; one per message, so retries dedupe."""
+
+    __table_args__ = (
+        # Workers look for the oldest runnable job
+        db.Index("ix_reply_job_status_available_at", "status", "available_at"),
+    )
+
+    message_id: int = db.Column(
+        db.Integer, db.ForeignKey("history_message.id"), primary_key=True
+    )
+    status: str = db.Column(db.String(16), nullable=False)
+    attempts: int = db.Column(db.Integer, nullable=False, default=0)
+    # Unix time before which a queued job is not retried
+    available_at: float = db.Column(db.Float, nullable=False)
+    lease_owner: str = db.Column(db.String(128), nullable=True)
+    lease_expires_at: float = db.Column(db.Float, nullable=True)
+    last_error: str = db.Column(db.Text, nullable=True)
+
+
+def configure_sqlite(engine, journal_mode="WAL", synchronous="NORMAL"):
+    """Apply journal and sync pragmas to every new pooled SQLite connection."""
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+        cursor.execute(f"PRAGMA synchronous={synchronous}")
+        cursor.close()
+
+
+# Columns added after the first release; create_all() does not alter existing tables
+ADDED_COLUMNS = {
+    "history": {"summary": "TEXT", "summary_through_id": "INTEGER"},
+}
+
+
+def upgrade_schema():
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {column["name"] for column in inspector.get_columns(table)}
+            for name, column_type in columns.items():
+                if name not in existing:
+                    connection.execute(
+                        db.text(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+                    )
+        # Indexes added to tables that already existed
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+def schema_version():
+    """31-bit fingerprint of the declared tables, columns and indexes."""
+    parts = []
+    for table in db.metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend(f"{column.name} {column.type}" for column in table.columns)
+        parts.extend(sorted(index.name for index in table.indexes))
+    digest = hashlib.sha256("\n".join(parts).encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") & 0x7FFFFFFF
+
+
+def ensure_schema():
+    """Create and upgrade the schema unless the database is stamped as current.
+
+    SQLite keeps the stamp in ``PRAGMA user_version``, so a restart against
+    an up-to-date database costs one pragma read instead of reflecting every
+    table. Other databases are always checked. Returns True if it ran.
+    """
+    version = schema_version()
+    stamped = db.engine.dialect.name == "sqlite"
+    if stamped:
+        with db.engine.connect() as connection:
+            if connection.exec_driver_sql("PRAGMA user_version").scalar() == version:
+                return False
+    db.create_all()
+    upgrade_schema()
+    if stamped:
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql(f"PRAGMA user_version = {version}")
+    return True
@@ -0,0 +1,111 @@
+import tiktoken
+
+# =====================================================
+# Token budgets
+# =====================================================
+KNOWLEDGE_TOKEN_BUDGET = 2000  # Retrieved abstracts in the system prompt
+HISTORY_TOKEN_BUDGET = 1000  # Verbatim recent turns in the system prompt
+SUMMARY_TOKEN_BUDGET = 300  # Rolling summary of older turns
+EMBED_WINDOW_TURNS = 3  # Previous user turns included in the retrieval query
+EMBED_TOKEN_BUDGET = 512
+MESSAGE_OVERHEAD_TOKENS = 4  # Role label and separators around each turn
+
+_encoding = None  # Lazily loaded tiktoken encoding
+
+
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        # Shared by gpt-3.5-turbo and text-embedding-3-small
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding
+
+
+def count_tokens(text):
+    return len(get_encoding().encode(text))
+
+
+def truncate_to_tokens(text, max_tokens, keep_end=False):
+    """Cut ``text`` to ``max_tokens``, keeping the start (or the end with ``keep_end``)."""
+    tokens = get_encoding().encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    kept = tokens[-max_tokens:] if keep_end else tokens[:max_tokens]
+    return get_encoding().decode(kept)
+
+
+def message_tokens(message):
+    return count_tokens(message.message) + MESSAGE_OVERHEAD_TOKENS
+
+
+# =====================================================
+# Prompt sections
+# =====================================================
+def select_knowledge(abstracts, budget=KNOWLEDGE_TOKEN_BUDGET):
+    """Keep abstracts in rank order until ``budget`` is spent, truncating the last."""
+    selected = []
+    for abstract in abstracts:
+        if budget <= 0:
+            break
+        abstract = truncate_to_tokens(abstract, budget)
+        selected.append(abstract)
+        budget -= count_tokens(abstract) + 1
+    return selected
+
+
+def split_history(messages, budget=HISTORY_TOKEN_BUDGET):
+    """Split turns into (overflow, recent) so ``recent`` fits in ``budget``.
+
+    When the turns do not fit, ``recent`` is trimmed to half the budget so
+    the overflow is folded into the summary in chunks rather than one turn
+    at a time.
+    """
+    costs = [message_tokens(message) for message in messages]
+    if sum(costs) <= budget:
+        return [], list(messages)
+    keep, used = 0, 0
+    for cost in reversed(costs):
+        if used + cost > budget // 2:
+            break
+        used += cost
+        keep += 1
+    split = len(messages) - keep
+    return list(messages[:split]), list(messages[split:])
+
+
+def retrieval_text(user_message_text, history_messages, max_turns=EMBED_WINDOW_TURNS):
+    """Embedding input: the last few user turns plus the new message, bounded in tokens."""
+    if not history_messages:
+        return truncate_to_tokens(user_message_text, EMBED_TOKEN_BUDGET)
+    history_texts = [msg.message for msg in history_messages if msg.is_user]
+    window = history_texts[-max_turns:] if max_turns else []
+    text = "\n".join(window + [user_message_text])
+    # Drop the oldest tokens first; the new message matters most
+    return truncate_to_tokens(text, EMBED_TOKEN_BUDGET, keep_end=True)
+
+
+def summary_request(previous_summary, messages):
+    """Chat messages asking the model to fold ``messages`` into the running summary."""
+    transcript = "\n".join(
+        f"{'User' if message.is_user else 'Assistant'}: {message.message}"
+        for message in messages
+    )
+    return [
+        {
+            "role": "system",
+            "content": (
+                "Summarize the conversation between a user and an assistant about "
+                "Arxiv papers. Keep the topics, papers and facts needed to follow up "
+                f"on it, in at most {SUMMARY_TOKEN_BUDGET} tokens."
+            ),
+        },
+        {
+            "role": "user",
+            "content": (
+                f"Summary so far:\n{previous_summary or '(none)'}\n\n"
+                f"New turns:\n{transcript}"
+            ),
+        },
+    ]
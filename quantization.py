@@ -0,0 +1,194 @@
+import numpy as np
+
+# =====================================================
+# Configuration
+# =====================================================
+STORAGE_KINDS = ("float32", "float16", "int8", "pq")
+PQ_CENTROIDS = 256  # One byte per sub-vector code
+PQ_SUBVECTOR_DIMS = 8  # 1536 dims -> 192 bytes per vector
+PQ_KMEANS_ITERATIONS = 15
+
+
+class Float16Codec:
+    """Half-precision copy of each vector: 2 bytes per dimension.
+
+    Every codec exposes the same small interface: ``train`` on a sample,
+    ``encode`` vectors into fixed-width codes, ``prepare`` a query once and
+    ``score`` blocks of codes against it with approximate dot products.
+    """
+
+    kind = "float16"
+    dtype = np.float16
+
+    def __init__(self, dim):
+        self.dim = dim
+
+    @property
+    def code_width(self):
+        return self.dim
+
+    def train(self, sample):
+        return self
+
+    def encode(self, vectors):
+        return np.asarray(vectors, dtype=np.float16)
+
+    def prepare(self, query):
+        return query
+
+    def score(self, codes, prepared):
+        return np.asarray(codes, dtype=np.float32) @ prepared
+
+    def params(self):
+        return {"dim": np.array(self.dim)}
+
+    @classmethod
+    def from_params(cls, params):
+        return cls(int(params["dim"]))
+
+
+class Int8Codec:
+    """Per-dimension scalar quantization to 256 levels: 1 byte per dimension."""
+
+    kind = "int8"
+    dtype = np.uint8
+
+    def __init__(self, dim, low=None, scale=None):
+        self.dim = dim
+        self.low = low
+        self.scale = scale
+
+    @property
+    def code_width(self):
+        return self.dim
+
+    def train(self, sample):
+        sample = np.asarray(sample, dtype=np.float32)
+        self.low = sample.min(axis=0)
+        high = sample.max(axis=0)
+        self.scale = np.maximum(high - self.low, 1e-12) / 255.0
+        return self
+
+    def encode(self, vectors):
+        levels = (np.asarray(vectors, dtype=np.float32) - self.low) / self.scale
+        return np.clip(np.rint(levels), 0, 255).astype(np.uint8)
+
+    def prepare(self, query):
+        # x ~= low + scale * code, so x . q = code . (scale * q) + low . q
+        return (self.scale * query).astype(np.float32), float(self.low @ query)
+
+    def score(self, codes, prepared):
+        scaled_query, offset = prepared
+        return np.asarray(codes, dtype=np.float32) @ scaled_query + offset
+
+    def params(self):
+        return {"dim": np.array(self.dim), "low": self.low, "scale": self.scale}
+
+    @classmethod
+    def from_params(cls, params):
+        return cls(int(params["dim"]), params["low"], params["scale"])
+
+
+def _kmeans(vectors, k, iterations, rng):
+    centroids = vectors[rng.choice(len(vectors), k, replace=len(vectors) < k)].copy()
+    for _ in range(iterations):
+        # Squared L2 distance without materializing the difference tensor
+        distances = (
+            (centroids**2).sum(axis=1)[None, :] - 2.0 * vectors @ centroids.T
+        )
+        labels = np.argmin(distances, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        counts = np.bincount(labels, minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+class ProductQuantizer:
+    """Product quantization with asymmetric distance computation (ADC).
+
+    Vectors are split into ``subspaces`` sub-vectors, each replaced by the
+    id of its nearest of 256 sub-centroids. At query time a (subspaces, 256)
+    lookup table of query/centroid dot products turns scoring a vector into
+    ``subspaces`` table lookups and adds.
+    """
+
+    kind = "pq"
+    dtype = np.uint8
+
+    def __init__(self, dim, subspaces=None, centroids=None):
+        subspaces = subspaces or max(1, dim // PQ_SUBVECTOR_DIMS)
+        if dim % subspaces:
+            raise ValueError(f"{dim} dimensions cannot be split into {subspaces} subspaces")
+        self.dim = dim
+        self.subspaces = subspaces
+        self.sub_dim = dim // subspaces
+        self.centroids = centroids  # (subspaces, 256, sub_dim)
+
+    @property
+    def code_width(self):
+        return self.subspaces
+
+    def _split(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors.reshape(len(vectors), self.subspaces, self.sub_dim)
+
+    def train(self, sample, seed=0):
+        rng = np.random.default_rng(seed)
+        parts = self._split(sample)
+        self.centroids = np.stack(
+            [
+                _kmeans(parts[:, m], PQ_CENTROIDS, PQ_KMEANS_ITERATIONS, rng)
+                for m in range(self.subspaces)
+            ]
+        ).astype(np.float32)
+        return self
+
+    def encode(self, vectors):
+        parts = self._split(vectors)
+        codes = np.empty((len(parts), self.subspaces), dtype=np.uint8)
+        for m in range(self.subspaces):
+            centroids = self.centroids[m]
+            distances = (centroids**2).sum(axis=1)[None, :] - 2.0 * parts[:, m] @ centroids.T
+            codes[:, m] = np.argmin(distances, axis=1)
+        return codes
+
+    def prepare(self, query):
+        # ADC lookup table: dot product of each query sub-vector with each centroid
+        return np.einsum(
+            "mkd,md->mk", self.centroids, query.reshape(self.subspaces, self.sub_dim)
+        ).astype(np.float32)
+
+    def score(self, codes, prepared):
+        codes = np.asarray(codes)
+        return prepared[np.arange(self.subspaces), codes].sum(axis=1)
+
+    def params(self):
+        return {
+            "dim": np.array(self.dim),
+            "subspaces": np.array(self.subspaces),
+            "centroids": self.centroids,
+        }
+
+    @classmethod
+    def from_params(cls, params):
+        return cls(int(params["dim"]), int(params["subspaces"]), params["centroids"])
+
+
+CODECS = {codec.kind: codec for codec in (Float16Codec, Int8Codec, ProductQuantizer)}
+
+
+def create_codec(kind, dim, **options):
+    if kind not in CODECS:
+        raise ValueError(f"Unknown storage kind {kind!r}; expected one of {STORAGE_KINDS}")
+    return CODECS[kind](dim, **options)
+
+
+def save_codec(path, codec):
+    np.savez(path, kind=np.array(codec.kind), **codec.params())
+
+
+def load_codec(path):
+    with np.load(path) as params:
+        return CODECS[str(params["kind"])].from_params(params)
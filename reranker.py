@@ -0,0 +1,104 @@
+import time
+from collections import Counter
+
+import numpy as np
+
+from lexical_index import tokenize, BM25_K1, BM25_B
+
+# =====================================================
+# Configuration
+# =====================================================
+DEFAULT_RERANK_CANDIDATES = 50  # Papers fetched per question before re-ranking
+DEFAULT_DEADLINE_MS = 30.0
+DEFAULT_DENSE_WEIGHT = 0.6  # Share of the vector similarity in the hybrid score
+BATCH_SIZE = 16  # Candidates tokenized between deadline checks
+
+
+class Candidate:
+    """A retrieved paper; ``dense_score`` is None when only BM25 found it."""
+
+    def __init__(self, id, text, dense_score=None):
+        self.id = id
+        self.text = text
+        self.dense_score = dense_score
+
+    def __repr__(self):
+        return f"Candidate(id={self.id!r}, dense_score={self.dense_score})"
+
+
+def _scale(scores):
+    # Divided by the maximum rather than min-max scaled: vector similarities
+    # of the candidates are close, and stretching their gaps to [0, 1] would
+    # drown the lexical signal
+    scores = np.maximum(scores, 0.0)
+    high = scores.max() if len(scores) else 0.0
+    return scores / high if high > 0 else scores
+
+
+class Reranker:
+    """Re-orders retrieval candidates with a lexical/embedding hybrid score.
+
+    The lexical part is BM25 of the question terms over the candidate texts,
+    with document frequencies taken from the candidates themselves. The
+    dense part is the similarity the vector store returned. Both are scaled
+    to a maximum of 1 and mixed by ``dense_weight``. If scoring has not
+    finished within ``deadline_ms``, the candidates are returned in their
+    original order.
+    """
+
+    def __init__(
+        self,
+        dense_weight=DEFAULT_DENSE_WEIGHT,
+        deadline_ms=DEFAULT_DEADLINE_MS,
+        batch_size=BATCH_SIZE,
+    ):
+        self.dense_weight = dense_weight
+        self.deadline_ms = deadline_ms
+        self.batch_size = batch_size
+        self.reranked = 0
+        self.fallbacks = 0
+
+    def rerank(self, question, candidates, top_k):
+        """The best ``top_k`` of ``candidates`` for ``question``, best first."""
+        deadline = time.perf_counter() + self.deadline_ms / 1000.0
+        scores = self._scores(question, candidates, deadline)
+        if scores is None:
+            self.fallbacks += 1
+            return candidates[:top_k]
+        self.reranked += 1
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        return [candidates[i] for i in order]
+
+    def stats(self):
+        return {"reranked": self.reranked, "fallbacks": self.fallbacks}
+
+    def _scores(self, question, candidates, deadline):
+        """Hybrid scores, or None once ``deadline`` has passed."""
+        terms = sorted(set(tokenize(question)))
+        n = len(candidates)
+        tfs = np.zeros((n, len(terms)), dtype=np.float32)
+        lengths = np.zeros(n, dtype=np.float32)
+        for start in range(0, n, self.batch_size):
+            if time.perf_counter() > deadline:
+                return None
+            for row in range(start, min(start + self.batch_size, n)):
+                tokens = tokenize(candidates[row].text)
+                counts = Counter(tokens)
+                tfs[row] = [counts[term] for term in terms]
+                lengths[row] = len(tokens)
+        if time.perf_counter() > deadline:
+            return None
+
+        df = (tfs > 0).sum(axis=0)
+        idf = np.log(1.0 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norms = BM25_K1 * (1.0 - BM25_B + BM25_B * lengths / max(lengths.mean(), 1.0))
+        lexical = (idf * tfs * (BM25_K1 + 1.0) / (tfs + norms[:, None])).sum(axis=1)
+
+        dense = np.array(
+            [np.nan if c.dense_score is None else c.dense_score for c in candidates],
+            dtype=np.float32,
+        )
+        found = ~np.isnan(dense)
+        # Lexical-only candidates rank as the weakest vector hit
+        dense[~found] = dense[found].min() if found.any() else 0.0
+        return self.dense_weight * _scale(dense) + (1.0 - self.dense_weight) * _scale(lexical)
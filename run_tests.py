@@ -3,6 +3,14 @@ from main import app, db, History, HistoryMessage # Import db and models
 from unittest.mock import patch, MagicMock # For mocking
 import main as main_module # To access main.py's global variables for assertions
 
+class WordEncoding:
+    """Stand-in for the tiktoken encoding (one token per word), which needs a download."""
+    def encode(self, text):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
 # Fixture to configure the app for testing and manage database per test
 @pytest.fixture(autouse=True) # autouse=True to apply to all tests
 def app_context_setup():
@@ -11,13 +19,22 @@ def app_context_setup():
         "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:", # Use in-memory SQLite for tests
         "OPENAI_API_KEY": None, 
         "UPSTASH_TOKEN": None,
-        "SERVER_NAME": "localhost.test" # For url_for if used outside request context
+        "SERVER_NAME": "localhost.test", # For url_for if used outside request context
+        "EMBEDDING_CACHE_PATH": None, # Keep the embedding cache in memory only
+        "VECTOR_STORE": "upstash",
+        "INDEX_GENERATION_PATH": None,
+        "ANSWER_CACHE_MAX_ENTRIES": 1000,
+        "RERANK_ENABLED": False,
     })
+    main_module.embedding_cache = None # Fresh embedding cache per test
+    main_module.answer_cache = None
+    main_module.reranker = None
 
     with app.app_context():
         db.create_all()
 
-    yield # Test runs here
+    with patch('prompt_builder.get_encoding', return_value=WordEncoding()):
+        yield # Test runs here
 
     with app.app_context():
         db.session.remove() # Clear session
@@ -57,6 +74,24 @@ def mock_main_upstash_index():
         mock_index_instance.query = mock_query
         yield mock_index_instance
 
+def _pending_bot_message(question="Question", history_id=None):
+    """Commit ``question`` (unless None) and a pending reply to it; returns the reply's id.
+
+    The messages go in a new session unless ``history_id`` is given.
+    """
+    with app.app_context():
+        if history_id is None:
+            history = History(title="Chat")
+            db.session.add(history)
+            db.session.flush()
+            history_id = history.id
+        if question is not None:
+            db.session.add(HistoryMessage(history_id=history_id, message=question, is_user=True))
+        bot_msg = HistoryMessage(history_id=history_id, message="Thinking...", is_user=False, is_pending=True)
+        db.session.add(bot_msg)
+        db.session.commit()
+        return bot_msg.id
+
 def test_initialize_route(client):
     """Test the /initialize route. Mocks OpenAI and Index constructors."""
     with patch('main.OpenAI') as MockOpenAIConstructor, \
@@ -314,6 +349,1464 @@ def test_get_bot_reply_main_openai_client_is_none(client, mock_main_upstash_inde
         assert updated_bot_msg.message == "Error: OpenAI client not initialized."
         assert updated_bot_msg.is_pending == False
 
+def test_vectorizer_token_batches_respect_budget():
+    """Token-budgeted batching never exceeds the per-request token budget."""
+    import vectorizer
+
+    records = [(f"arxiv_{i}", "word " * 30, {}) for i in range(10)]
+    with patch('vectorizer.count_tokens', side_effect=lambda text: len(text.split())):
+        batches = list(vectorizer.iter_token_batches(records, max_tokens=100, max_items=5))
+
+    assert [len(batch) for batch, _ in batches] == [3, 3, 3, 1]
+    assert all(tokens <= 100 for _, tokens in batches)
+    assert [r[0] for batch, _ in batches for r in batch] == [f"arxiv_{i}" for i in range(10)]
+
+def test_vectorizer_ingest_bulk_upserts():
+    """The ingestion pipeline embeds in batches and upserts in large chunks."""
+    import vectorizer
+
+    def fake_embeddings_create(model, input):
+        response = MagicMock()
+        response.data = [MagicMock(embedding=[float(len(text))]) for text in input]
+        return response
+
+    records = [(f"arxiv_{i}", f"Abstract: {i}", {"abstract": str(i)}) for i in range(25)]
+    with patch('vectorizer.openai_client') as mock_client, \
+         patch('vectorizer.upstash_index') as mock_index, \
+         patch('vectorizer.count_tokens', side_effect=lambda text: len(text.split())):
+        mock_client.embeddings.create.side_effect = fake_embeddings_create
+        limiter = vectorizer.AdaptiveRateLimiter(rate=1000.0, max_rate=1000.0)
+        stats = vectorizer.ingest(records, workers=2, upsert_batch_size=10, limiter=limiter)
+
+    assert stats.docs == 25
+    assert stats.failed == 0
+    assert stats.tokens == 50
+    upserted = [v for call in mock_index.upsert.call_args_list for v in call.kwargs["vectors"]]
+    assert [len(call.kwargs["vectors"]) for call in mock_index.upsert.call_args_list] == [10, 10, 5]
+    assert sorted(v.id for v in upserted) == sorted(r[0] for r in records)
+
+def test_vectorizer_rate_limiter_backs_off_and_recovers():
+    """The adaptive limiter halves its rate when throttled and creeps back up on success."""
+    import vectorizer
+
+    limiter = vectorizer.AdaptiveRateLimiter(rate=10.0, min_rate=1.0, max_rate=20.0, increase=1.0)
+    limiter.on_throttle(retry_after=0)
+    assert limiter.rate == 5.0
+    assert limiter.throttled == 1
+    limiter.on_success()
+    assert limiter.rate == 6.0
+
+def test_vectorizer_shards_do_not_overlap():
+    """--start/--end/--shard k/N split the dataset into disjoint, covering ranges."""
+    import vectorizer
+
+    shards = [set(vectorizer.select_indices(100, start=10, end=50, shard=(k, 3))) for k in range(3)]
+    assert set().union(*shards) == set(range(10, 50))
+    assert sum(len(s) for s in shards) == 40
+    assert all(i % 3 == 1 for i in shards[1])
+    assert vectorizer.parse_shard("2/4") == (2, 4)
+    with pytest.raises(Exception):
+        vectorizer.parse_shard("4/4")
+
+def test_vectorizer_checkpoint_resumes_and_retries_failures(tmp_path):
+    """A rerun skips upserted ids, --retry-failed selects only failures, and a journal keeps to one index."""
+    import vectorizer
+    from checkpoint import CheckpointJournal
+
+    def fake_embeddings_create(model, input):
+        if any("arxiv_3" in text for text in input):
+            raise ValueError("boom")
+        response = MagicMock()
+        response.data = [MagicMock(embedding=[1.0]) for _ in input]
+        return response
+
+    records = [(vectorizer.vector_id(i), f"Abstract: arxiv_{i}", {}) for i in range(6)]
+    with CheckpointJournal(str(tmp_path / "checkpoint.db")) as journal, \
+         patch('vectorizer.openai_client') as mock_client, \
+         patch('vectorizer.upstash_index'), \
+         patch('vectorizer.count_tokens', return_value=1):
+        mock_client.embeddings.create.side_effect = fake_embeddings_create
+        limiter = vectorizer.AdaptiveRateLimiter(rate=1000.0)
+        with patch('vectorizer.iter_token_batches', side_effect=lambda recs: (([r], 1) for r in recs)):
+            stats = vectorizer.ingest(records, workers=2, limiter=limiter, journal=journal)
+
+        assert stats.docs == 5
+        assert journal.failed_ids() == {"arxiv_3"}
+        assert journal.failures()[0][1] == "ValueError"
+        is_pending = vectorizer.pending_filter(journal)
+        assert [i for i in range(8) if is_pending(vectorizer.vector_id(i))] == [3, 6, 7]
+        is_failed = vectorizer.pending_filter(journal, retry_failed_only=True)
+        assert [i for i in range(8) if is_failed(vectorizer.vector_id(i))] == [3]
+
+    bound_path = str(tmp_path / "bound.db")
+    with CheckpointJournal(bound_path, target="local:/stores/a") as journal:
+        journal.mark_upserted(["arxiv_0"])
+    with CheckpointJournal(bound_path, target="local:/stores/a") as journal:
+        assert journal.completed_ids() == {"arxiv_0"}
+    with pytest.raises(ValueError):
+        CheckpointJournal(bound_path, target="local:/stores/b")
+
+def test_embedding_cache_tiers_and_counters(tmp_path):
+    """Repeated texts are served from memory, then from disk after a restart."""
+    from embedding_cache import EmbeddingCache
+
+    calls = []
+    def fake_embed(texts):
+        calls.append(list(texts))
+        return [[float(len(text)), 0.5] for text in texts]
+
+    path = str(tmp_path / "cache.db")
+    cache = EmbeddingCache(path, max_memory_entries=10)
+    assert cache.embed("m", ["a", "bb", "a"], fake_embed) == [[1.0, 0.5], [2.0, 0.5], [1.0, 0.5]]
+    assert cache.embed("m", ["bb"], fake_embed) == [[2.0, 0.5]]
+    assert calls == [["a", "bb"]]
+    assert cache.stats()["memory_hits"] == 1
+    cache.close()
+
+    reopened = EmbeddingCache(path)
+    assert reopened.embed("m", ["a"], fake_embed) == [[1.0, 0.5]]
+    assert reopened.embed("other-model", ["a"], fake_embed) == [[1.0, 0.5]]
+    assert calls == [["a", "bb"], ["a"]]
+    assert reopened.stats()["disk_hits"] == 1
+    assert reopened.stats()["misses"] == 1
+
+def test_embedding_cache_evicts_to_bounds(tmp_path):
+    """Both tiers stay within their configured size bounds."""
+    from embedding_cache import EmbeddingCache
+
+    cache = EmbeddingCache(str(tmp_path / "cache.db"), max_memory_entries=3, max_disk_entries=10)
+    for i in range(30):
+        cache.embed("m", [f"text {i}"], lambda texts: [[0.0] for _ in texts])
+    stats = cache.stats()
+    assert stats["memory_entries"] == 3
+    assert stats["disk_entries"] <= 10
+
+def test_get_bot_reply_reuses_cached_embedding(client, mock_main_openai_client, mock_main_upstash_index):
+    """Re-asking the same question in a new session does not re-embed it."""
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["ANSWER_CACHE_MAX_ENTRIES"] = 0 # Exercise retrieval on every request
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+
+    bot_message_ids = [_pending_bot_message("Same question") for _ in range(2)]
+
+    for bot_message_id in bot_message_ids:
+        assert client.get(f'/api/v1/get-bot-reply/{bot_message_id}').status_code == 200
+
+    mock_main_openai_client.embeddings.create.assert_called_once()
+    assert mock_main_upstash_index.query.call_count == 2
+
+def test_local_vector_store_exact_top_k(tmp_path):
+    """Blocked argpartition search matches brute-force cosine ranking and persists."""
+    import numpy as np
+    import vector_store
+    from vector_store import LocalVectorStore
+    from upstash_vector import Vector
+
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(300, 16)).astype(np.float32)
+    query = rng.normal(size=16).astype(np.float32)
+
+    store = LocalVectorStore(str(tmp_path / "store"))
+    store.upsert([Vector(id=f"arxiv_{i}", vector=data[i].tolist(), metadata={"abstract": f"A{i}"}) for i in range(300)])
+
+    with patch.object(vector_store, "BLOCK_ROWS", 64):
+        results = store.query(vector=query.tolist(), top_k=5, include_metadata=True)
+
+    normed = data / np.linalg.norm(data, axis=1, keepdims=True)
+    expected = np.argsort(-(normed @ (query / np.linalg.norm(query))))[:5]
+    assert [r.id for r in results] == [f"arxiv_{i}" for i in expected]
+    assert results[0].metadata == {"abstract": f"A{expected[0]}"}
+    assert 0.0 <= results[-1].score <= results[0].score <= 1.0
+
+    store.delete([f"arxiv_{expected[0]}"])
+    # One writer per store: a second one is refused until the first closes
+    other = LocalVectorStore(str(tmp_path / "store"))
+    with pytest.raises(RuntimeError):
+        other.delete(["arxiv_1"])
+    other.close()
+    store.close()
+    reopened = LocalVectorStore(str(tmp_path / "store"))
+    assert len(reopened) == 299
+    assert reopened.query(vector=query.tolist(), top_k=1)[0].id == f"arxiv_{expected[1]}"
+
+def test_get_bot_reply_with_local_vector_store(client, mock_main_openai_client, tmp_path):
+    """VECTOR_STORE=local serves retrieval from the in-process store without an Upstash token."""
+    from vector_store import LocalVectorStore
+
+    store_path = str(tmp_path / "store")
+    seed = LocalVectorStore(store_path)
+    seed.upsert([("arxiv_0", [0.1, 0.2, 0.3], {"abstract": "Local abstract"})])
+    seed.close()
+
+    app.config["VECTOR_STORE"] = "local"
+    app.config["LOCAL_VECTOR_STORE_PATH"] = store_path
+    with patch('main.OpenAI', return_value=mock_main_openai_client), \
+         patch('main.upstash_index', None):
+        response = client.post('/initialize', data={'openai_api_key': 'test_openai_key'})
+        assert response.status_code == 302
+        assert isinstance(main_module.upstash_index, LocalVectorStore)
+        assert b"ArXiv LLM" in client.get('/').data
+
+        bot_message_id = _pending_bot_message()
+        response = client.get(f'/api/v1/get-bot-reply/{bot_message_id}')
+        main_module.upstash_index.close()
+
+    assert b"Mocked bot reply" in response.data
+    system_prompt = mock_main_openai_client.chat.completions.create.call_args.kwargs["messages"][0]["content"]
+    assert "Local abstract" in system_prompt
+
+def test_local_vector_store_ivf_index(tmp_path):
+    """The IVF index matches exact search when probing every list and picks up new upserts."""
+    import numpy as np
+    from vector_store import LocalVectorStore
+
+    rng = np.random.default_rng(1)
+    data = rng.normal(size=(500, 16)).astype(np.float32)
+    store = LocalVectorStore(str(tmp_path / "store"))
+    store.upsert([(f"arxiv_{i}", data[i], None) for i in range(500)])
+    ann = store.build_ann_index(n_lists=8)
+    assert ann.n_lists == 8
+
+    query = rng.normal(size=16).astype(np.float32)
+    exact = [r.id for r in store.query(vector=query, top_k=10, exact=True)]
+    assert [r.id for r in store.query(vector=query, top_k=10, nprobe=8)] == exact
+    assert len(store.query(vector=query, top_k=10, nprobe=1)) <= 10
+
+    # Incremental insert: a new vector is found without rebuilding
+    store.upsert([("new_paper", query, None)])
+    assert store.query(vector=query, top_k=1, nprobe=1)[0].id == "new_paper"
+    # Assignments are saved on close(); a store opened before then rebuilds them
+    reader = LocalVectorStore(str(tmp_path / "store"))
+    assert reader.query(vector=query, top_k=1, nprobe=1)[0].id == "new_paper"
+    reader.close()
+    store.delete(["new_paper"])
+    store.close()
+
+    reopened = LocalVectorStore(str(tmp_path / "store"), nprobe=8)
+    assert reopened.ann is not None
+    assert [r.id for r in reopened.query(vector=query, top_k=10)] == exact
+
+@pytest.mark.parametrize("storage", ["float16", "int8", "pq"])
+def test_local_vector_store_compressed_storage(tmp_path, storage):
+    """Compressed codes shrink the scanned data while re-ranking keeps exact results."""
+    import numpy as np
+    from vector_store import LocalVectorStore
+
+    rng = np.random.default_rng(2)
+    data = rng.normal(size=(400, 32)).astype(np.float32)
+    query = rng.normal(size=32).astype(np.float32)
+    store = LocalVectorStore(str(tmp_path / "store"), rerank=50)
+    store.upsert([(f"arxiv_{i}", data[i], None) for i in range(400)])
+    exact = [r.id for r in store.query(vector=query, top_k=10)]
+    float32_bytes = store.memory_footprint()
+
+    store.compress(storage)
+    assert store.memory_footprint() < float32_bytes
+    assert [r.id for r in store.query(vector=query, top_k=10)] == exact
+
+    # New upserts are encoded incrementally and the codec survives a reopen
+    store.upsert([("new_paper", query, None)])
+    store.close()
+    reopened = LocalVectorStore(str(tmp_path / "store"))
+    assert reopened.storage == storage
+    assert reopened.query(vector=query, top_k=1)[0].id == "new_paper"
+
+def test_stream_bot_reply_forwards_deltas(client, mock_main_openai_client, mock_main_upstash_index):
+    """The streaming endpoint forwards completion deltas as SSE and persists the reply once."""
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+
+    def chunk(text):
+        delta = MagicMock(content=text)
+        return MagicMock(choices=[MagicMock(delta=delta)])
+    mock_main_openai_client.chat.completions.create.side_effect = None
+    mock_main_openai_client.chat.completions.create.return_value = iter(
+        [chunk("Hello"), chunk(" streaming"), chunk(None), chunk(" world")]
+    )
+
+    bot_message_id = _pending_bot_message()
+
+    with patch('main._finish_bot_message', wraps=main_module._finish_bot_message) as mock_finish:
+        response = client.get(f'/api/v1/stream-bot-reply/{bot_message_id}')
+        body = response.get_data(as_text=True)
+        mock_finish.assert_called_once()
+
+    assert response.mimetype == "text/event-stream"
+    assert body.count("event: delta") == 3
+    assert body.index('"Hello"') < body.index('" streaming"') < body.index('" world"')
+    assert "event: done" in body and "Hello streaming world" in body
+    assert mock_main_openai_client.chat.completions.create.call_args.kwargs["stream"] is True
+
+    with app.app_context():
+        updated_bot_msg = db.session.get(HistoryMessage, bot_message_id)
+        assert updated_bot_msg.message == "Hello streaming world"
+        assert updated_bot_msg.is_pending == False
+
+    # A processed reply is returned as a single "done" event without regenerating
+    again = client.get(f'/api/v1/stream-bot-reply/{bot_message_id}').get_data(as_text=True)
+    assert "event: delta" not in again and "Hello streaming world" in again
+    assert mock_main_openai_client.chat.completions.create.call_count == 1
+
+def test_stream_bot_reply_saves_reply_after_disconnect(client, mock_main_openai_client, mock_main_upstash_index):
+    """A client that disconnects mid-stream still gets the full reply stored and the lease released."""
+    from models import ReplyJob
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+    chunks = [MagicMock(choices=[MagicMock(delta=MagicMock(content=text))]) for text in ("Saved", " despite", " leaving")]
+    mock_main_openai_client.chat.completions.create.side_effect = None
+    mock_main_openai_client.chat.completions.create.return_value = iter(chunks)
+
+    bot_message_id = _pending_bot_message()
+
+    response = client.get(f'/api/v1/stream-bot-reply/{bot_message_id}', buffered=False)
+    first = next(iter(response.response))
+    assert b'"Saved"' in first
+    response.close()  # The browser went away after the first delta
+
+    with app.app_context():
+        updated_bot_msg = db.session.get(HistoryMessage, bot_message_id)
+        assert updated_bot_msg.message == "Saved despite leaving"
+        assert updated_bot_msg.is_pending == False
+        assert db.session.get(ReplyJob, bot_message_id).status == "done"
+
+def test_stream_bot_reply_without_user_message(client, mock_main_openai_client, mock_main_upstash_index):
+    """Errors before the completion starts are reported in a single "done" event."""
+    bot_message_id = _pending_bot_message(question=None)
+
+    body = client.get(f'/api/v1/stream-bot-reply/{bot_message_id}').get_data(as_text=True)
+    assert "event: done" in body
+    assert "Error: Could not find user message context." in body
+    mock_main_openai_client.chat.completions.create.assert_not_called()
+
+def test_stream_bot_reply_releases_lease_when_retrieval_fails(client, mock_main_openai_client, mock_main_upstash_index):
+    """An error while building the prompt gives the lease back, so a retry can claim the reply."""
+    from job_queue import claim, new_owner, STATUS_QUEUED
+    from models import ReplyJob
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+    bot_message_id = _pending_bot_message()
+
+    mock_main_upstash_index.query.side_effect = ConnectionError("index unavailable")
+    with pytest.raises(ConnectionError):
+        client.get(f'/api/v1/stream-bot-reply/{bot_message_id}')
+
+    with app.app_context():
+        assert db.session.get(ReplyJob, bot_message_id).status == STATUS_QUEUED
+        assert claim(bot_message_id, new_owner())
+
+def test_long_session_prompt_stays_within_budget(client, mock_main_openai_client, mock_main_upstash_index):
+    """Older turns are folded into a stored summary once; the prompt and embed input stay bounded."""
+    import prompt_builder
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+
+    with app.app_context():
+        history = History(title="Long chat")
+        db.session.add(history)
+        db.session.commit()
+        history_id = history.id
+        for turn in range(40):
+            db.session.add(HistoryMessage(history_id=history_id, message=f"question{turn} " + "word " * 30, is_user=True))
+            db.session.add(HistoryMessage(history_id=history_id, message=f"answer{turn} " + "word " * 30, is_user=False))
+        db.session.commit()
+    bot_message_id = _pending_bot_message("Latest question", history_id=history_id)
+
+    summary_choice = MagicMock(message=MagicMock(content="Summary of early turns"))
+    reply_choice = MagicMock(message=MagicMock(content="Mocked bot reply"))
+    mock_main_openai_client.chat.completions.create.side_effect = [
+        MagicMock(choices=[summary_choice]),
+        MagicMock(choices=[reply_choice]),
+    ]
+
+    response = client.get(f'/api/v1/get-bot-reply/{bot_message_id}')
+    assert b"Mocked bot reply" in response.data
+
+    summary_call, reply_call = mock_main_openai_client.chat.completions.create.call_args_list
+    assert "question0 " in summary_call.kwargs["messages"][1]["content"]
+    system_prompt = reply_call.kwargs["messages"][0]["content"]
+    assert "Summary of early turns" in system_prompt
+    assert "question0 " not in system_prompt and "answer39 " in system_prompt
+    history_section = system_prompt.split("CHAT HISTORIES")[1]
+    assert prompt_builder.count_tokens(history_section) <= prompt_builder.HISTORY_TOKEN_BUDGET
+
+    embed_input = mock_main_openai_client.embeddings.create.call_args.kwargs["input"][0]
+    assert prompt_builder.count_tokens(embed_input) <= prompt_builder.EMBED_TOKEN_BUDGET
+    assert embed_input.endswith("Latest question") and "question36 " not in embed_input
+
+    with app.app_context():
+        history = db.session.get(History, history_id)
+        assert history.summary == "Summary of early turns"
+        assert history.summary_through_id is not None
+
+def test_select_knowledge_respects_budget():
+    """Abstracts are kept in rank order and the one crossing the budget is truncated."""
+    import prompt_builder
+    abstracts = ["one " * 60, "two " * 60, "three " * 60]
+    selected = prompt_builder.select_knowledge(abstracts, budget=100)
+    assert len(selected) == 2
+    assert selected[0].startswith("one") and selected[1].startswith("two")
+    assert sum(prompt_builder.count_tokens(a) for a in selected) <= 100
+
+def test_sidebar_and_history_keyset_pagination(client):
+    """The sidebar and session history are served in bounded pages with an infinite-scroll cursor."""
+    with app.app_context():
+        sessions = [History(title=f"Session {i}") for i in range(main_module.SIDEBAR_PAGE_SIZE + 5)]
+        db.session.add_all(sessions)
+        db.session.commit()
+        history_id = sessions[-1].id
+        for i in range(main_module.HISTORY_PAGE_SIZE + 3):
+            db.session.add(HistoryMessage(history_id=history_id, message=f"Message {i}.", is_user=i % 2 == 0))
+        db.session.commit()
+
+    first = client.get('/sidebar').get_data(as_text=True)
+    assert first.count("hx-get=\"/api/v1/history/") == main_module.SIDEBAR_PAGE_SIZE
+    assert f"Session {main_module.SIDEBAR_PAGE_SIZE + 4}" in first
+    assert "/sidebar?before=" in first
+    cursor = first.split("/sidebar?before=")[1].split('"')[0]
+    second = client.get(f'/sidebar?before={cursor}').get_data(as_text=True)
+    assert second.count("hx-get=\"/api/v1/history/") == 5
+    assert "Session 0" in second and "/sidebar?before=" not in second
+
+    latest = client.get(f'/api/v1/history/{history_id}').get_data(as_text=True)
+    assert f"Message {main_module.HISTORY_PAGE_SIZE + 2}." in latest and "Message 2." not in latest
+    assert latest.index("Message 3.") < latest.index(f"Message {main_module.HISTORY_PAGE_SIZE + 2}.")
+    cursor = latest.split("?before=")[1].split('"')[0]
+    older = client.get(f'/api/v1/history/{history_id}?before={cursor}').get_data(as_text=True)
+    assert "Message 0." in older and "Message 2." in older and "Message 3." not in older
+    assert "sessionId" not in older and "?before=" not in older
+
+def test_reply_context_is_one_indexed_query(client, mock_main_openai_client, mock_main_upstash_index):
+    """Reply context is fetched with a single query that uses the (history_id, id) index."""
+    from sqlalchemy import event
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+
+    with app.app_context():
+        history = History(title="Context")
+        db.session.add(history)
+        db.session.commit()
+        for message, is_user in [("First question", True), ("First answer", False)]:
+            db.session.add(HistoryMessage(history_id=history.id, message=message, is_user=is_user))
+        db.session.commit()
+        # As loaded by the route
+        bot_msg = db.session.get(HistoryMessage, _pending_bot_message("Second question", history_id=history.id))
+
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            user_text, history_messages, summary = main_module.load_reply_context(bot_msg)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+
+        assert len(statements) == 1
+        assert user_text == "Second question"
+        assert [m.message for m in history_messages] == ["First question", "First answer"]
+        explain = db.session.connection().exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT id FROM history_message WHERE history_id = ? AND id < ? ORDER BY id DESC",
+            (history.id, bot_msg.id),
+        ).fetchall()
+        assert any("ix_history_message_history_id_id" in row[-1] for row in explain)
+
+def test_send_message_is_one_wal_transaction(client):
+    """send_message writes the session and both messages in a single commit on a WAL database."""
+    from sqlalchemy import event
+    with app.app_context():
+        assert db.session.execute(db.text("PRAGMA journal_mode")).scalar() == "wal"
+        assert db.session.execute(db.text("PRAGMA synchronous")).scalar() == 1 # NORMAL
+
+        commits = []
+        listener = lambda conn: commits.append(conn)
+        event.listen(db.engine, "commit", listener)
+        try:
+            response = client.post('/api/v1/send-message', data={'message': 'One transaction'})
+        finally:
+            event.remove(db.engine, "commit", listener)
+
+    assert response.status_code == 200
+    assert len(commits) == 1
+    with app.app_context():
+        messages = HistoryMessage.query.filter_by(history_id=History.query.one().id).order_by(HistoryMessage.id).all()
+        assert [(m.is_user, m.is_pending) for m in messages] == [(True, False), (False, True)]
+
+def test_answer_cache_serves_repeated_standalone_questions(client, mock_main_openai_client, mock_main_upstash_index):
+    """A repeated question without history is answered from the cache; follow-ups are not."""
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+
+    bot_message_ids = [_pending_bot_message("What is attention?") for _ in range(2)]
+    # A follow-up in the second session has history and bypasses the cache
+    with app.app_context():
+        second_history_id = db.session.get(HistoryMessage, bot_message_ids[1]).history_id
+    follow_up_id = _pending_bot_message("What is attention?", history_id=second_history_id)
+
+    for bot_message_id in bot_message_ids:
+        assert b"Mocked bot reply" in client.get(f'/api/v1/get-bot-reply/{bot_message_id}').data
+    assert mock_main_openai_client.chat.completions.create.call_count == 1
+    # The hit still retrieves, to check the answer was built from the same papers
+    assert mock_main_upstash_index.query.call_count == 2
+    with app.app_context():
+        assert db.session.get(HistoryMessage, bot_message_ids[1]).message == "Mocked bot reply"
+
+    client.get(f'/api/v1/get-bot-reply/{follow_up_id}')
+    assert mock_main_openai_client.chat.completions.create.call_count == 2
+
+    stats = client.get('/api/v1/cache-stats').get_json()["answer_cache"]
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["hit_rate"] == 0.5
+
+    # Once retrieval returns other papers, e.g. after a sync, the cached answer is stale
+    mock_main_upstash_index.query.return_value = [MagicMock(metadata={"abstract": "Revised abstract", "paper": "arxiv_9"})]
+    client.get(f'/api/v1/get-bot-reply/{_pending_bot_message("What is attention?")}')
+    assert mock_main_openai_client.chat.completions.create.call_count == 3
+    assert client.get('/api/v1/cache-stats').get_json()["answer_cache"]["stale"] == 1
+
+def test_answer_cache_threshold_ttl_lru_and_invalidation(tmp_path):
+    """Near-duplicates hit, distant questions miss, and entries expire, evict and invalidate."""
+    import time
+    from answer_cache import AnswerCache, bump_generation
+    generation = tmp_path / "index_generation"
+    cache = AnswerCache(threshold=0.9, ttl=60, max_entries=2, generation_path=str(generation))
+
+    cache.put([1.0, 0.0, 0.0], "about x", ["doc_1"])
+    assert cache.lookup([0.99, 0.05, 0.0]) == ("about x", ["doc_1"])
+    assert cache.lookup([0.99, 0.05, 0.0], ["doc_1"]) == ("about x", ["doc_1"])
+    assert cache.lookup([0.0, 1.0, 0.0]) is None
+
+    cache.put([0.0, 1.0, 0.0], "about y")
+    cache.lookup([1.0, 0.0, 0.0]) # Touch x so y is least recently used
+    cache.put([0.0, 0.0, 1.0], "about z")
+    assert cache.lookup([0.0, 1.0, 0.0]) is None
+    assert cache.lookup([1.0, 0.0, 0.0])[0] == "about x"
+    assert cache.stats()["evictions"] == 1
+
+    with patch("answer_cache.time.time", return_value=time.time() + 120):
+        assert cache.lookup([0.0, 0.0, 1.0]) is None
+
+    bump_generation(str(generation))
+    assert cache.lookup([1.0, 0.0, 0.0]) is None
+    assert len(cache) == 0 and cache.stats()["invalidations"] == 1
+
+    # An answer built from other results than the question retrieves now is dropped
+    cache.put([1.0, 0.0, 0.0], "about x", ["doc_1"])
+    assert cache.lookup([1.0, 0.0, 0.0], ["doc_2"]) is None
+    assert len(cache) == 0 and cache.stats()["stale"] == 1
+
+def test_bm25_index_round_trip(tmp_path):
+    """The on-disk BM25 index ranks exact term matches first and decodes compressed postings."""
+    import os
+    import numpy as np
+    from lexical_index import BM25IndexBuilder, BM25Index, encode_varints, decode_varints
+    values = [0, 1, 127, 128, 300, 16384, 2**31]
+    assert decode_varints(np.frombuffer(encode_varints(values), dtype=np.uint8)).tolist() == values
+
+    builder = BM25IndexBuilder(str(tmp_path / "bm25"))
+    builder.add("arxiv_0", "We train a transformer on ImageNet with attention.")
+    builder.add("arxiv_1", "A study of attention in recurrent networks.")
+    builder.add("arxiv_2", "The LSTM-CRF tagger is evaluated on CoNLL-2003.")
+    for i in range(3, 300):
+        builder.add(f"arxiv_{i}", f"Filler abstract number {i} about attention models.")
+    builder.finish()
+
+    index = BM25Index.load(str(tmp_path / "bm25"))
+    assert len(index) == 300
+    docs, tfs = index.postings("attention")
+    assert len(docs) == 299 and docs[:2].tolist() == [0, 1]
+    hits = index.search("CoNLL 2003 LSTM")
+    assert hits[0].id == "arxiv_2" and "CoNLL-2003" in hits[0].text
+    assert index.search("imagenet attention")[0].id == "arxiv_0"
+    assert index.search("unseenterm") == []
+    assert BM25Index.load(str(tmp_path / "missing")) is None
+
+    # Rebuilding swaps a new directory in; the open index keeps reading the old files
+    rebuilt = BM25IndexBuilder(str(tmp_path / "bm25"))
+    rebuilt.add("arxiv_9", "A single new abstract.")
+    rebuilt.finish()
+    assert index.search("CoNLL 2003 LSTM")[0].id == "arxiv_2"
+    assert len(BM25Index.load(str(tmp_path / "bm25"))) == 1
+    assert sorted(os.listdir(tmp_path)) == ["bm25"]
+
+    import vectorizer
+    assert not vectorizer.covers_part(vectorizer.parse_args([]), 100)
+    assert not vectorizer.covers_part(vectorizer.parse_args(["--end", "100"]), 100)
+    assert vectorizer.covers_part(vectorizer.parse_args(["--end", "50"]), 100)
+    assert vectorizer.covers_part(vectorizer.parse_args(["--shard", "1/2"]), 100)
+
+def test_get_bot_reply_fuses_lexical_hits(client, mock_main_openai_client, mock_main_upstash_index, tmp_path):
+    """Exact-term BM25 matches missed by vector search reach the prompt via rank fusion."""
+    from lexical_index import BM25IndexBuilder, reciprocal_rank_fusion
+    assert [doc for doc, _ in reciprocal_rank_fusion([["a", "b", "c"], ["c", "d"]])][:2] == ["c", "a"]
+
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+    builder = BM25IndexBuilder(str(tmp_path / "bm25"))
+    builder.add("arxiv_7", "We introduce the SQuAD 2.0 benchmark for unanswerable questions.")
+    builder.add("arxiv_8", "A survey of graph neural networks.")
+    mock_main_upstash_index.query.return_value = [
+        MagicMock(id="arxiv_1", metadata={"abstract": "Dense abstract"}),
+    ]
+
+    bot_message_id = _pending_bot_message("What is SQuAD 2.0?")
+
+    with patch('main.lexical_index', builder.finish()):
+        client.get(f'/api/v1/get-bot-reply/{bot_message_id}')
+
+    system_prompt = mock_main_openai_client.chat.completions.create.call_args.kwargs["messages"][0]["content"]
+    assert "SQuAD 2.0 benchmark" in system_prompt and "Dense abstract" in system_prompt
+    assert "graph neural networks" not in system_prompt
+
+def test_chunker_splits_articles_on_sections_with_overlap():
+    """Chunks stay under the token budget, end at section breaks and overlap their neighbours."""
+    import vectorizer
+    from chunker import chunk_article
+
+    article = "\n".join([
+        "intro " * 10,
+        "method " * 25,
+        "results " * 5,
+        "appendix " * 90,
+    ])
+    chunks = list(chunk_article(article, WordEncoding(), max_tokens=40, overlap=5))
+    words = [chunk.split() for chunk in chunks]
+    assert all(len(w) <= 40 for w in words)
+    assert words[0] == ["intro"] * 10 + ["method"] * 25 + ["results"] * 5
+    assert all(a[-5:] == b[:5] for a, b in zip(words, words[1:]))
+    assert sum(w.count("appendix") for w in words) >= 90
+    with pytest.raises(ValueError):
+        list(chunk_article(article, WordEncoding(), max_tokens=8, overlap=8))
+
+    examples = iter([{"abstract": f"Abstract {i}", "article": "a b c\nd e f"} for i in range(10)])
+    selected = list(vectorizer.iter_selected(examples, vectorizer.select_indices(100, 2, 8, (0, 3))))
+    assert [i for i, _ in selected] == [3, 6]
+    assert selected[0][1]["abstract"] == "Abstract 3"
+
+    class Stream(list):
+        def skip(self, n):
+            skipped.append(n)
+            return Stream(self[n:])
+    skipped = []
+    stream = Stream({"abstract": f"Abstract {i}"} for i in range(10))
+    assert [(i, e["abstract"]) for i, e in vectorizer.iter_selected(stream, range(4, 9, 2))] == [
+        (4, "Abstract 4"), (6, "Abstract 6"), (8, "Abstract 8")
+    ]
+    assert skipped == [4]
+    with patch('vectorizer.get_encoding', return_value=WordEncoding()):
+        records = list(vectorizer.paper_records(3, selected[0][1], chunk_tokens=4, chunk_overlap=1))
+    assert [r[0] for r in records] == ["arxiv_3", "arxiv_3_chunk_0", "arxiv_3_chunk_1"]
+    assert all(r[2]["paper"] == "arxiv_3" for r in records)
+    assert records[2][2]["text"] == "c d e f"
+
+def test_get_bot_reply_collapses_chunks_per_paper(client, mock_main_openai_client, mock_main_upstash_index):
+    """Several chunk hits from one paper take a single knowledge slot, its best-scoring one."""
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+    mock_main_upstash_index.query.return_value = [
+        MagicMock(id="arxiv_1_chunk_4", metadata={"paper": "arxiv_1", "chunk": 4, "text": "Best chunk"}),
+        MagicMock(id="arxiv_1_chunk_5", metadata={"paper": "arxiv_1", "chunk": 5, "text": "Second chunk"}),
+        MagicMock(id="arxiv_1", metadata={"paper": "arxiv_1", "abstract": "Paper one abstract"}),
+        MagicMock(id="arxiv_2", metadata={"paper": "arxiv_2", "abstract": "Paper two abstract"}),
+    ]
+
+    bot_message_id = _pending_bot_message("Question?")
+
+    client.get(f'/api/v1/get-bot-reply/{bot_message_id}')
+
+    assert mock_main_upstash_index.query.call_args.kwargs["top_k"] == main_module.RETRIEVAL_CANDIDATES
+    system_prompt = mock_main_openai_client.chat.completions.create.call_args.kwargs["messages"][0]["content"]
+    assert "Best chunk" in system_prompt and "Paper two abstract" in system_prompt
+    assert "Second chunk" not in system_prompt and "Paper one abstract" not in system_prompt
+    assert main_module.answer_cache._entries[0][1] == ["arxiv_1", "arxiv_2"]
+
+def test_reranker_hybrid_order_and_deadline_fallback():
+    """Lexical matches lift weaker vector hits; a blown deadline keeps the original order."""
+    from reranker import Reranker, Candidate
+
+    candidates = [
+        Candidate("arxiv_0", "A survey of convolutional networks.", 0.82),
+        Candidate("arxiv_1", "Generic results on deep learning.", 0.81),
+        Candidate("arxiv_2", "Dropout regularization prevents overfitting in dropout networks.", 0.80),
+        Candidate("arxiv_3", "We study dropout as Bayesian approximation.", None),
+    ]
+    reranker = Reranker(dense_weight=0.5, deadline_ms=1000)
+    ranked = reranker.rerank("How does dropout prevent overfitting?", candidates, top_k=2)
+    assert [c.id for c in ranked] == ["arxiv_2", "arxiv_3"]
+
+    late = Reranker(deadline_ms=-1)
+    assert late.rerank("dropout", candidates, top_k=3) == candidates[:3]
+    assert late.stats() == {"reranked": 0, "fallbacks": 1}
+
+def test_get_bot_reply_reranks_over_fetched_candidates(client, mock_main_openai_client, mock_main_upstash_index):
+    """With re-ranking on, 50 candidates are fetched and the best 10 fill the prompt in hybrid order."""
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+    app.config["RERANK_ENABLED"] = True
+    mock_main_upstash_index.query.return_value = [
+        MagicMock(id=f"arxiv_{i}", score=0.9 - i * 0.001, metadata={"abstract": f"Filler abstract {i}."})
+        for i in range(49)
+    ] + [MagicMock(id="arxiv_49", score=0.85, metadata={"abstract": "Grokking in modular arithmetic."})]
+
+    bot_message_id = _pending_bot_message("What is grokking?")
+
+    client.get(f'/api/v1/get-bot-reply/{bot_message_id}')
+
+    assert mock_main_upstash_index.query.call_args.kwargs["top_k"] == 50
+    system_prompt = mock_main_openai_client.chat.completions.create.call_args.kwargs["messages"][0]["content"]
+    knowledge = system_prompt.split("Knowledge: ")[1].split("\n\n\n")[0].splitlines()
+    assert knowledge[0] == "Grokking in modular arithmetic."
+    assert len(knowledge) == main_module.RETRIEVAL_TOP_K
+    assert main_module.reranker.stats()["reranked"] == 1
+
+def test_get_bot_reply_leases_pending_message(client, mock_main_openai_client, mock_main_upstash_index):
+    """A second request for a reply that is being generated polls instead of generating it again."""
+    from job_queue import claim, new_owner, STATUS_DONE
+    from models import ReplyJob
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+
+    bot_message_id = _pending_bot_message()
+    with app.app_context():
+        other_owner = new_owner()
+        assert claim(bot_message_id, other_owner)
+
+    response = client.get(f'/api/v1/get-bot-reply/{bot_message_id}')
+    assert response.status_code == 202
+    assert f'hx-get="/api/v1/get-bot-reply/{bot_message_id}"' in response.data.decode()
+    mock_main_openai_client.chat.completions.create.assert_not_called()
+
+    with app.app_context():
+        # Once the other claimant's lease has lapsed, the reply can be taken over
+        db.session.get(ReplyJob, bot_message_id).lease_expires_at = 0.0
+        db.session.commit()
+    response = client.get(f'/api/v1/get-bot-reply/{bot_message_id}')
+    assert response.status_code == 200 and b"Mocked bot reply" in response.data
+    assert client.get(f'/api/v1/get-bot-reply/{bot_message_id}').status_code == 200
+    assert mock_main_openai_client.chat.completions.create.call_count == 1
+    with app.app_context():
+        job = db.session.get(ReplyJob, bot_message_id)
+        assert job.status == STATUS_DONE and job.attempts == 2
+
+def test_reply_worker_pool_retries_with_backoff(client, mock_main_openai_client, mock_main_upstash_index):
+    """Queued replies are generated by workers, retried with backoff and served by the result endpoint."""
+    import job_queue
+    from models import ReplyJob
+    app.config.update({
+        "OPENAI_API_KEY": "fake_key", "UPSTASH_TOKEN": "fake_token",
+        "REPLY_WORKERS": 1, "REPLY_MAX_ATTEMPTS": 2, "REPLY_RETRY_BACKOFF": 60.0,
+    })
+    try:
+        response = client.post('/api/v1/send-message', data={'message': 'Queued question'})
+        with app.app_context():
+            bot_msg = HistoryMessage.query.filter_by(is_user=False).order_by(HistoryMessage.id.desc()).first()
+            bot_message_id = bot_msg.id
+            assert db.session.get(ReplyJob, bot_message_id).status == job_queue.STATUS_QUEUED
+        assert f'/api/v1/bot-reply/{bot_message_id}' in response.data.decode()
+        assert client.get(f'/api/v1/bot-reply/{bot_message_id}').status_code == 202
+
+        pool = job_queue.ReplyWorkerPool(app, main_module.run_reply_job, max_attempts=2, backoff_seconds=60.0)
+        mock_main_openai_client.chat.completions.create.side_effect = RuntimeError("upstream 500")
+        assert pool.run_once()
+        with app.app_context():
+            job = db.session.get(ReplyJob, bot_message_id)
+            assert job.status == job_queue.STATUS_QUEUED and "upstream 500" in job.last_error
+            assert job.available_at > job_queue.time.time() + 30
+        assert not pool.run_once()  # Backing off
+
+        with app.app_context():
+            db.session.get(ReplyJob, bot_message_id).available_at = 0.0
+            db.session.commit()
+        mock_main_openai_client.chat.completions.create.side_effect = None
+        assert pool.run_once()
+        assert pool.stats()["retried"] == 1 and pool.stats()["processed"] == 1
+        response = client.get(f'/api/v1/bot-reply/{bot_message_id}')
+        assert response.status_code == 200 and b"Mocked bot reply" in response.data
+    finally:
+        app.config["REPLY_WORKERS"] = 0
+
+def test_metrics_endpoint_stage_latency_and_errors(client, mock_main_openai_client, mock_main_upstash_index, caplog):
+    """A chat turn records per-stage latency; a failed completion is counted and logged with its trace id."""
+    from instrumentation import STAGE_SECONDS, STAGE_ERRORS
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+    before = {name: STAGE_SECONDS.count(name) for name in ("embed", "vector_query", "prompt", "completion", "db_commit")}
+    errors_before = STAGE_ERRORS.value("completion")
+
+    response = client.post('/api/v1/send-message', data={'message': 'Metrics question'})
+    assert response.headers["X-Request-ID"]
+    with app.app_context():
+        bot_message_id = HistoryMessage.query.filter_by(is_user=False).order_by(HistoryMessage.id.desc()).first().id
+    mock_main_openai_client.chat.completions.create.side_effect = RuntimeError("upstream 500")
+    with caplog.at_level("ERROR"):
+        response = client.get(f'/api/v1/get-bot-reply/{bot_message_id}', headers={"X-Request-ID": "trace-123"})
+    assert response.headers["X-Request-ID"] == "trace-123"
+    assert b"Sorry, I encountered an error" in response.data
+
+    assert all(STAGE_SECONDS.count(name) > count for name, count in before.items())
+    assert STAGE_ERRORS.value("completion") == errors_before + 1
+    record = next(r for r in caplog.records if "Completion failed" in r.getMessage())
+    assert record.trace_id == "trace-123" and record.exc_info is not None
+
+    body = client.get('/metrics').data.decode()
+    assert 'rag_stage_seconds_bucket{stage="embed",le="+Inf"}' in body
+    assert 'rag_stage_errors_total{stage="completion"}' in body
+    assert 'http_request_seconds_count{endpoint="get_bot_reply",status="200"}' in body
+    assert 'rag_cache_hit_rate{cache="embedding"}' in body
+
+def test_init_worker_builds_clients_from_env_config(client):
+    """A forked worker creates its own clients from keys configured in the environment."""
+    app.config.update({"OPENAI_API_KEY": "env_openai_key", "UPSTASH_TOKEN": "env_upstash_token"})
+    with patch('main.OpenAI') as MockOpenAIConstructor, \
+         patch('main.Index') as MockUpstashIndexConstructor, \
+         patch('main.openai_client', "inherited"), patch('main.upstash_index', "inherited"), \
+         patch('main.lexical_index'), patch('main.reply_workers'):
+        main_module.init_worker()
+        # Clients (and their libraries) are only built on first use
+        MockOpenAIConstructor.assert_not_called()
+        MockUpstashIndexConstructor.assert_not_called()
+
+        assert main_module.openai_client.chat is MockOpenAIConstructor.return_value.chat
+        main_module.upstash_index.query
+        main_module.openai_client.embeddings
+        MockOpenAIConstructor.assert_called_once_with(api_key="env_openai_key")
+        MockUpstashIndexConstructor.assert_called_once_with(
+            url="https://capable-midge-9649-eu1-vector.upstash.io", token="env_upstash_token"
+        )
+        assert main_module.reply_workers is None  # REPLY_WORKERS defaults to 0
+
+    with app.app_context():
+        db.create_all()  # The in-memory database went with the disposed pool
+    response = client.get('/')
+    assert b"initialization" not in response.data.lower()
+
+def test_ensure_schema_skips_when_stamped_current():
+    """Schema creation runs once, then is skipped until the declared schema changes."""
+    from models import ensure_schema, schema_version
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql("PRAGMA user_version = 0")
+        with patch('models.upgrade_schema') as mock_upgrade:
+            assert ensure_schema() is True
+            assert ensure_schema() is False
+            assert mock_upgrade.call_count == 1
+
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql(f"PRAGMA user_version = {schema_version() - 1}")
+            assert ensure_schema() is True
+            assert mock_upgrade.call_count == 2
+
+def test_main_imports_with_in_memory_database_url():
+    """An in-memory DATABASE_URL gets no pool sizing, which its single-connection pool rejects."""
+    import os, subprocess, sys
+    script = (
+        "import main\n"
+        "with main.app.app_context():\n"
+        "    main.db.create_all()\n"
+        "    print(main.db.session.query(main.History).count())\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script], env=dict(os.environ, DATABASE_URL="sqlite://"),
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "0"
+
+def test_vectorizer_export_round_trip_without_api(tmp_path):
+    """Ingest appends to an export; --from-export rebuilds a store from it with no API calls."""
+    import os
+    import numpy as np
+    import vectorizer
+    from embedding_export import EmbeddingExport, ExportWriter
+    from vector_store import LocalVectorStore
+
+    def fake_embeddings_create(model, input):
+        response = MagicMock()
+        response.data = [MagicMock(embedding=[float(len(text)), 1.0, 0.0]) for text in input]
+        return response
+
+    export_path = str(tmp_path / "export")
+    records = [(f"arxiv_{i}", f"Abstract: {'x' * i}", {"abstract": "x" * i, "paper": f"arxiv_{i}"}) for i in range(1, 6)]
+    with patch('vectorizer.openai_client') as mock_client, \
+         patch('vectorizer.upstash_index'), \
+         patch('vectorizer.count_tokens', side_effect=lambda text: len(text.split())), \
+         ExportWriter(export_path, model=vectorizer.MODEL) as export:
+        mock_client.embeddings.create.side_effect = fake_embeddings_create
+        limiter = vectorizer.AdaptiveRateLimiter(rate=1000.0, max_rate=1000.0)
+        vectorizer.ingest(records[:3], workers=1, limiter=limiter, export=export)
+    with ExportWriter(export_path, model=vectorizer.MODEL) as export:  # Resumes after row 3
+        export.append(["arxiv_9_chunk_0"], [[0.0, 0.0, 1.0]], [{"text": "chunk", "paper": "arxiv_9", "chunk": 0}])
+        # Rows appended without a commit, as after a crash, are dropped on reopen
+        export._vectors.append(np.ones((1, 3)))
+    reopened = EmbeddingExport(export_path)
+    assert len(reopened) == 4 and isinstance(reopened.vectors, np.memmap)
+    assert reopened.ids == ["arxiv_1", "arxiv_2", "arxiv_3", "arxiv_9_chunk_0"]
+    assert reopened.vectors[1].tolist() == [float(len("Abstract: xx")), 1.0, 0.0]
+    assert reopened.column("abstract") == ["x", "xx", "xxx", None]
+    assert reopened.column("chunk") == [None, None, None, 0]
+    # Batches decode their own rows only
+    [first, second] = EmbeddingExport(export_path).batches(batch_size=3)
+    assert first[0] == ["arxiv_1", "arxiv_2", "arxiv_3"] and first[2][1] == {"abstract": "xx", "paper": "arxiv_2"}
+    assert second[0] == ["arxiv_9_chunk_0"] and second[2] == [{"text": "chunk", "paper": "arxiv_9", "chunk": 0}]
+
+    store_path = str(tmp_path / "store")
+    generation_path = str(tmp_path / "index_generation")
+    with patch('vectorizer.OpenAI') as MockOpenAI, \
+         patch.dict('os.environ', {"INDEX_GENERATION_PATH": generation_path}):
+        vectorizer.main([
+            "--from-export", export_path,
+            "--vector-store", "local", "--local-store-path", store_path,
+            "--lexical-index", str(tmp_path / "lexical"), "--checkpoint", str(tmp_path / "checkpoint.db"),
+        ])
+    MockOpenAI.assert_not_called()
+    assert os.path.exists(generation_path)  # Cached answers are invalidated
+    store = LocalVectorStore(store_path)
+    assert len(store) == 4
+    [hit] = store.query([0.0, 0.0, 1.0], top_k=1, include_metadata=True)
+    assert hit.id == "arxiv_9_chunk_0" and hit.metadata == {"text": "chunk", "paper": "arxiv_9", "chunk": 0}
+    from lexical_index import BM25Index
+    assert len(BM25Index.load(str(tmp_path / "lexical"))) == 3
+
+def test_vectorizer_sync_embeds_only_the_delta(tmp_path):
+    """--sync embeds new and changed abstracts only, deletes papers that disappeared and starts from the journal."""
+    import vectorizer
+    from types import SimpleNamespace
+    from vector_store import LocalVectorStore
+
+    class Dataset(list):
+        split = "train"
+
+        @property
+        def info(self):
+            return SimpleNamespace(splits={"train": SimpleNamespace(num_examples=len(self))})
+
+    embedded = []
+    def fake_embeddings_create(model, input):
+        embedded.extend(input)
+        return MagicMock(data=[MagicMock(embedding=[float(len(text)), 1.0]) for text in input])
+
+    def sync(papers, flags=("--sync",), manifest="manifest.db", store="store", checkpoint="checkpoint.db"):
+        with patch('vectorizer.load_dataset', return_value=Dataset({"abstract": a, "article": ""} for a in papers)), \
+             patch('vectorizer.OpenAI') as MockOpenAI, \
+             patch('vectorizer.count_tokens', side_effect=lambda text: len(text.split())), \
+             patch.dict('os.environ', {"OPENAI_API_KEY": "test", "INDEX_GENERATION_PATH": str(tmp_path / "generation")}):
+            MockOpenAI.return_value.embeddings.create.side_effect = fake_embeddings_create
+            vectorizer.main([
+                *flags, "--sync-manifest", str(tmp_path / manifest),
+                "--vector-store", "local", "--local-store-path", str(tmp_path / store),
+                "--checkpoint", str(tmp_path / checkpoint),
+                "--no-embedding-cache", "--no-lexical-index",
+            ])
+        embedded_now = list(embedded)
+        embedded.clear()
+        return embedded_now
+
+    assert sync(["first", "second", "third"]) == ["Abstract: first", "Abstract: second", "Abstract: third"]
+    assert sync(["first", "second", "third"]) == []  # Nothing changed, nothing embedded
+    assert sync(["first", "second, revised"]) == ["Abstract: second, revised"]
+
+    store = LocalVectorStore(str(tmp_path / "store"))
+    assert len(store) == 2
+    assert store.fetch_metadata(["arxiv_1", "arxiv_2"]) == {"arxiv_1": {"abstract": "second, revised", "paper": "arxiv_1", "length": 0}}
+    store.close()
+
+    # A first sync after plain runs trusts the checkpoint journal instead of re-embedding
+    assert sync(["first", "second, revised", "fourth"], flags=()) == ["Abstract: fourth"]
+    assert sync(["first", "second, revised", "fourth"], manifest="fresh.db") == []
+    assert sync(["first", "second, again", "fourth"], manifest="fresh.db") == ["Abstract: second, again"]
+
+    # So does a first sync of a store rebuilt from an export
+    papers = ["first", "second, again", "fourth"]
+    export_flags = ("--export", str(tmp_path / "export"))
+    assert len(sync(papers, flags=export_flags, store="source", checkpoint="source.db")) == 3
+    with patch.dict('os.environ', {"INDEX_GENERATION_PATH": str(tmp_path / "generation")}):
+        vectorizer.main([
+            "--from-export", str(tmp_path / "export"),
+            "--vector-store", "local", "--local-store-path", str(tmp_path / "rebuilt"),
+            "--checkpoint", str(tmp_path / "rebuilt.db"), "--no-lexical-index",
+        ])
+    assert sync(papers, manifest="rebuilt_manifest.db", store="rebuilt", checkpoint="rebuilt.db") == []
+
+def test_local_vector_store_metadata_filter(tmp_path):
+    """Filters restrict the scan itself: exact, ANN and selective queries all fill top_k with matches."""
+    import os
+    import numpy as np
+    from vector_store import LocalVectorStore
+    from attribute_index import ATTRIBUTES_FILE
+
+    rng = np.random.default_rng(3)
+    data = rng.normal(size=(600, 16)).astype(np.float32)
+    categories = ["cs.LG", "cs.CL", "math.PR"]
+    metadata = [{"paper": f"arxiv_{i}", "category": categories[i % 3], "year": 2015 + i % 10} for i in range(600)]
+    metadata[7] = {"paper": "arxiv_7"}  # No attributes: never matches
+    store = LocalVectorStore(str(tmp_path / "store"))
+    store.upsert([(f"arxiv_{i}", data[i], metadata[i]) for i in range(600)])
+    query = rng.normal(size=16).astype(np.float32)
+
+    def expected(predicate, k=10):
+        rows = [i for i in range(600) if predicate(metadata[i])]
+        scores = data[rows] @ query / np.linalg.norm(data[rows], axis=1)
+        return [f"arxiv_{rows[j]}" for j in np.argsort(-scores)[:k]]
+
+    recent_lg = "category = 'cs.LG' AND year > 2020"
+    is_recent_lg = lambda m: m.get("category") == "cs.LG" and m.get("year", 0) > 2020
+    assert [r.id for r in store.query(query, top_k=10, filter=recent_lg)] == expected(is_recent_lg)
+    either = "category IN ('cs.CL', 'math.PR') OR (year <= 2016 AND category != 'cs.CL')"
+    is_either = lambda m: m.get("category") in ("cs.CL", "math.PR") or (m.get("year", 9999) <= 2016 and m.get("category", "cs.CL") != "cs.CL")
+    assert [r.id for r in store.query(query, top_k=10, filter=either)] == expected(is_either)
+    # Selective enough to score the matching rows only
+    assert [r.id for r in store.query(query, top_k=10, filter="year = 2019 AND category = 'cs.LG'")] == expected(lambda m: m.get("year") == 2019 and m.get("category") == "cs.LG")
+    assert store.query(query, top_k=10, filter="year > 3000") == []
+
+    # The ANN path keeps only matching candidates and scans further if the probed lists run short
+    store.build_ann_index(n_lists=8)
+    assert [r.id for r in store.query(query, top_k=10, nprobe=8, filter=recent_lg)] == expected(is_recent_lg)
+    assert len(store.query(query, top_k=10, nprobe=1, filter=recent_lg)) == 10
+
+    # Upserts re-index attributes, deletes clear them, reopening restores them
+    store.upsert([("arxiv_0", query, {"category": "q-bio", "year": 2024})])
+    assert [r.id for r in store.query(query, top_k=5, filter="category = 'q-bio'")] == ["arxiv_0"]
+    store.delete(["arxiv_0"])
+    assert store.query(query, top_k=5, filter="category = 'q-bio'") == []
+    store.close()
+    os.remove(tmp_path / "store" / ATTRIBUTES_FILE)  # Rebuilt from the metadata sidecar
+    reopened = LocalVectorStore(str(tmp_path / "store"))
+    assert [r.id for r in reopened.query(query, top_k=10, exact=True, filter=recent_lg)] == expected(is_recent_lg)
+
+    for bad in ("category = ", "category ~ 'x'", "year > 'soon'", "title = 'x'"):
+        with pytest.raises(ValueError):
+            reopened.query(query, top_k=10, filter=bad)
+
+def test_search_endpoint_passes_metadata_filter(client, mock_main_openai_client, mock_main_upstash_index):
+    """/api/v1/search forwards the filter to the vector index and returns one result per paper."""
+    mock_main_upstash_index.query.return_value = [
+        MagicMock(id="arxiv_1_chunk_2", score=0.9, metadata={"paper": "arxiv_1", "chunk": 2, "text": "Chunk", "category": "cs.LG", "year": 2021}),
+        MagicMock(id="arxiv_1", score=0.8, metadata={"paper": "arxiv_1", "abstract": "Abstract", "category": "cs.LG", "year": 2021}),
+        MagicMock(id="arxiv_2", score=0.7, metadata={"paper": "arxiv_2", "abstract": "Other", "category": "cs.LG", "year": 2023}),
+    ]
+    response = client.get("/api/v1/search", query_string={"q": "transformers", "filter": "category = 'cs.LG' AND year > 2020", "top_k": 5})
+    assert response.status_code == 200
+    assert mock_main_upstash_index.query.call_args.kwargs["filter"] == "category = 'cs.LG' AND year > 2020"
+    results = response.get_json()["results"]
+    assert [(r["paper"], r["id"], r["text"], r["year"]) for r in results] == [("arxiv_1", "arxiv_1_chunk_2", "Chunk", 2021), ("arxiv_2", "arxiv_2", "Other", 2023)]
+
+    assert client.get("/api/v1/search", query_string={"q": "x", "filter": "year >"}).status_code == 400
+    assert client.get("/api/v1/search").status_code == 400
+
+def test_local_vector_store_query_many_matches_single_queries(tmp_path):
+    """query_many returns what one query per vector would, filtered or not, with or without ANN."""
+    import numpy as np
+    from vector_store import LocalVectorStore
+
+    rng = np.random.default_rng(4)
+    data = rng.normal(size=(700, 16)).astype(np.float32)
+    store = LocalVectorStore(str(tmp_path / "store"))
+    store.upsert([(f"arxiv_{i}", data[i], {"year": 2000 + i % 20}) for i in range(700)])
+    vectors = rng.normal(size=(30, 16)).astype(np.float32)
+
+    def check(**options):
+        queries = [{"vector": v, "top_k": 3 + i % 5, "include_metadata": True, **options} for i, v in enumerate(vectors)]
+        batched = store.query_many(queries=queries)
+        single = [store.query(**query) for query in queries]
+        assert [[r.id for r in hits] for hits in batched] == [[r.id for r in hits] for hits in single]
+        assert all(r.metadata is not None for hits in batched for r in hits)
+
+    check()
+    check(filter="year >= 2015")
+    store.build_ann_index(n_lists=8)
+    check(nprobe=2)  # Answered query by query
+    check(exact=True, filter="year < 2003")
+
+def test_batch_answer_streams_jsonl_with_bounded_concurrency(client, mock_main_openai_client, tmp_path):
+    """/api/v1/batch-answer embeds in one call, retrieves in one pass and caps completions in flight."""
+    import json, threading, time
+    import numpy as np
+    from vector_store import LocalVectorStore
+
+    store = LocalVectorStore(str(tmp_path / "store"))
+    store.upsert([(f"arxiv_{i}", np.eye(8)[i], {"paper": f"arxiv_{i}", "abstract": f"Abstract {i}"}) for i in range(8)])
+    mock_main_openai_client.embeddings.create.side_effect = lambda model, input: MagicMock(
+        data=[MagicMock(embedding=np.eye(8)[int(text.split()[-1])].tolist()) for text in input]
+    )
+    lock = threading.Lock()
+    in_flight = [0, 0]  # current, peak
+    def fake_completion(model, messages):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        return MagicMock(choices=[MagicMock(message=MagicMock(content=f"Answer to {messages[-1]['content']}"))])
+    mock_main_openai_client.chat.completions.create.side_effect = fake_completion
+
+    questions = [f"Question {i % 8}" for i in range(12)]
+    with patch('main.upstash_index', store):
+        response = client.post("/api/v1/batch-answer", json={"questions": questions, "concurrency": 3})
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert response.mimetype == "application/x-ndjson"
+    assert sorted(line["index"] for line in lines) == list(range(12))
+    for line in lines:
+        assert line["answer"] == f"Answer to {questions[line['index']]}" and line["error"] is None
+        assert line["papers"][0] == f"arxiv_{line['index'] % 8}"
+        assert {"embed_batch_ms", "retrieval_batch_ms", "completion_ms", "elapsed_ms"} <= set(line["timings"])
+    assert mock_main_openai_client.embeddings.create.call_count == 1
+    assert 1 < in_flight[1] <= 3
+
+    assert client.post("/api/v1/batch-answer", json={"questions": "not a list"}).status_code == 400
+
+def test_batch_answer_reports_errors_before_and_during_the_stream(client, mock_main_openai_client, mock_main_upstash_index):
+    """Embed and retrieval failures get an error status; a failed prompt fails only its own line."""
+    import json
+    with patch('main.upstash_index', None):
+        assert client.post("/api/v1/batch-answer", json={"questions": ["Q"]}).status_code == 503
+
+    mock_main_openai_client.embeddings.create.side_effect = RuntimeError("embeddings down")
+    response = client.post("/api/v1/batch-answer", json={"questions": ["Q"]})
+    assert response.status_code == 502 and response.get_json() == {"error": "embeddings down"}
+
+    mock_main_openai_client.embeddings.create.side_effect = lambda model, input: MagicMock(
+        data=[MagicMock(embedding=[0.1, 0.2, 0.3]) for _ in input]
+    )
+    mock_main_upstash_index.query_many.return_value = [[], []]
+    build = main_module.build_chat_messages
+    def flaky_build(question, *args):
+        if question == "Bad":
+            raise ValueError("prompt failed")
+        return build(question, *args)
+    with patch('main.build_chat_messages', side_effect=flaky_build):
+        response = client.post("/api/v1/batch-answer", json={"questions": ["Good", "Bad"]})
+        lines = {line["question"]: line for line in map(json.loads, response.get_data(as_text=True).splitlines())}
+    assert response.status_code == 200
+    assert lines["Good"]["answer"] == "Mocked bot reply" and lines["Good"]["error"] is None
+    assert lines["Bad"]["answer"] is None and lines["Bad"]["error"] == "prompt failed"
+
+def test_single_flight_shares_results_and_errors():
+    """Callers arriving while a call is in flight share its result or exception; later callers run again."""
+    import threading, time
+    from single_flight import SingleFlight, normalize_query
+
+    assert normalize_query("  What is\tATTENTION? ") == normalize_query("what is attention?")
+    flight = SingleFlight()
+    runs = []
+    def slow(value):
+        runs.append(value)
+        time.sleep(0.2)
+        if value == "boom":
+            raise RuntimeError("upstream failed")
+        return value
+
+    outcomes = []
+    def call(key):
+        try:
+            outcomes.append(flight.do("embed", key, lambda: slow(key)))
+        except RuntimeError as error:
+            outcomes.append(("error", str(error)))
+    threads = [threading.Thread(target=call, args=(key,)) for key in ["a"] * 4 + ["boom"] * 2]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(runs) == ["a", "boom"]
+    assert sorted(outcomes, key=str) == [("a", False)] + [("a", True)] * 3 + [("error", "upstream failed")] * 2
+    assert flight.stats()["embed"] == {"executed": 2, "shared": 4, "saved_ratio": 4 / 6}
+    assert flight.in_flight() == 0
+    assert flight.do("embed", "a", lambda: "again") == ("again", False)
+
+def test_get_bot_reply_coalesces_identical_concurrent_questions(mock_main_openai_client, mock_main_upstash_index):
+    """Concurrent replies to the same question make one embedding, one retrieval and, when prompts match, one completion."""
+    import threading, time
+    main_module.single_flight = None
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+    def slow(result):
+        def call(*args, **kwargs):
+            time.sleep(0.3)
+            return result
+        return call
+    mock_main_openai_client.embeddings.create.side_effect = slow(mock_main_openai_client.embeddings.create.return_value)
+    mock_main_upstash_index.query.side_effect = slow(mock_main_upstash_index.query.return_value)
+    mock_main_openai_client.chat.completions.create.side_effect = slow(mock_main_openai_client.chat.completions.create.return_value)
+
+    questions = ["What is attention?"] * 4 + ["  what is ATTENTION? "]
+    bot_ids = [_pending_bot_message(question) for question in questions]
+
+    replies = []
+    def fetch(bot_id):
+        replies.append(app.test_client().get(f"/api/v1/get-bot-reply/{bot_id}").status_code)
+    with patch.dict(app.config, {"SINGLE_FLIGHT_COMPLETIONS": True}):
+        threads = [threading.Thread(target=fetch, args=(bot_id,)) for bot_id in bot_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert replies == [200] * 5
+    assert mock_main_openai_client.embeddings.create.call_count == 1
+    assert mock_main_upstash_index.query.call_count == 1
+    # The differently written question has its own prompt, hence its own completion
+    assert mock_main_openai_client.chat.completions.create.call_count == 2
+    stats = app.test_client().get("/api/v1/cache-stats").get_json()["single_flight"]
+    assert stats["embed"]["shared"] == 4 and stats["retrieval"]["shared"] == 4 and stats["completion"]["shared"] == 3
+    assert 'rag_coalesced_calls_total{stage="embed"}' in app.test_client().get("/metrics").get_data(as_text=True)
+    with app.app_context():
+        assert all(db.session.get(HistoryMessage, bot_id).message == "Mocked bot reply" for bot_id in bot_ids)
+
+def test_serve_prefork_workers_and_graceful_shutdown(tmp_path):
+    """serve.py forks workers on one socket, replaces a dead one and exits cleanly on SIGTERM."""
+    import os, re, signal, subprocess, sys, time, urllib.request
+    env = dict(
+        os.environ,
+        PORT="0",
+        WEB_CONCURRENCY="2",
+        VECTOR_STORE="local",
+        OPENAI_API_KEY="test_openai_key",
+        LOCAL_VECTOR_STORE_PATH=str(tmp_path / "vector_store"),
+        DATABASE_URL=f"sqlite:///{tmp_path / 'chat.db'}",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "serve.py"], env=env, stderr=subprocess.PIPE, text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    try:
+        port = int(re.search(r":(\d+) with 2 workers", server.stderr.readline()).group(1))
+        workers = [int(re.search(r"worker (\d+)", server.stderr.readline()).group(1)) for _ in range(2)]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/") as response:
+            assert response.status == 200
+
+        os.kill(workers[0], signal.SIGKILL)
+        line = ""
+        while "Started worker" not in line:
+            line = server.stderr.readline()
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.status == 200
+
+        started = time.monotonic()
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(timeout=15) == 0
+        assert time.monotonic() - started < 10
+    finally:
+        if server.poll() is None:
+            server.kill()
+        server.stderr.close()
+
+def _async_server_request(path, pipeline=None):
+    """Issue one request against the aiohttp server; returns (status, body)."""
+    import asyncio
+    from aiohttp.test_utils import TestClient, TestServer
+    import async_server
+
+    async def run():
+        server_app = async_server.create_app()
+        if pipeline is not None:
+            server_app[async_server.PIPELINE_KEY] = pipeline
+        async with TestClient(TestServer(server_app)) as test_client:
+            response = await test_client.get(path)
+            return response.status, await response.text()
+
+    return asyncio.run(run())
+
+def _fake_async_pipeline(completion_delay=0.0, **timeouts):
+    from unittest.mock import AsyncMock
+    import asyncio
+    import async_server
+
+    pipeline = async_server.AsyncRAGPipeline("fake_key", upstash_token="fake_token", **timeouts)
+    embedding_obj = MagicMock(embedding=[0.1, 0.2, 0.3])
+    pipeline.openai = MagicMock()
+    pipeline.openai.embeddings.create = AsyncMock(return_value=MagicMock(data=[embedding_obj]))
+
+    async def complete(**kwargs):
+        await asyncio.sleep(completion_delay)
+        message_obj = MagicMock(content="Async bot reply")
+        return MagicMock(choices=[MagicMock(message=message_obj)])
+    pipeline.openai.chat.completions.create = AsyncMock(side_effect=complete)
+    pipeline.index = MagicMock()
+    pipeline.index.query = AsyncMock(return_value=[MagicMock(metadata={"abstract": "Async abstract"})])
+    return pipeline
+
+def test_async_server_get_bot_reply():
+    """The async path embeds, queries and completes on the async clients and persists the reply."""
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+    bot_message_id = _pending_bot_message()
+    pipeline = _fake_async_pipeline()
+
+    status, body = _async_server_request(f'/api/v1/get-bot-reply/{bot_message_id}', pipeline)
+    assert status == 200
+    assert "Async bot reply" in body
+    pipeline.index.query.assert_awaited_once()
+    messages = pipeline.openai.chat.completions.create.call_args.kwargs["messages"]
+    assert "Async abstract" in messages[0]["content"]
+
+    with app.app_context():
+        updated_bot_msg = db.session.get(HistoryMessage, bot_message_id)
+        assert updated_bot_msg.message == "Async bot reply"
+        assert updated_bot_msg.is_pending == False
+
+def test_async_server_stage_timeouts():
+    """A slow vector query returns 504 and leaves the message pending; a slow completion stores the error reply."""
+    import asyncio
+    from unittest.mock import AsyncMock
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+    bot_message_id = _pending_bot_message()
+
+    slow_query = _fake_async_pipeline(query_timeout=0.05)
+    async def slow(**kwargs):
+        await asyncio.sleep(1)
+    slow_query.index.query = AsyncMock(side_effect=slow)
+    status, body = _async_server_request(f'/api/v1/get-bot-reply/{bot_message_id}', slow_query)
+    assert status == 504
+    with app.app_context():
+        assert db.session.get(HistoryMessage, bot_message_id).is_pending == True
+
+    slow_completion = _fake_async_pipeline(completion_delay=1, completion_timeout=0.05)
+    status, body = _async_server_request(f'/api/v1/get-bot-reply/{bot_message_id}', slow_completion)
+    assert status == 200
+    assert main_module.COMPLETION_ERROR_MESSAGE in body
+    with app.app_context():
+        assert db.session.get(HistoryMessage, bot_message_id).is_pending == False
+
+def test_async_server_stream_saves_reply_after_disconnect():
+    """A client that leaves mid-stream still gets the full reply stored."""
+    import asyncio
+    from aiohttp.test_utils import TestClient, TestServer
+    import async_server
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+    bot_message_id = _pending_bot_message()
+    pipeline = _fake_async_pipeline()
+    async def stream(messages):
+        for delta in ["Streamed ", "after ", "disconnect"]:
+            await asyncio.sleep(0.1)
+            yield delta
+    pipeline.stream = stream
+
+    async def run():
+        server_app = async_server.create_app()
+        server_app[async_server.PIPELINE_KEY] = pipeline
+        server = TestServer(server_app, handler_cancellation=True)
+        async with TestClient(server) as test_client:
+            response = await test_client.get(f'/api/v1/stream-bot-reply/{bot_message_id}')
+            assert (await response.content.readline()).startswith(b"event: delta")
+            response.close()
+            while async_server._background_tasks:
+                await asyncio.sleep(0.05)
+    asyncio.run(run())
+
+    with app.app_context():
+        updated_bot_msg = db.session.get(HistoryMessage, bot_message_id)
+        assert updated_bot_msg.message == "Streamed after disconnect"
+        assert updated_bot_msg.is_pending == False
+
+def test_async_server_get_bot_reply_saves_reply_after_disconnect():
+    """A client that leaves during the completion still gets the reply stored."""
+    import asyncio
+    from aiohttp.test_utils import TestClient, TestServer
+    import async_server
+    app.config["OPENAI_API_KEY"] = "fake_key"
+    app.config["UPSTASH_TOKEN"] = "fake_token"
+    bot_message_id = _pending_bot_message()
+    pipeline = _fake_async_pipeline(completion_delay=0.3)
+
+    async def run():
+        server_app = async_server.create_app()
+        server_app[async_server.PIPELINE_KEY] = pipeline
+        server = TestServer(server_app, handler_cancellation=True)
+        async with TestClient(server) as test_client:
+            with pytest.raises(asyncio.TimeoutError):
+                await test_client.get(f'/api/v1/get-bot-reply/{bot_message_id}', timeout=0.1)
+            await asyncio.sleep(0.5)  # Past the completion delay
+    asyncio.run(run())
+
+    with app.app_context():
+        updated_bot_msg = db.session.get(HistoryMessage, bot_message_id)
+        assert updated_bot_msg.message == "Async bot reply"
+        assert updated_bot_msg.is_pending == False
+
+def test_async_upstash_index_queries_on_the_shared_client():
+    """Upstash queries go through the pipeline's own pool, which aclose shuts."""
+    import asyncio, json
+    import httpx
+    import async_server
+
+    requests = []
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json={"result": [{"id": "arxiv_1", "score": 0.9, "metadata": {"abstract": "A"}}]})
+
+    pipeline = async_server.AsyncRAGPipeline("fake_key", upstash_token="fake_token")
+    pipeline.http_client = pipeline.index.http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def run():
+        [hit] = await pipeline.query([0.1, 0.2], top_k=3)
+        await pipeline.aclose()
+        return hit
+    hit = asyncio.run(run())
+
+    assert (hit.id, hit.score, hit.metadata) == ("arxiv_1", 0.9, {"abstract": "A"})
+    assert requests[0].headers["Authorization"] == "Bearer fake_token"
+    assert json.loads(requests[0].content) == {"vector": [0.1, 0.2], "topK": 3, "includeMetadata": True}
+    assert pipeline.http_client.is_closed
+
+def test_async_pipeline_coalesces_identical_questions():
+    """Concurrent identical questions share one embedding and one retrieval on the async path."""
+    import asyncio
+    from unittest.mock import AsyncMock
+    pipeline = _fake_async_pipeline()
+    async def slow_embed(model, input):
+        await asyncio.sleep(0.05)
+        return MagicMock(data=[MagicMock(embedding=[0.1, 0.2, 0.3])])
+    pipeline.openai.embeddings.create = AsyncMock(side_effect=slow_embed)
+
+    async def run():
+        first, second = await asyncio.gather(
+            pipeline.retrieve("What is attention?", []),
+            pipeline.retrieve("what is  ATTENTION?", []),
+        )
+        await pipeline.aclose()
+        return first, second
+    first, second = asyncio.run(run())
+
+    assert first[1] is not None and "Async abstract" in first[1][0]["content"]
+    assert second[1] is not None
+    assert pipeline.openai.embeddings.create.await_count == 1
+    assert pipeline.index.query.await_count == 1
+    assert pipeline.single_flight.stats()["embed"] == {"executed": 1, "shared": 1, "saved_ratio": 0.5}
+
+def test_async_server_bridges_other_routes_to_flask():
+    """Routes without an async handler are served by the Flask app."""
+    with app.app_context():
+        db.session.add(History(title="Bridged session"))
+        db.session.commit()
+
+    status, body = _async_server_request('/sidebar')
+    assert status == 200
+    assert "Bridged session" in body
+
+def test_async_server_streams_bridged_batch_answers(mock_main_openai_client, mock_main_upstash_index):
+    """Bridged streaming responses reach the client line by line, not once the app finishes."""
+    import asyncio, json, threading
+    from aiohttp.test_utils import TestClient, TestServer
+    import async_server
+
+    first_read = threading.Event()
+    def fake_answers(questions, concurrency, metadata_filter):
+        yield {"index": 0, "answer": "first"}
+        assert first_read.wait(5), "second answer produced before the first was delivered"
+        yield {"index": 1, "answer": "second"}
+
+    async def run():
+        async with TestClient(TestServer(async_server.create_app())) as test_client:
+            response = await test_client.post("/api/v1/batch-answer", json={"questions": ["a", "b"]})
+            assert response.headers["Content-Type"] == "application/x-ndjson"
+            first = json.loads(await response.content.readline())
+            first_read.set()
+            return first, [json.loads(line) for line in (await response.text()).splitlines()]
+
+    with patch('main.answer_questions', side_effect=fake_answers):
+        first, rest = asyncio.run(run())
+    assert first["answer"] == "first"
+    assert [line["answer"] for line in rest] == ["second"]
+
 # Add this section to make the file directly executable
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,180 @@
+"""Pre-fork production server for the chat app.
+
+    python serve.py
+
+The parent imports the app once, binds the port and forks WEB_CONCURRENCY
+workers that accept from the shared socket, each running a threaded
+WSGI server. Dead workers are replaced. On SIGTERM or SIGINT the workers
+stop accepting, finish in-flight requests for up to GRACEFUL_TIMEOUT
+seconds and are then killed.
+
+Configuration comes from the environment: OPENAI_API_KEY, UPSTASH_TOKEN
+and the settings read in main.py, plus HOST, PORT, WEB_CONCURRENCY and
+GRACEFUL_TIMEOUT.
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+logger = logging.getLogger("serve")
+
+# =====================================================
+# Configuration
+# =====================================================
+DEFAULT_PORT = 8080
+DEFAULT_GRACEFUL_TIMEOUT = 30.0
+LISTEN_BACKLOG = 2048
+RESPAWN_DELAY = 1.0  # Pause before replacing a worker, so a crash loop cannot spin
+
+
+def default_workers():
+    """One worker per CPU this process may run on (cgroup/affinity aware)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # macOS
+        return os.cpu_count() or 1
+
+
+# =====================================================
+# Worker
+# =====================================================
+def run_worker(app_module, sock, graceful_timeout):
+    """Serve from the inherited socket until SIGTERM, then drain and exit."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent decides when to stop
+    app_module.init_worker()
+
+    server = make_server(
+        sock.getsockname()[0],
+        sock.getsockname()[1],
+        app_module.app,
+        threaded=True,
+        fd=sock.fileno(),
+    )
+    # Non-daemon request threads are joined by server_close(), which is the drain
+    server.daemon_threads = False
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, which runs in this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        app_module.shutdown_worker(graceful_timeout)
+
+
+# =====================================================
+# Supervisor
+# =====================================================
+class Supervisor:
+    def __init__(self, app_module, sock, workers, graceful_timeout):
+        self.app_module = app_module
+        self.sock = sock
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.children = set()
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.app_module, self.sock, self.graceful_timeout)
+            except BaseException:
+                logger.exception("Worker %s crashed", os.getpid())
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        self.children.add(pid)
+        logger.info("Started worker %s", pid)
+
+    def reap(self):
+        """Forget exited workers; returns how many there were."""
+        exited = 0
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            self.children.discard(pid)
+            exited += 1
+            if not self.stopping:
+                logger.warning(
+                    "Worker %s exited with status %s", pid, os.waitstatus_to_exitcode(status)
+                )
+        return exited
+
+    def request_stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        for _ in range(self.workers):
+            self.spawn()
+
+        while not self.stopping:
+            time.sleep(0.2)
+            if self.reap() and not self.stopping:
+                time.sleep(RESPAWN_DELAY)
+                while len(self.children) < self.workers and not self.stopping:
+                    self.spawn()
+
+        self.shutdown()
+
+    def shutdown(self):
+        logger.info("Stopping %d workers", len(self.children))
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.children.discard(pid)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.05)
+        for pid in list(self.children):
+            logger.warning("Killing worker %s after %.0fs", pid, self.graceful_timeout)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self.children.clear()
+        self.sock.close()
+
+
+def main():
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", DEFAULT_PORT))
+    workers = int(os.getenv("WEB_CONCURRENCY", default_workers()))
+    graceful_timeout = float(os.getenv("GRACEFUL_TIMEOUT", DEFAULT_GRACEFUL_TIMEOUT))
+
+    # Imported before forking so workers share the loaded code copy-on-write;
+    # clients, connections and threads are only created in the workers
+    import main as app_module
+
+    app_module.precompile_templates()
+    sock = socket.create_server((host, port), backlog=LISTEN_BACKLOG)
+    sock.set_inheritable(True)
+    logger.info(
+        "Listening on %s:%s with %d workers", *sock.getsockname()[:2], workers
+    )
+    Supervisor(app_module, sock, workers, graceful_timeout).run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+
+
+def normalize_query(text):
+    """Case- and whitespace-insensitive form of a question, used in flight keys."""
+    return " ".join(text.casefold().split())
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapses concurrent identical calls into one.
+
+    The first caller of ``do`` for a key runs the function; callers that
+    arrive with the same key while it is running wait for it and receive
+    its result, or its exception. Nothing is kept once the call finishes,
+    so later callers run it again (caching is the caches' job). Keys are
+    namespaced by ``group``, and each group counts the calls it ran and the
+    ones it saved by sharing.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # (group, key) -> _Call in flight
+        self._counts = {}  # group -> [executed, shared]
+
+    def do(self, group, key, fn):
+        """Return ``(result, shared)``; ``shared`` is True if another caller ran ``fn``."""
+        flight_key = (group, key)
+        with self._lock:
+            counts = self._counts.setdefault(group, [0, 0])
+            call = self._calls.get(flight_key)
+            leader = call is None
+            if leader:
+                call = self._calls[flight_key] = _Call()
+                counts[0] += 1
+            else:
+                counts[1] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[flight_key]
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self):
+        with self._lock:
+            return _stats(self._counts)
+
+
+class AsyncSingleFlight:
+    """``SingleFlight`` for coroutines, on one event loop.
+
+    The first caller's coroutine runs as a task that every caller awaits
+    through ``asyncio.shield``: a caller cancelled by its client going away
+    leaves the call running for the others.
+    """
+
+    def __init__(self):
+        self._tasks = {}  # (group, key) -> task in flight
+        self._counts = {}  # group -> [executed, shared]
+
+    async def do(self, group, key, fn):
+        """Return ``(await fn(), shared)``, sharing the call with identical ones in flight."""
+        flight_key = (group, key)
+        counts = self._counts.setdefault(group, [0, 0])
+        task = self._tasks.get(flight_key)
+        shared = task is not None
+        if shared:
+            counts[1] += 1
+        else:
+            counts[0] += 1
+            task = self._tasks[flight_key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done: self._forget(flight_key, done))
+        return await asyncio.shield(task), shared
+
+    def _forget(self, flight_key, task):
+        del self._tasks[flight_key]
+        if not task.cancelled():
+            task.exception()  # Retrieved, even if every caller was cancelled
+
+    def in_flight(self):
+        return len(self._tasks)
+
+    def stats(self):
+        return _stats(self._counts)
+
+
+def _stats(counts):
+    return {
+        group: {
+            "executed": executed,
+            "shared": shared,
+            "saved_ratio": shared / (executed + shared) if executed + shared else 0.0,
+        }
+        for group, (executed, shared) in counts.items()
+    }
@@ -0,0 +1,38 @@
+// Streams a bot reply into its placeholder as the completion is generated.
+// Falls back to the blocking get-bot-reply endpoint if the stream fails.
+function streamBotReply(container) {
+  if (container.dataset.streamStarted) return;
+  container.dataset.streamStarted = "true";
+
+  const bubble = container.querySelector("p");
+  const source = new EventSource(container.dataset.streamUrl);
+  let text = "";
+
+  source.addEventListener("delta", (event) => {
+    text += JSON.parse(event.data).text;
+    bubble.textContent = text;
+    bubble.classList.remove("animate-pulse");
+  });
+
+  source.addEventListener("done", (event) => {
+    source.close();
+    container.innerHTML = JSON.parse(event.data).html;
+    // A reply generated elsewhere arrives as a placeholder that polls for it
+    htmx.process(container);
+  });
+
+  source.onerror = () => {
+    source.close();
+    htmx.ajax("GET", container.dataset.fallbackUrl, {
+      target: container,
+      swap: "innerHTML",
+    });
+  };
+}
+
+document.addEventListener("htmx:load", (event) => {
+  const root = event.detail.elt;
+  if (!(root instanceof Element)) return;
+  if (root.matches("[data-stream-url]")) streamBotReply(root);
+  root.querySelectorAll("[data-stream-url]").forEach(streamBotReply);
+});
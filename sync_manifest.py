@@ -0,0 +1,95 @@
+import hashlib
+import sqlite3
+import time
+
+# =====================================================
+# Sync manifest for vectorizer.py --sync
+# =====================================================
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id TEXT PRIMARY KEY,
+    paper INTEGER NOT NULL,
+    fingerprint BLOB NOT NULL,
+    synced_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_records_paper ON records (paper);
+"""
+
+
+def fingerprint(model, text):
+    """Changes whenever the embedded text (prompt prefix included) or the model does."""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+
+
+class SyncManifest:
+    """Fingerprint of every record as of its last successful upsert.
+
+    A record is re-embedded only when its fingerprint differs from the one
+    stored here. Fingerprints are ``stage``d when a record is queued and
+    written by ``mark_upserted``, so a failed upsert is retried next sync.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        self._staged = {}  # id -> (paper, fingerprint) awaiting upsert
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def paper_fingerprints(self, paper):
+        """{id: fingerprint} of the records last synced for dataset index ``paper``."""
+        rows = self.conn.execute(
+            "SELECT id, fingerprint FROM records WHERE paper = ?", (paper,)
+        )
+        return dict(rows.fetchall())
+
+    def stage(self, record_id, paper, record_fingerprint):
+        self._staged[record_id] = (paper, record_fingerprint)
+
+    def mark_upserted(self, ids):
+        now = time.time()
+        staged = [(i, *self._staged.pop(i), now) for i in ids if i in self._staged]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO records (id, paper, fingerprint, synced_at) "
+                "VALUES (?, ?, ?, ?)",
+                staged,
+            )
+
+    def seed(self, entries):
+        """Record (id, paper, fingerprint) entries as synced without an upsert."""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO records (id, paper, fingerprint, synced_at) "
+                "VALUES (?, ?, ?, ?)",
+                [(*entry, now) for entry in entries],
+            )
+
+    def remove(self, ids):
+        with self.conn:
+            self.conn.executemany("DELETE FROM records WHERE id = ?", [(i,) for i in ids])
+
+    def vanished_ids(self, total, start=0, end=None, shard=(0, 1)):
+        """Ids of papers in the selection whose dataset index is now past ``total``."""
+        k, n = shard
+        query = "SELECT id FROM records WHERE paper >= ? AND paper % ? = ?"
+        params = [max(total, start), n, k]
+        if end is not None:
+            query += " AND paper < ?"
+            params.append(end)
+        return [row[0] for row in self.conn.execute(query, params)]
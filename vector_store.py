@@ -0,0 +1,631 @@
+import os
+import json
+import fcntl
+import sqlite3
+import threading
+
+import numpy as np
+
+from ann_index import IVFIndex, DEFAULT_NPROBE
+from attribute_index import AttributeIndex, DEFAULT_ATTRIBUTE_FIELDS
+from quantization import create_codec, save_codec, load_codec
+
+# =====================================================
+# Configuration
+# =====================================================
+UPSTASH_URL = "https://capable-midge-9649-eu1-vector.upstash.io"
+DEFAULT_LOCAL_STORE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "instance", "vector_store"
+)
+BACKENDS = ("upstash", "local")
+
+VECTORS_FILE = "vectors.f32"
+CODES_FILE = "codes.bin"
+CODEC_FILE = "codec.npz"
+METADATA_FILE = "metadata.db"
+LOCK_FILE = "write.lock"
+BLOCK_ROWS = 4096  # Rows scored per matrix-vector product (~25 MB at 1536 dims)
+INITIAL_CAPACITY = 1024
+DEFAULT_RERANK = 50  # Candidates re-scored with float32 vectors when compressed
+MAX_CODEC_TRAINING_POINTS = 50_000
+# Filters matching at most this share of the rows score only those rows
+PREFILTER_FRACTION = 0.05
+QUERY_BATCH = 256  # Queries scored together per matrix product in query_many
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vectors (
+    id TEXT PRIMARY KEY,
+    row INTEGER NOT NULL UNIQUE,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class QueryResult:
+    """Mirrors the fields of ``upstash_vector.types.QueryResult``."""
+
+    def __init__(self, id, score, vector=None, metadata=None):
+        self.id = id
+        self.score = score
+        self.vector = vector
+        self.metadata = metadata
+
+    def __repr__(self):
+        return f"QueryResult(id={self.id!r}, score={self.score:.4f})"
+
+
+class VectorStore:
+    """The subset of the Upstash ``Index`` API that the app relies on.
+
+    ``upstash_vector.Index`` satisfies it as is; local engines subclass it.
+    Scores follow Upstash's cosine convention, ``(1 + cos) / 2`` in [0, 1].
+    """
+
+    def upsert(self, vectors):
+        raise NotImplementedError
+
+    def query(
+        self, vector, top_k=10, include_vectors=False, include_metadata=False, filter=""
+    ):
+        raise NotImplementedError
+
+    def query_many(self, *, queries):
+        """One result list per query dict, in order (Upstash ``QueryRequest`` keys)."""
+        raise NotImplementedError
+
+    def delete(self, ids):
+        raise NotImplementedError
+
+
+def _as_record(vector):
+    """Accept upstash ``Vector`` objects, (id, vector, metadata) tuples or dicts."""
+    if isinstance(vector, dict):
+        return vector["id"], vector["vector"], vector.get("metadata")
+    if isinstance(vector, (tuple, list)):
+        return vector[0], vector[1], vector[2] if len(vector) > 2 else None
+    return vector.id, vector.vector, getattr(vector, "metadata", None)
+
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(scores, k):
+    """Indices of the ``k`` highest scores, best first, via argpartition."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def _top_k_per_column(scores, k):
+    """Row indices of each column's ``k`` highest scores, unordered, shape (k, columns)."""
+    k = min(k, len(scores))
+    return np.argpartition(-scores, k - 1, axis=0)[:k]
+
+
+class LocalVectorStore(VectorStore):
+    """In-process exact cosine search over a memory-mapped float32 matrix.
+
+    Vectors are L2-normalized on write and stored row by row in
+    ``vectors.f32``; ids, row numbers and metadata live in a SQLite sidecar.
+    Queries run a blocked matrix-vector product and keep each block's best
+    rows with ``argpartition`` so memory stays bounded by ``BLOCK_ROWS``.
+    Once ``build_ann_index`` has been run, queries use the IVF index instead
+    unless ``exact=True`` is passed.
+
+    ``query(filter=...)`` takes Upstash filter syntax over the metadata keys
+    in ``attribute_fields``. The filter becomes a row bitmap from the
+    ``AttributeIndex`` before scoring: selective filters score only their
+    matching rows, others mask the scan, so the top k always comes from
+    matching rows instead of being post-filtered.
+
+    After ``compress`` the scan reads compact float16/int8/PQ codes instead of
+    the float32 matrix, and the best ``rerank`` candidates are re-scored
+    exactly from the float32 vectors, which stay on disk.
+
+    Row assignments are kept in memory, so only one process may write to a
+    store: the first write takes an exclusive lock on the store directory,
+    held until ``close``, and writes from any other process raise
+    ``RuntimeError``. Readers take no lock.
+
+    The IVF assignments and attribute index are derived from the rows and
+    are saved by ``flush`` (and ``close``), not on every write. Until then
+    the sidecar marks them stale, and a store opened meanwhile rebuilds them
+    in memory from the rows.
+    """
+
+    def __init__(
+        self,
+        path=DEFAULT_LOCAL_STORE_PATH,
+        nprobe=DEFAULT_NPROBE,
+        rerank=DEFAULT_RERANK,
+        attribute_fields=DEFAULT_ATTRIBUTE_FIELDS,
+    ):
+        self.path = path
+        self.rerank = rerank
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._write_lock = None  # Lock file, held from the first write until close()
+        self._unsaved = set()  # Derived indexes changed since the last flush()
+        self._conn = sqlite3.connect(
+            os.path.join(path, METADATA_FILE), timeout=30, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+        settings = dict(self._conn.execute("SELECT key, value FROM settings"))
+        self.dim = int(settings["dim"]) if "dim" in settings else None
+        self.capacity = int(settings.get("capacity", 0))
+        self._matrix = None
+        self._ids = [None] * self.capacity  # row -> id, None for free rows
+        self._rows = {}  # id -> row
+        for vector_id, row in self._conn.execute("SELECT id, row FROM vectors"):
+            self._ids[row] = vector_id
+            self._rows[vector_id] = row
+        self._live = np.array([i is not None for i in self._ids], dtype=bool)
+        self._size = self._high_water_mark()
+        self.storage = settings.get("storage", "float32")
+        self.codec = None
+        self._codes = None
+        if self.storage != "float32":
+            self.codec = load_codec(os.path.join(path, CODEC_FILE))
+        if self.dim is not None:
+            self._open_matrix()
+        # A writer is mid-run, or stopped without flushing: the saved files lag the rows
+        stale = settings.get("stale") == "1"
+        self.ann = IVFIndex.load(path, nprobe=nprobe)
+        if stale and self.ann is not None:
+            self.ann.reassign(self._matrix, np.flatnonzero(self._live), self.capacity)
+        self.attributes = None
+        if not stale:
+            self.attributes = AttributeIndex.load(path, attribute_fields, self.capacity)
+        if self.attributes is None:
+            # Stores written before attribute indexing, or indexing other fields
+            self.attributes = AttributeIndex(attribute_fields, self.capacity)
+            rows = self._conn.execute(
+                "SELECT row, metadata FROM vectors WHERE metadata IS NOT NULL"
+            ).fetchall()
+            self.attributes.set([row for row, _ in rows], [json.loads(m) for _, m in rows])
+            if not stale:
+                self.attributes.save(path)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def flush(self):
+        """Save the IVF assignments and attribute index changed since the last flush."""
+        with self._lock:
+            if not self._unsaved:
+                return
+            if "ann" in self._unsaved and self.ann is not None:
+                self.ann.save(self.path)
+            if "attributes" in self._unsaved:
+                self.attributes.save(self.path)
+            self._unsaved.clear()
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO settings (key, value) VALUES ('stale', '0')"
+                )
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._matrix is not None:
+                self._matrix.flush()
+                self._matrix = None
+            if self._codes is not None:
+                self._codes.flush()
+                self._codes = None
+            self._conn.close()
+            if self._write_lock is not None:
+                self._write_lock.close()
+                self._write_lock = None
+
+    # -------------------------------------------------
+    # Storage management
+    # -------------------------------------------------
+    def _vectors_path(self):
+        return os.path.join(self.path, VECTORS_FILE)
+
+    def _high_water_mark(self):
+        live_rows = np.flatnonzero(self._live)
+        return int(live_rows[-1]) + 1 if len(live_rows) else 0
+
+    def _open_matrix(self):
+        if self.capacity == 0:
+            self._matrix = None
+            self._codes = None
+            return
+        self._matrix = np.memmap(
+            self._vectors_path(),
+            dtype=np.float32,
+            mode="r+",
+            shape=(self.capacity, self.dim),
+        )
+        if self.codec is not None:
+            self._codes = np.memmap(
+                os.path.join(self.path, CODES_FILE),
+                dtype=self.codec.dtype,
+                mode="r+",
+                shape=(self.capacity, self.codec.code_width),
+            )
+
+    def _resize_codes_file(self):
+        itemsize = np.dtype(self.codec.dtype).itemsize
+        with open(os.path.join(self.path, CODES_FILE), "ab") as f:
+            f.truncate(self.capacity * self.codec.code_width * itemsize)
+
+    def _ensure_capacity(self, rows_needed):
+        if rows_needed <= self.capacity:
+            return
+        new_capacity = max(INITIAL_CAPACITY, self.capacity)
+        while new_capacity < rows_needed:
+            new_capacity *= 2
+        if self._matrix is not None:
+            self._matrix.flush()
+            self._matrix = None
+        if self._codes is not None:
+            self._codes.flush()
+            self._codes = None
+        with open(self._vectors_path(), "ab") as f:
+            f.truncate(new_capacity * self.dim * 4)
+        self._ids.extend([None] * (new_capacity - self.capacity))
+        self._live = np.concatenate(
+            [self._live, np.zeros(new_capacity - self.capacity, dtype=bool)]
+        )
+        self.capacity = new_capacity
+        self.attributes.resize(new_capacity)
+        if self.codec is not None:
+            self._resize_codes_file()
+        self._open_matrix()
+
+    def _claim_writer(self):
+        """Take the store's write lock, or raise if another process holds it."""
+        if self._write_lock is not None:
+            return
+        lock_file = open(os.path.join(self.path, LOCK_FILE), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise RuntimeError(
+                f"{self.path} is being written by another process; "
+                "concurrent writers must use separate stores"
+            ) from None
+        # A writer that finished since this store was opened moved rows around
+        (stored,) = self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()
+        if stored != len(self._rows):
+            lock_file.close()
+            raise RuntimeError(f"{self.path} changed since it was opened; reopen it to write")
+        self._write_lock = lock_file
+
+    def _mark_unsaved(self, *indexes):
+        """Defer saving ``indexes`` to flush(); call inside the write's transaction."""
+        if not self._unsaved:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES ('stale', '1')"
+            )
+        self._unsaved.update(indexes)
+
+    def _save_settings(self):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+            [
+                ("dim", str(self.dim)),
+                ("capacity", str(self.capacity)),
+                ("storage", self.storage),
+            ],
+        )
+
+    # -------------------------------------------------
+    # VectorStore API
+    # -------------------------------------------------
+    def upsert(self, vectors):
+        records = [_as_record(v) for v in vectors]
+        if not records:
+            return "Success"
+        matrix = normalize_rows([r[1] for r in records])
+
+        with self._lock:
+            self._claim_writer()
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+            if matrix.shape[1] != self.dim:
+                raise ValueError(
+                    f"Expected {self.dim}-dimensional vectors, got {matrix.shape[1]}"
+                )
+
+            free_rows = iter(np.flatnonzero(~self._live[: self._size]).tolist())
+            rows = []
+            for vector_id, _, _ in records:
+                row = self._rows.get(vector_id)
+                if row is None:
+                    row = next(free_rows, None)
+                    if row is None:
+                        row = self._size
+                        self._size += 1
+                    self._rows[vector_id] = row
+                rows.append(row)
+
+            self._ensure_capacity(self._size)
+            for row, (vector_id, _, _) in zip(rows, records):
+                self._ids[row] = vector_id
+            self._matrix[rows] = matrix
+            self._matrix.flush()
+            if self._codes is not None:
+                self._codes[rows] = self.codec.encode(matrix)
+                self._codes.flush()
+            self._live[rows] = True
+            if self.ann is not None:
+                self.ann.add(rows, matrix)
+            self.attributes.set(rows, [metadata for _, _, metadata in records])
+
+            with self._conn:
+                self._mark_unsaved("ann", "attributes")
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO vectors (id, row, metadata) VALUES (?, ?, ?)",
+                    [
+                        (vector_id, row, json.dumps(metadata) if metadata else None)
+                        for row, (vector_id, _, metadata) in zip(rows, records)
+                    ],
+                )
+                self._save_settings()
+        return "Success"
+
+    def delete(self, ids):
+        with self._lock:
+            self._claim_writer()
+            rows = [self._rows.pop(i) for i in ids if i in self._rows]
+            for row in rows:
+                self._ids[row] = None
+            if rows:
+                self._live[rows] = False
+                self._matrix[rows] = 0.0
+                self._matrix.flush()
+                if self.ann is not None:
+                    self.ann.remove(rows)
+                self.attributes.clear(rows)
+            self._size = self._high_water_mark()
+            with self._conn:
+                if rows:
+                    self._mark_unsaved("ann", "attributes")
+                self._conn.executemany(
+                    "DELETE FROM vectors WHERE row = ?", [(row,) for row in rows]
+                )
+        return len(rows)
+
+    def fetch_metadata(self, ids):
+        """Sidecar lookup of metadata keyed by id."""
+        if not ids:
+            return {}
+        placeholders = ",".join("?" * len(ids))
+        rows = self._conn.execute(
+            f"SELECT id, metadata FROM vectors WHERE id IN ({placeholders})", list(ids)
+        )
+        return {i: json.loads(m) if m else None for i, m in rows}
+
+    def compress(self, storage, **options):
+        """Switch the scan to ``storage`` codes ("float16", "int8", "pq" or "float32").
+
+        Trainable codecs are fitted on a sample of the current vectors; all
+        rows are then encoded and later upserts are encoded incrementally.
+        """
+        with self._lock:
+            self._claim_writer()
+            if storage == "float32":
+                self.codec = None
+                self._codes = None
+                self.storage = storage
+                with self._conn:
+                    self._save_settings()
+                return None
+            rows = np.flatnonzero(self._live)
+            if len(rows) == 0:
+                raise ValueError("Cannot train a codec over an empty store")
+            rng = np.random.default_rng(0)
+            sample = np.sort(
+                rng.choice(rows, min(len(rows), MAX_CODEC_TRAINING_POINTS), replace=False)
+            )
+            codec = create_codec(storage, self.dim, **options)
+            codec.train(self._matrix[sample])
+
+            self.codec = codec
+            self.storage = storage
+            self._codes = None
+            self._resize_codes_file()
+            self._open_matrix()
+            for start in range(0, self._size, BLOCK_ROWS):
+                end = min(start + BLOCK_ROWS, self._size)
+                self._codes[start:end] = codec.encode(self._matrix[start:end])
+            self._codes.flush()
+            save_codec(os.path.join(self.path, CODEC_FILE), codec)
+            with self._conn:
+                self._save_settings()
+        return codec
+
+    def memory_footprint(self):
+        """Bytes scanned per query path: the codes if compressed, else the matrix."""
+        if self.codec is not None:
+            return self._codes.nbytes if self._codes is not None else 0
+        return self._matrix.nbytes if self._matrix is not None else 0
+
+    def build_ann_index(self, n_lists=None, nprobe=None):
+        """Train an IVF index over the current vectors and persist it."""
+        with self._lock:
+            self._claim_writer()
+            rows = np.flatnonzero(self._live)
+            if len(rows) == 0:
+                raise ValueError("Cannot build an ANN index over an empty store")
+            self.ann = IVFIndex.train(
+                self._matrix,
+                rows,
+                n_lists=n_lists,
+                nprobe=nprobe or (self.ann.nprobe if self.ann else DEFAULT_NPROBE),
+                capacity=self.capacity,
+            )
+            self.ann.save(self.path)
+            self._unsaved.discard("ann")
+        return self.ann
+
+    def query(
+        self,
+        vector,
+        top_k=10,
+        include_vectors=False,
+        include_metadata=False,
+        exact=False,
+        nprobe=None,
+        filter="",
+    ):
+        if self._matrix is None or not self._rows:
+            return []
+        allowed = None
+        if filter:
+            allowed = self.attributes.mask(filter) & self._live
+            if not allowed.any():
+                return []
+        q = normalize_rows(vector)
+        # With compressed storage, over-fetch on approximate scores and re-rank
+        fetch_k = max(top_k, self.rerank) if self.codec is not None else top_k
+        matching = None if allowed is None else np.flatnonzero(allowed)
+        if matching is not None and len(matching) <= max(
+            fetch_k, PREFILTER_FRACTION * len(self._rows)
+        ):
+            rows, scores = self._scan_rows(q, matching, fetch_k)
+        elif self.ann is not None and not exact:
+            rows, scores = self._scan_ann(q, fetch_k, nprobe, allowed)
+            if len(rows) < min(fetch_k, len(matching) if matching is not None else fetch_k):
+                # The probed lists hold too few matches; scan all of them once
+                rows, scores = self._scan_all(q, fetch_k, allowed)
+        else:
+            rows, scores = self._scan_all(q, fetch_k, allowed)
+        if self.codec is not None and self.rerank:
+            rows, scores = self._rerank(q, rows)
+        order = top_k_indices(scores, top_k)
+        return self._results(rows[order], scores[order], include_vectors, include_metadata)
+
+    def query_many(self, *, queries):
+        """Batched ``query``; takes Upstash ``QueryRequest`` dicts.
+
+        Exact scans over float32 storage are shared: queries with the same
+        filter are scored ``QUERY_BATCH`` at a time with one matrix product
+        per block, so the matrix is read once per batch instead of once per
+        query. ANN and compressed stores answer each query on its own.
+        """
+        results = [None] * len(queries)
+        groups = {}
+        for i, request in enumerate(queries):
+            if self.codec is None and (self.ann is None or request.get("exact")):
+                groups.setdefault(request.get("filter", ""), []).append(i)
+            else:
+                results[i] = self.query(**request)
+        for metadata_filter, members in groups.items():
+            for start in range(0, len(members), QUERY_BATCH):
+                batch = members[start : start + QUERY_BATCH]
+                for i, hits in zip(
+                    batch, self._query_batch([queries[i] for i in batch], metadata_filter)
+                ):
+                    results[i] = hits
+        return results
+
+    def _query_batch(self, requests, metadata_filter):
+        if self._matrix is None or not self._rows:
+            return [[] for _ in requests]
+        allowed = self._live
+        if metadata_filter:
+            allowed = self.attributes.mask(metadata_filter) & self._live
+        k = max(request.get("top_k", 10) for request in requests)
+        queries = normalize_rows([request["vector"] for request in requests])
+        best_rows = []
+        best_scores = []
+        for start in range(0, self._size, BLOCK_ROWS):
+            end = min(start + BLOCK_ROWS, self._size)
+            scores = self._matrix[start:end] @ queries.T  # (rows, queries)
+            scores[~allowed[start:end]] = -np.inf
+            local = _top_k_per_column(scores, k)
+            best_rows.append(local + start)
+            best_scores.append(np.take_along_axis(scores, local, axis=0))
+        rows = np.concatenate(best_rows)
+        scores = np.concatenate(best_scores)
+        hits = []
+        for column, request in enumerate(requests):
+            order = top_k_indices(scores[:, column], request.get("top_k", 10))
+            hits.append(
+                self._results(
+                    rows[order, column],
+                    scores[order, column],
+                    request.get("include_vectors", False),
+                    request.get("include_metadata", False),
+                )
+            )
+        return hits
+
+    def _score(self, index, prepared):
+        if self.codec is None:
+            return self._matrix[index] @ prepared
+        return self.codec.score(self._codes[index], prepared)
+
+    def _prepare(self, q):
+        return q if self.codec is None else self.codec.prepare(q)
+
+    def _scan_all(self, q, k, allowed=None):
+        prepared = self._prepare(q)
+        size = self._size
+        keep = self._live if allowed is None else allowed
+        best_rows = []
+        best_scores = []
+        for start in range(0, size, BLOCK_ROWS):
+            end = min(start + BLOCK_ROWS, size)
+            scores = self._score(slice(start, end), prepared)
+            scores[~keep[start:end]] = -np.inf
+            local = top_k_indices(scores, k)
+            best_rows.append(local + start)
+            best_scores.append(scores[local])
+        return np.concatenate(best_rows), np.concatenate(best_scores)
+
+    def _scan_ann(self, q, k, nprobe, allowed=None):
+        # Sorted rows keep reads from the memory-mapped file sequential
+        rows = np.sort(self.ann.candidates(q, nprobe))
+        if allowed is not None:
+            rows = rows[allowed[rows]]
+        return self._scan_rows(q, rows, k)
+
+    def _scan_rows(self, q, rows, k):
+        scores = self._score(rows, self._prepare(q))
+        best = top_k_indices(scores, k)
+        return rows[best], scores[best]
+
+    def _rerank(self, q, rows):
+        rows = np.sort(rows)
+        return rows, self._matrix[rows] @ q
+
+    def _results(self, rows, cosines, include_vectors, include_metadata):
+        hits = [
+            (self._ids[row], row, float(cos))
+            for row, cos in zip(rows.tolist(), cosines.tolist())
+            if np.isfinite(cos) and self._ids[row] is not None
+        ]
+        metadata = (
+            self.fetch_metadata([vector_id for vector_id, _, _ in hits])
+            if include_metadata
+            else {}
+        )
+        return [
+            QueryResult(
+                id=vector_id,
+                score=(1.0 + cos) / 2.0,
+                vector=self._matrix[row].tolist() if include_vectors else None,
+                metadata=metadata.get(vector_id),
+            )
+            for vector_id, row, cos in hits
+        ]
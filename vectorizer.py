@@ -1,22 +1,66 @@
 import os
 import time
-from datasets import load_dataset
+import argparse
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from tqdm import tqdm
+import openai
 from openai import OpenAI
 import getpass
+import tiktoken
 from upstash_vector import Index, Vector
 
+from checkpoint import CheckpointJournal
+from embedding_cache import EmbeddingCache, DEFAULT_CACHE_PATH
+from answer_cache import bump_generation, DEFAULT_GENERATION_PATH
+from lexical_index import BM25IndexBuilder, DEFAULT_LEXICAL_INDEX_PATH
+from chunker import chunk_article, DEFAULT_CHUNK_TOKENS, DEFAULT_CHUNK_OVERLAP
+from quantization import STORAGE_KINDS
+from embedding_export import ExportWriter, EmbeddingExport, push_export
+from sync_manifest import SyncManifest, fingerprint
+from vector_store import (
+    LocalVectorStore,
+    BACKENDS,
+    UPSTASH_URL,
+    DEFAULT_LOCAL_STORE_PATH,
+)
+
 # =====================================================
 # Global instances
 # =====================================================
 openai_client = None  # Will be initialized in main()
 upstash_index = None  # Will be initialized in main()
+embedding_cache = None  # Optional, initialized in main()
+_encoding = None  # Lazily loaded tiktoken encoding for MODEL
 
 # =====================================================
 # Set up OpenAI
 # =====================================================
 MODEL = "text-embedding-3-small"
 MAX_TOKENS_PER_REQUEST = 8191
+MAX_INPUTS_PER_REQUEST = 2048  # OpenAI limit on inputs per embeddings call
+
+# =====================================================
+# Ingestion pipeline settings
+# =====================================================
+DEFAULT_WORKERS = 4
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+UPSERT_BATCH_SIZE = 1000  # Upstash accepts up to 1000 vectors per upsert
+MAX_EMBED_RETRIES = 5
+MAX_UPSERT_RETRIES = 3
+CHECKPOINT_PATH = "checkpoint.db"
+SYNC_MANIFEST_PATH = "sync_manifest.db"
+DATASET_NAME = "ccdv/arxiv-summarization"
+DATASET_CONFIG = "section"
+
+# Errors that are worth retrying after backing off
+TRANSIENT_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
 
 
 # =====================================================
@@ -52,63 +96,787 @@ def get_upstash_token():
     return token
 
 
-def embed_texts(texts):
+# =====================================================
+# Tokens
+# =====================================================
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.encoding_for_model(MODEL)
+    return _encoding
+
+
+def count_tokens(text):
+    return len(get_encoding().encode(text))
+
+
+def truncate_to_tokens(text, max_tokens):
+    tokens = get_encoding().encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return get_encoding().decode(tokens[:max_tokens])
+
+
+def iter_token_batches(
+    records, max_tokens=MAX_TOKENS_PER_REQUEST, max_items=MAX_INPUTS_PER_REQUEST
+):
+    """Pack (id, text, metadata) records into batches that fit one embeddings call.
+
+    Yields (batch, batch_tokens) tuples. A text that exceeds the budget on its
+    own is truncated and sent as a single-item batch.
+    """
+    batch = []
+    batch_tokens = 0
+    for record_id, text, metadata in records:
+        n_tokens = count_tokens(text)
+        if n_tokens > max_tokens:
+            text = truncate_to_tokens(text, max_tokens)
+            n_tokens = max_tokens
+
+        if batch and (
+            batch_tokens + n_tokens > max_tokens or len(batch) >= max_items
+        ):
+            yield batch, batch_tokens
+            batch = []
+            batch_tokens = 0
+
+        batch.append((record_id, text, metadata))
+        batch_tokens += n_tokens
+
+    if batch:
+        yield batch, batch_tokens
+
+
+# =====================================================
+# Rate limiting
+# =====================================================
+class AdaptiveRateLimiter:
+    """Thread-safe request pacer with additive-increase / multiplicative-decrease.
+
+    Every successful call nudges the rate up towards ``max_rate``; every
+    throttled call halves it and pauses all workers for the server-suggested
+    retry delay.
+    """
+
+    def __init__(
+        self,
+        rate=DEFAULT_REQUESTS_PER_SECOND,
+        min_rate=0.2,
+        max_rate=50.0,
+        increase=0.1,
+        decrease=0.5,
+    ):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, retry_after=None):
+        with self._lock:
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            pause = retry_after if retry_after is not None else 1.0 / self.rate
+            self._next_slot = max(self._next_slot, time.monotonic() + pause)
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+# =====================================================
+# Embedding and upserting
+# =====================================================
+def _embed_texts_uncached(texts):
     response = openai_client.embeddings.create(model=MODEL, input=texts)
     return [e.embedding for e in response.data]
 
 
-def main():
+def embed_texts(texts):
+    if embedding_cache is None:
+        return _embed_texts_uncached(texts)
+    return embedding_cache.embed(MODEL, texts, _embed_texts_uncached)
+
+
+def embed_batch(batch, limiter, max_retries=MAX_EMBED_RETRIES):
+    texts = [text for _, text, _ in batch]
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        try:
+            embeddings = embed_texts(texts)
+        except TRANSIENT_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            limiter.on_throttle(_retry_after(e))
+            continue
+        limiter.on_success()
+        return embeddings
+
+
+def upsert_vectors(vectors, max_retries=MAX_UPSERT_RETRIES):
+    for attempt in range(max_retries + 1):
+        try:
+            upstash_index.upsert(vectors=vectors)
+            return
+        except Exception:
+            if attempt == max_retries:
+                raise
+            time.sleep(2**attempt)  # backoff strategy
+
+
+def delete_vectors(ids, max_retries=MAX_UPSERT_RETRIES):
+    for attempt in range(max_retries + 1):
+        try:
+            upstash_index.delete(ids)
+            return
+        except Exception:
+            if attempt == max_retries:
+                raise
+            time.sleep(2**attempt)
+
+
+class IngestStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.docs = 0
+        self.tokens = 0
+        self.failed = 0
+        self.deleted = 0
+
+    def elapsed(self):
+        return max(time.monotonic() - self.started, 1e-9)
+
+    def docs_per_sec(self):
+        return self.docs / self.elapsed()
+
+    def tokens_per_sec(self):
+        return self.tokens / self.elapsed()
+
+    def summary(self):
+        return (
+            f"{self.docs} docs, {self.tokens} tokens in {self.elapsed():.1f}s "
+            f"({self.docs_per_sec():.1f} docs/sec, "
+            f"{self.tokens_per_sec():.0f} tokens/sec)"
+        )
+
+
+def ingest(
+    records,
+    workers=DEFAULT_WORKERS,
+    upsert_batch_size=UPSERT_BATCH_SIZE,
+    limiter=None,
+    progress=None,
+    journal=None,
+    export=None,
+    manifest=None,
+):
+    """Embed and upsert records with a bounded pool of embedding workers.
+
+    Batches are packed by token count, embedded concurrently and the resulting
+    vectors are upserted in chunks of ``upsert_batch_size``. When a checkpoint
+    ``journal`` is given, every state change is recorded in it. With an
+    ``export`` (an ``ExportWriter``), every embedded batch is also appended
+    to it before upserting, so it survives upsert failures. A sync
+    ``manifest`` records the fingerprints of upserted records.
+    """
+    limiter = limiter or AdaptiveRateLimiter()
+    stats = IngestStats()
+    buffer = []
+    pending = {}
+
+    def flush(force=False):
+        while buffer and (force or len(buffer) >= upsert_batch_size):
+            chunk = buffer[:upsert_batch_size]
+            del buffer[:upsert_batch_size]
+            ids = [v.id for v in chunk]
+            try:
+                upsert_vectors(chunk)
+                stats.docs += len(chunk)
+                if journal is not None:
+                    journal.mark_upserted(ids)
+                if manifest is not None:
+                    manifest.mark_upserted(ids)
+            except Exception as e:
+                print(f"Error upserting {ids[0]}..{ids[-1]}: {e}")
+                stats.failed += len(chunk)
+                if journal is not None:
+                    journal.mark_failed(ids, e)
+            if progress is not None:
+                progress.update(len(chunk))
+                progress.set_postfix(
+                    docs_s=f"{stats.docs_per_sec():.1f}",
+                    tok_s=f"{stats.tokens_per_sec():.0f}",
+                    rps=f"{limiter.rate:.1f}",
+                )
+
+    def collect(done):
+        for future in done:
+            batch, batch_tokens = pending.pop(future)
+            try:
+                embeddings = future.result()
+            except Exception as e:
+                print(f"Error embedding {batch[0][0]}..{batch[-1][0]}: {e}")
+                stats.failed += len(batch)
+                if journal is not None:
+                    journal.mark_failed([r[0] for r in batch], e)
+                if progress is not None:
+                    progress.update(len(batch))
+                continue
+            stats.tokens += batch_tokens
+            if journal is not None:
+                journal.mark_embedded([r[0] for r in batch])
+            if export is not None:
+                export.append([r[0] for r in batch], embeddings, [r[2] for r in batch])
+            for (record_id, _, metadata), embedding in zip(batch, embeddings):
+                buffer.append(Vector(id=record_id, vector=embedding, metadata=metadata))
+        flush()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch, batch_tokens in iter_token_batches(records):
+            # Keep at most two batches per worker in flight to bound memory
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(embed_batch, batch, limiter)
+            pending[future] = (batch, batch_tokens)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    flush(force=True)
+    return stats
+
+
+# =====================================================
+# Record selection
+# =====================================================
+def parse_shard(value):
+    try:
+        k, n = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected k/N, got {value!r}")
+    if n < 1 or not 0 <= k < n:
+        raise argparse.ArgumentTypeError(f"Shard must satisfy 0 <= k < N, got {value!r}")
+    return k, n
+
+
+def select_indices(total, start=0, end=None, shard=(0, 1)):
+    """Dataset indices in [start, end) that belong to shard k of N (i % N == k)."""
+    end = total if end is None else min(end, total)
+    k, n = shard
+    first = start + (k - start) % n
+    return range(first, end, n)
+
+
+def covers_part(args, total):
+    """Whether --start/--end/--shard select less than the whole dataset."""
+    return (
+        args.start > 0
+        or tuple(args.shard) != (0, 1)
+        or (args.end is not None and (total is None or args.end < total))
+    )
+
+
+def checkpoint_target(args):
+    """The index a run writes to; its checkpoint journal is bound to it."""
+    if args.vector_store == "local":
+        return f"local:{os.path.abspath(args.local_store_path)}"
+    return f"upstash:{UPSTASH_URL}"
+
+
+def vector_id(i):
+    return f"arxiv_{i}"
+
+
+def chunk_id(i, chunk):
+    return f"arxiv_{i}_chunk_{chunk}"
+
+
+def pending_filter(journal, retry_failed_only=False):
+    """Predicate on record ids: not yet upserted, or failed with ``retry_failed_only``."""
+    if retry_failed_only:
+        failed = journal.failed_ids()
+        return lambda record_id: record_id in failed
+    completed = journal.completed_ids()
+    return lambda record_id: record_id not in completed
+
+
+def load_dataset(*args, **kwargs):
+    # datasets takes seconds to import; only pay for it once papers are streamed
+    from datasets import load_dataset
+
+    return load_dataset(*args, **kwargs)
+
+
+def dataset_size(dataset):
+    """Number of rows in a streaming split, from the dataset card metadata."""
+    splits = dataset.info.splits
+    return splits[dataset.split].num_examples if splits else None
+
+
+def iter_selected(examples, indices):
+    """Yield (i, example) for the stream positions in ``indices`` (a range).
+
+    The rows before ``indices.start`` are dropped with the stream's own
+    ``skip`` when it has one (Hugging Face ``IterableDataset``), so a late
+    --start does not format every earlier paper; rows are positional after it.
+    """
+    if indices.start and hasattr(examples, "skip"):
+        examples = examples.skip(indices.start)
+    else:
+        examples = itertools.islice(examples, indices.start, None)
+    # zip stops at the last index without reading past it
+    yield from zip(indices, itertools.islice(examples, 0, None, indices.step))
+
+
+def paper_attributes(example):
+    """Filterable metadata for one paper: its article length in words, plus the
+    title, primary category and year when the dataset has them.
+
+    ccdv/arxiv-summarization only carries the texts; arXiv metadata dumps
+    name these ``title``, ``categories`` and ``update_date``.
+    """
+    attributes = {"length": len(example.get("article", "").split())}
+    if example.get("title"):
+        attributes["title"] = " ".join(example["title"].split())
+    if example.get("categories"):
+        attributes["category"] = example["categories"].split()[0]
+    date = example.get("update_date") or example.get("published") or example.get("year")
+    if date and str(date)[:4].isdigit():
+        attributes["year"] = int(str(date)[:4])
+    return attributes
+
+
+def paper_records(i, example, chunk_tokens=None, chunk_overlap=DEFAULT_CHUNK_OVERLAP):
+    """(id, text, metadata) records for one paper: its abstract, then article chunks.
+
+    Every record's metadata names its paper so that retrieval can collapse
+    hits per paper, and carries the paper's attributes so chunks match the
+    same filters as the abstract.
+    """
+    paper = vector_id(i)
+    abstract = example["abstract"]
+    attributes = paper_attributes(example)
+    yield paper, f"Abstract: {abstract}", {"abstract": abstract, "paper": paper, **attributes}
+    if chunk_tokens:
+        chunks = chunk_article(
+            example["article"], get_encoding(), chunk_tokens, chunk_overlap
+        )
+        for n, text in enumerate(chunks):
+            yield chunk_id(i, n), text, {"text": text, "paper": paper, "chunk": n, **attributes}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Embed arXiv abstracts and upsert them to the vector index."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of concurrent embedding requests.",
+    )
+    parser.add_argument(
+        "--upsert-batch-size",
+        type=int,
+        default=UPSERT_BATCH_SIZE,
+        help="Number of vectors per upsert call.",
+    )
+    parser.add_argument(
+        "--requests-per-second",
+        type=float,
+        default=DEFAULT_REQUESTS_PER_SECOND,
+        help="Initial embedding request rate; adapts to rate-limit responses.",
+    )
+    parser.add_argument(
+        "--start", type=int, default=0, help="First dataset index to ingest."
+    )
+    parser.add_argument(
+        "--end", type=int, default=None, help="Stop before this dataset index."
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=(0, 1),
+        metavar="k/N",
+        help="Only ingest indices i with i %% N == k, for running N processes.",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=CHECKPOINT_PATH,
+        help="SQLite journal used to resume interrupted runs; one per target index.",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Only re-ingest records that failed in a previous run.",
+    )
+    parser.add_argument(
+        "--vector-store",
+        choices=BACKENDS,
+        default=os.getenv("VECTOR_STORE", "upstash"),
+        help="Where to upsert vectors: Upstash or the local in-process store.",
+    )
+    parser.add_argument(
+        "--local-store-path",
+        default=os.getenv("LOCAL_VECTOR_STORE_PATH", DEFAULT_LOCAL_STORE_PATH),
+        help="Directory of the local vector store.",
+    )
+    parser.add_argument(
+        "--build-ann",
+        action="store_true",
+        help="Build the IVF approximate nearest-neighbour index after ingesting "
+        "(local vector store only).",
+    )
+    parser.add_argument(
+        "--ann-lists",
+        type=int,
+        default=None,
+        help="Number of IVF lists; defaults to about 4 * sqrt(number of vectors).",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=STORAGE_KINDS,
+        default=None,
+        help="Encode the local store as float16, int8 or product-quantized codes "
+        "after ingesting (float32 vectors are kept on disk for re-ranking).",
+    )
+    parser.add_argument(
+        "--embedding-cache",
+        default=DEFAULT_CACHE_PATH,
+        help="Embedding cache shared with the chat server.",
+    )
+    parser.add_argument(
+        "--no-embedding-cache",
+        action="store_true",
+        help="Always call the embeddings API, bypassing the cache.",
+    )
+    parser.add_argument(
+        "--lexical-index",
+        default=DEFAULT_LEXICAL_INDEX_PATH,
+        help="Where to write the BM25 index over the selected abstracts, built "
+        "in the same pass for hybrid retrieval.",
+    )
+    parser.add_argument(
+        "--no-lexical-index",
+        action="store_true",
+        help="Skip building the BM25 index.",
+    )
+    parser.add_argument(
+        "--chunk-articles",
+        action="store_true",
+        help="Also embed the full articles as overlapping, section-aware chunks.",
+    )
+    parser.add_argument(
+        "--chunk-tokens",
+        type=int,
+        default=DEFAULT_CHUNK_TOKENS,
+        help="Maximum tokens per article chunk.",
+    )
+    parser.add_argument(
+        "--chunk-overlap",
+        type=int,
+        default=DEFAULT_CHUNK_OVERLAP,
+        help="Tokens shared by consecutive chunks.",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Only embed records that are new or changed since the last sync and "
+        "delete the vectors of records that disappeared.",
+    )
+    parser.add_argument(
+        "--sync-manifest",
+        default=SYNC_MANIFEST_PATH,
+        help="SQLite manifest of record fingerprints used by --sync.",
+    )
+    parser.add_argument(
+        "--export",
+        default=None,
+        help="Also append every embedding to this export directory (float32 "
+        "vectors, ids and metadata columns) for re-importing without the API.",
+    )
+    parser.add_argument(
+        "--from-export",
+        default=None,
+        help="Upsert the embeddings of an export directory instead of embedding "
+        "the dataset; no OpenAI calls are made.",
+    )
+    return parser.parse_args(argv)
+
+
+def embed_dataset(args):
+    """Embed the selected papers and upsert them; returns (stats, lexical_builder)."""
     global openai_client
-    global upstash_index
+    global embedding_cache
 
     # Initialize OpenAI client with user-provided API key
     openai_api_key = get_openai_api_key()
     openai_client = OpenAI(api_key=openai_api_key)
 
-    # Initialize Upstash index with user-provided token
-    upstash_token = get_upstash_token()
-    upstash_index = Index(
-        url="https://capable-midge-9649-eu1-vector.upstash.io",
-        token=upstash_token,
-    )
+    if not args.no_embedding_cache:
+        embedding_cache = EmbeddingCache(args.embedding_cache)
 
     print("Loading dataset...")
-    dataset = load_dataset("ccdv/arxiv-summarization", "section", split="train")
+    # Streamed, so neither the articles nor the abstracts are held in memory
+    dataset = load_dataset(DATASET_NAME, DATASET_CONFIG, split="train", streaming=True)
+    total = dataset_size(dataset)
+    if total is None and args.end is None:
+        raise ValueError("Dataset size unknown; pass --end.")
 
-    articles = dataset["article"]
-    abstracts = dataset["abstract"]
+    journal = CheckpointJournal(args.checkpoint, target=checkpoint_target(args))
+    indices = select_indices(total or args.end, args.start, args.end, args.shard)
+    is_pending = pending_filter(journal, retry_failed_only=args.retry_failed)
+    chunk_tokens = args.chunk_tokens if args.chunk_articles else None
 
-    successful_upserts = 0
-    failed_upserts = 0
+    lexical_builder = None
+    if not args.no_lexical_index:
+        if covers_part(args, total) and os.path.abspath(args.lexical_index) == os.path.abspath(
+            DEFAULT_LEXICAL_INDEX_PATH
+        ):
+            # The server loads this index; a shard's BM25 index would replace the full one
+            print(
+                "Skipping the BM25 index: this run covers part of the dataset. "
+                "Pass --lexical-index PATH to index this part on its own."
+            )
+        else:
+            lexical_builder = BM25IndexBuilder(args.lexical_index)
 
-    print("Embedding articles and abstracts and upserting to Upstash...")
+    skipped = 0
+    manifest = SyncManifest(args.sync_manifest) if args.sync else None
+    changes = {"new": 0, "changed": 0, "deleted": 0, "seeded": 0}
+    stale = []
+    # A first sync of an index built without --sync trusts the journal: records
+    # it marks upserted are taken as in sync with the current dataset
+    seed_ids = journal.completed_ids() if manifest is not None and not len(manifest) else set()
+    seeds = []
 
-    for i in tqdm(range(len(dataset))):
-        text = f"Abstract: {abstracts[i]}"
-        try:
-            # Embed each pair as one input
-            embedding = embed_texts([text])[0]
-
-            # Upsert to Upstash
-            upstash_index.upsert(
-                vectors=[
-                    Vector(
-                        id=f"arxiv_{i}",
-                        vector=embedding,
-                        metadata={"abstract": abstracts[i]},
-                    )
-                ]
+    def flush_seeds(force=False):
+        if seeds and (force or len(seeds) >= args.upsert_batch_size):
+            manifest.seed(seeds)
+            changes["seeded"] += len(seeds)
+            seeds.clear()
+
+    def delete_stale(force=False):
+        while stale and (force or len(stale) >= args.upsert_batch_size):
+            ids = stale[: args.upsert_batch_size]
+            del stale[: args.upsert_batch_size]
+            delete_vectors(ids)
+            manifest.remove(ids)
+            journal.forget(ids)
+            changes["deleted"] += len(ids)
+
+    def changed_records(i, example):
+        """Records of paper ``i`` whose fingerprint differs from the last sync."""
+        nonlocal skipped
+        previous = manifest.paper_fingerprints(i)
+        for record in paper_records(i, example, chunk_tokens, args.chunk_overlap):
+            record_fingerprint = fingerprint(MODEL, record[1])
+            synced = previous.pop(record[0], None)
+            if synced is None and record[0] in seed_ids:
+                seeds.append((record[0], i, record_fingerprint))
+                synced = record_fingerprint
+            if synced == record_fingerprint:
+                skipped += 1
+                progress.update(1)
+                continue
+            changes["new" if synced is None else "changed"] += 1
+            manifest.stage(record[0], i, record_fingerprint)
+            yield record
+        # Records the paper no longer produces, e.g. chunks of a shortened article
+        stale.extend(previous)
+        delete_stale()
+        flush_seeds()
+
+    def iter_records():
+        nonlocal skipped
+        for i, example in iter_selected(dataset, indices):
+            # The BM25 index covers every selected paper, including those
+            # already embedded in an earlier run
+            if lexical_builder is not None:
+                lexical_builder.add(vector_id(i), example["abstract"])
+            if manifest is not None:
+                yield from changed_records(i, example)
+                continue
+            for record in paper_records(i, example, chunk_tokens, args.chunk_overlap):
+                if is_pending(record[0]):
+                    yield record
+                else:
+                    skipped += 1
+                    progress.update(1)
+
+    records = iter_records()
+
+    print(f"Embedding articles and abstracts and upserting to {args.vector_store}...")
+
+    limiter = AdaptiveRateLimiter(rate=args.requests_per_second)
+    # Chunk counts are only known once each article has been split
+    progress_total = None if chunk_tokens else len(indices)
+    export = ExportWriter(args.export, model=MODEL) if args.export else None
+    try:
+        with journal, tqdm(total=progress_total, unit="doc") as progress:
+            stats = ingest(
+                records,
+                workers=args.workers,
+                upsert_batch_size=args.upsert_batch_size,
+                limiter=limiter,
+                progress=progress,
+                journal=journal,
+                export=export,
+                manifest=manifest,
             )
-            successful_upserts += 1
-        except Exception as e:
-            print(f"Error at index {i}: {e}")
-            failed_upserts += 1
-            time.sleep(2)  # backoff strategy
+            if manifest is not None:
+                # Papers past the end of a dataset that shrank
+                if total is not None:
+                    stale.extend(manifest.vanished_ids(total, args.start, args.end, args.shard))
+                delete_stale(force=True)
+                flush_seeds(force=True)
+                stats.deleted = changes["deleted"]
+            failures = journal.counts().get("failed", 0)
+    finally:
+        if export is not None:
+            export.close()
+        if manifest is not None:
+            manifest.close()
+
+    if manifest is not None:
+        print(
+            f"Sync: {changes['new']} new, {changes['changed']} changed, "
+            f"{skipped} unchanged, {changes['deleted']} deleted."
+        )
+        if changes["seeded"]:
+            print(f"{changes['seeded']} unchanged records were taken from {args.checkpoint}.")
+    else:
+        print(f"{skipped} records were already done and skipped.")
+    print(f"Done. {stats.docs} embeddings successfully upserted to {args.vector_store}.")
+    print(f"Failed upserts: {stats.failed}")
+    if failures:
+        print(f"{failures} records failed in total; rerun with --retry-failed.")
+    print(f"Throughput: {stats.summary()}")
+    print(f"Rate limited responses: {limiter.throttled}")
+    if embedding_cache is not None:
+        print(f"Embedding cache: {embedding_cache.stats()}")
+    if export is not None:
+        print(f"Export at {args.export} now holds {len(export)} embeddings.")
+    return stats, lexical_builder
+
+
+def import_export(args):
+    """Upsert the embeddings of an export; returns (stats, lexical_builder)."""
+    export = EmbeddingExport(args.from_export)
+    if export.model not in (None, MODEL):
+        raise ValueError(
+            f"{args.from_export} holds {export.model} embeddings; queries use {MODEL}."
+        )
+
+    lexical_builder = None
+    if not args.no_lexical_index:
+        lexical_builder = BM25IndexBuilder(args.lexical_index)
+        # Later rows of a repeated id win, as they do when upserted
+        abstracts = dict(zip(export.ids, export.column("abstract")))
+        for record_id, abstract in abstracts.items():
+            if abstract is not None:
+                lexical_builder.add(record_id, abstract)
+
+    print(f"Upserting {len(export)} embeddings from {args.from_export} to {args.vector_store}...")
+    stats = IngestStats()
+    # Recorded like embedded records, so a first --sync of this index seeds from the journal
+    journal = CheckpointJournal(args.checkpoint, target=checkpoint_target(args))
+    with journal, tqdm(total=len(export), unit="vec") as progress:
+
+        def upsert(records):
+            upsert_vectors(records)
+            journal.mark_upserted([record[0] for record in records])
+            stats.docs += len(records)
+            progress.update(len(records))
+
+        push_export(
+            export,
+            upsert,
+            batch_size=args.upsert_batch_size,
+            as_lists=args.vector_store != "local",
+        )
+    print(f"Done. {stats.docs} embeddings upserted in {stats.elapsed():.1f}s.")
+    return stats, lexical_builder
+
+
+def main(argv=None):
+    global upstash_index
+
+    args = parse_args(argv)
+
+    if args.vector_store == "local":
+        upstash_index = LocalVectorStore(args.local_store_path)
+    else:
+        # Initialize Upstash index with user-provided token
+        upstash_token = get_upstash_token()
+        upstash_index = Index(
+            url=UPSTASH_URL,
+            token=upstash_token,
+        )
+
+    try:
+        if args.from_export:
+            stats, lexical_builder = import_export(args)
+        else:
+            stats, lexical_builder = embed_dataset(args)
+
+        if lexical_builder is not None:
+            lexical_index = lexical_builder.finish()
+            print(f"BM25 index over {len(lexical_index)} abstracts written to {args.lexical_index}.")
+
+        if args.compress:
+            if args.vector_store != "local":
+                print("Skipping --compress: only the local vector store can be compressed.")
+            else:
+                print(f"Compressing vectors to {args.compress}...")
+                upstash_index.compress(args.compress)
+                print(
+                    f"Scan footprint: {upstash_index.memory_footprint() / 2**20:.1f} MiB "
+                    f"for {len(upstash_index)} vectors."
+                )
 
-        time.sleep(0.15)  # delay to avoid rate limit
+        if args.build_ann:
+            if args.vector_store != "local":
+                print("Skipping --build-ann: only the local vector store has an ANN index.")
+            else:
+                print("Building IVF index...")
+                started = time.monotonic()
+                ann = upstash_index.build_ann_index(n_lists=args.ann_lists)
+                print(
+                    f"Built IVF index with {ann.n_lists} lists over {len(upstash_index)} "
+                    f"vectors in {time.monotonic() - started:.1f}s."
+                )
+    finally:
+        if args.vector_store == "local":
+            # Saves the IVF assignments and attribute index, deferred until now
+            upstash_index.close()
 
-    print(f"Done. {successful_upserts} embeddings successfully upserted to Upstash.")
-    print(f"Failed upserts: {failed_upserts}")
+    if stats.docs or stats.deleted or lexical_builder is not None or args.compress or args.build_ann:
+        # Cached chat answers were retrieved from the previous index contents
+        bump_generation(os.getenv("INDEX_GENERATION_PATH", DEFAULT_GENERATION_PATH))
 
 
 if __name__ == "__main__":